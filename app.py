@@ -4,10 +4,16 @@ import json
 import openpyxl
 import csv
 from io import BytesIO
-import boto3
-from myfunction import process_event  # Import the process_event function
+import appcache
+import clients
+import ingest
+import s3listing
+from myfunction import process_event, stream_event  # Import the process_event function
 import time
 
+# Options sent to the S3 file selectbox; longer lists make every rerun slow in the browser
+MAX_S3_OPTIONS = 1000
+
 def main():
     st.title("Upload File and Enter Prompt")
 
@@ -17,21 +23,46 @@ def main():
     # User input: File upload
     uploaded_file = st.file_uploader("Choose a file", type=['xlsx','csv',])
 
-    # S3 Client
-    s3_client = boto3.client('s3')
+    # Uploads are parsed once per content hash and kept across reruns (appcache.py)
+    upload_key = appcache.upload_key(uploaded_file) if uploaded_file is not None else None
+
+    # Let the user pick sheets of an uploaded workbook (names are read without parsing the sheets)
+    sheets = None
+    if uploaded_file is not None and ingest.is_xlsx(uploaded_file.name.split('.')[-1]):
+        sheet_names = appcache.data((upload_key, 'sheet_names'), lambda: ingest.list_sheets(uploaded_file.getvalue()))
+        sheets = st.multiselect("Sheets", sheet_names, default=sheet_names[:1]) or None
+
+    # How the table is sent: all rows, map-reduce chunks, or only the schema for an exact local query
+    answer_modes = {"Full table": None, "Map-reduce for large files": 'mapreduce', "Exact query (schema only)": 'query'}
+    answer_mode = answer_modes[st.radio("Answer mode", list(answer_modes))]
+
+    # Show the answer as it is generated (full-table answers only)
+    stream_response = st.checkbox("Stream response", value=True, disabled=answer_mode is not None)
+
+    # Compact encoding sends the same table in fewer input tokens
+    table_encoding = st.selectbox("Table encoding", list(ingest.ENCODERS), index=list(ingest.ENCODERS).index(ingest.DEFAULT_ENCODING))
+
+    # Shared S3 client, reused across reruns
+    s3_client = clients.s3()
     bucket_name = 'bedrocktest03'
 
-    # Get list of files in S3 bucket
-    s3_files = []
-    try:
-        response = s3_client.list_objects_v2(Bucket=bucket_name)
-        if 'Contents' in response:
-            s3_files = [obj['Key'] for obj in response['Contents']]
-    except Exception as e:
-        st.error(f"Error fetching S3 files: {e}")
+    # Spreadsheets in the S3 bucket, listed only when no file is uploaded. The full listing is paginated and
+    # cached across reruns (s3listing.py); a prefix narrows it and at most MAX_S3_OPTIONS keys reach the browser
+    s3_file_selected = "None"
+    if uploaded_file is None:
+        prefix_column, refresh_column = st.columns([4, 1])
+        s3_prefix = prefix_column.text_input("S3 key prefix", "")
+        refresh_listing = refresh_column.button("Refresh list")
+        s3_files = ()
+        try:
+            s3_files = s3listing.list_keys(s3_client, bucket_name, s3_prefix, ('xlsx', 'csv'), refresh=refresh_listing)
+        except Exception as e:
+            st.error(f"Error fetching S3 files: {e}")
+        if len(s3_files) > MAX_S3_OPTIONS:
+            st.caption(f"Showing the first {MAX_S3_OPTIONS:,} of {len(s3_files):,} files; type a longer prefix to narrow them down")
 
-    # Add "None" option to allow unselecting S3 file
-    s3_file_selected = st.selectbox("Select a file from S3 bucket", ["None"] + s3_files)
+        # Add "None" option to allow unselecting S3 file
+        s3_file_selected = st.selectbox("Select a file from S3 bucket", ("None",) + s3_files[:MAX_S3_OPTIONS])
 
     # Placeholder for timer
     timer_placeholder = st.empty()
@@ -42,22 +73,52 @@ def main():
                 start_time = time.time()
                 timer_running = True
                 
+                s3_key = None
+                tables = None
                 if uploaded_file is not None:
-                    # Read the uploaded file
-                    file_contents = uploaded_file.read()
+                    # Read the uploaded file; its tables are parsed on the first question only
+                    file_contents = uploaded_file.getvalue()
                     filetype = uploaded_file.type.split('/')[-1]
+                    if ingest.is_xlsx(filetype) or ingest.is_csv(filetype):
+                        tables = appcache.data((upload_key, 'tables', repr(sheets)),
+                                               lambda: ingest.load_file_tables(file_contents, filetype, sheets))
                     
                 elif s3_file_selected != "None":
-                    # Read the selected S3 file
-                    s3_object = s3_client.get_object(Bucket=bucket_name, Key=s3_file_selected)
-                    file_contents = s3_object['Body'].read()
+                    # Parsed by key through s3cache: memory, disk, then the Parquet sidecar before the object itself
+                    file_contents = None
                     filetype = s3_file_selected.split('.')[-1]
+                    s3_key = s3_file_selected
                 else:
                     file_contents = None
                     filetype = ''  # Default filetype when no file is uploaded
 
+                if stream_response and answer_mode is None:
+                    # Render text deltas as they arrive from Bedrock
+                    st.subheader("Response:")
+                    response_placeholder = st.empty()
+                    text = ""
+                    try:
+                        stream = stream_event(user_prompt, file_contents, filetype, table_encoding, sheets, s3_key=s3_key, tables=tables)
+                        for delta in stream:
+                            text += delta
+                            response_placeholder.markdown(text)
+                    except Exception as e:
+                        # Any text already shown stays on the page above the error
+                        st.error(f"Error generating the response: {e}")
+                        timer_placeholder.write(f"Elapsed time: {time.time() - start_time:.2f} seconds")
+                        return
+                    timer_running = False
+
+                    stats = stream.stats()
+                    st.caption(f"Time to first token: {stats['time_to_first_token'] or 0:.2f} s, "
+                               f"total: {stats['total_latency']:.2f} s, "
+                               f"tokens in/out: {stats['input_tokens']}/{stats['output_tokens']}")
+                    timer_placeholder.write(f"Elapsed time: {time.time() - start_time:.2f} seconds")
+                    return
+
                 # Process the event using the local function
-                result = process_event(user_prompt, file_contents, filetype)
+                result = process_event(user_prompt, file_contents, filetype, table_encoding, sheets,
+                                       answer_mode, s3_key=s3_key, tables=tables)
 
                 # Stop the timer
                 elapsed_time = time.time() - start_time
@@ -70,8 +131,13 @@ def main():
                 st.write(result.get('response', '').get('content', [])[0].get('text', ''))
             
 
-                # Display elapsed time
+                # Display elapsed time, then where it went stage by stage
                 timer_placeholder.write(f"Elapsed time: {elapsed_time:.2f} seconds")
+                trace = result.get('trace')
+                if trace:
+                    stages = ", ".join(f"{name} {ms:.0f} ms" for name, ms in trace['spans_ms'].items())
+                    counters = ", ".join(f"{name} {value}" for name, value in trace['counters'].items())
+                    st.caption(f"Stages: {stages or 'none'} | {counters}")
 
 if __name__ == "__main__":
     main()
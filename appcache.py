@@ -0,0 +1,135 @@
+# Rerun-safe caches for the Streamlit apps.
+#
+# Streamlit executes the whole script again on every widget change and chat
+# message, but imported modules stay loaded, so what is kept here survives
+# reruns and is shared by every session of the server process. resource()
+# builds a long-lived object (a LangChain model, a chain) once per name. data()
+# keeps parsed uploads and what is derived from them (DataFrames, tables, row
+# indexes, data-quality results, agents bound to a DataFrame) under a key that
+# starts with the upload's content hash, and evicts the least recently used
+# entries once their estimated size passes APP_CACHE_BYTES. boto3 clients are
+# already shared by clients.py.
+#
+# Cached values are shared: callers must not modify them in place.
+
+import hashlib
+import logging
+import os
+import sys
+import threading
+from collections import OrderedDict
+
+import numpy as np
+
+CACHE_BYTES = int(os.environ.get('APP_CACHE_BYTES', str(512 * 1024 * 1024)))
+UPLOAD_HASHES = 256       # upload ids whose content hash is remembered
+
+_lock = threading.Lock()
+_resources = {}           # name -> object
+_entries = OrderedDict()  # key -> (value, estimated bytes)
+_cache_bytes = 0
+_upload_hashes = OrderedDict()
+_stats = {
+    'hits': 0,
+    'misses': 0,
+    'evictions': 0,
+    'resources_built': 0,
+}
+
+
+def stats():
+    with _lock:
+        counters = dict(_stats)
+        counters['entries'] = len(_entries)
+        counters['bytes'] = _cache_bytes
+        counters['resources'] = len(_resources)
+    return counters
+
+
+def clear():
+    global _cache_bytes
+    with _lock:
+        _resources.clear()
+        _entries.clear()
+        _upload_hashes.clear()
+        _cache_bytes = 0
+        for name in _stats:
+            _stats[name] = 0
+
+
+def content_key(data):
+    return hashlib.sha256(data).hexdigest()
+
+
+def upload_key(uploaded_file):
+    # Content hash of a Streamlit upload; hashed once per upload rather than once per rerun
+    file_id = getattr(uploaded_file, 'file_id', None)
+    if file_id is None:
+        return content_key(uploaded_file.getvalue())
+    with _lock:
+        key = _upload_hashes.get(file_id)
+    if key is None:
+        key = content_key(uploaded_file.getvalue())
+        with _lock:
+            _upload_hashes[file_id] = key
+            while len(_upload_hashes) > UPLOAD_HASHES:
+                _upload_hashes.popitem(last=False)
+    return key
+
+
+def size_of(value):
+    # Estimated bytes held by a cached value
+    if isinstance(value, (tuple, list)):
+        return sys.getsizeof(value) + sum(size_of(item) for item in value)
+    if isinstance(value, dict):
+        return sys.getsizeof(value) + sum(size_of(item) for item in value.values())
+    if hasattr(value, 'memory_usage'):
+        # pandas DataFrame or Series, including the strings in object columns
+        return int(np.sum(value.memory_usage(deep=True)))
+    nbytes = getattr(value, 'nbytes', None)
+    if isinstance(nbytes, (int, np.integer)):
+        return int(nbytes)
+    return sys.getsizeof(value)
+
+
+def resource(name, factory):
+    # The object factory() built the first time name was asked for
+    value = _resources.get(name)
+    if value is not None:
+        return value
+    with _lock:
+        value = _resources.get(name)
+        if value is None:
+            logging.debug(f"Building shared resource {name}")
+            value = factory()
+            _resources[name] = value
+            _stats['resources_built'] += 1
+    return value
+
+
+def data(key, factory):
+    # Cached factory() for key (a tuple starting with an upload's content hash)
+    global _cache_bytes
+    with _lock:
+        entry = _entries.get(key)
+        if entry is not None:
+            _entries.move_to_end(key)
+            _stats['hits'] += 1
+            return entry[0]
+        _stats['misses'] += 1
+    # Built outside the lock; two sessions asking at once may both build it, and the last one is kept
+    value = factory()
+    size = size_of(value)
+    if size > CACHE_BYTES:
+        logging.debug(f"App cache: {key[1:]} ({size} bytes) is larger than the whole cache, not kept")
+        return value
+    with _lock:
+        previous = _entries.pop(key, None)
+        if previous is not None:
+            _cache_bytes -= previous[1]
+        _entries[key] = (value, size)
+        _cache_bytes += size
+        while _cache_bytes > CACHE_BYTES:
+            _cache_bytes -= _entries.popitem(last=False)[1][1]
+            _stats['evictions'] += 1
+    return value
@@ -0,0 +1,208 @@
+# Concurrent, resumable batch runner for JSONL files of Bedrock requests.
+#
+# Each input line is one request, in any of these shapes:
+#   {"id": "q1", "prompt": "What's aws for"}                         plain prompt
+#   {"id": "q2", "body": {"anthropic_version": ..., "messages": ...}}  invoke_model body
+#   {"id": "q3", "anthropic_version": ..., "messages": [...]}        invoke_model body inline
+#   {"id": "q4", "messages": [...], "inferenceConfig": {...}}        Converse request (text.json)
+# with an optional "modelId". Lines without an id are identified as line-<n> by line number.
+#
+# Requests run on a bounded thread pool and each result is appended to the output
+# JSONL as soon as it completes. The output file is the checkpoint: rerunning with
+# the same output skips every id that already has a successful result, so a crashed
+# or interrupted run only redoes unfinished (or failed) lines.
+#
+# Usage: python batch.py requests.jsonl results.jsonl [--concurrency 8] [--model-id ...]
+
+import argparse
+import base64
+import io
+import json
+import logging
+import os
+import threading
+import time
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+
+import clients
+import codec
+import ingest
+import ratelimit
+import responsecache
+
+MODEL_ID = "anthropic.claude-3-sonnet-20240229-v1:0"
+CONCURRENCY = int(os.environ.get('BATCH_CONCURRENCY', '8'))
+MAX_TOKENS = 1000
+CONVERSE_FIELDS = ('system', 'inferenceConfig', 'additionalModelRequestFields', 'toolConfig', 'guardrailConfig')
+
+
+def read_requests(path):
+    # Yield (id, request) for each non-blank line without loading the whole file; a line that is not
+    # a JSON object yields (its line-<n> id, the error) so it is reported without stopping the run
+    with open(path, encoding='utf-8') as f:
+        for number, line in enumerate(f, 1):
+            if not line.strip():
+                continue
+            try:
+                request = json.loads(line)
+            except json.JSONDecodeError as e:
+                yield f"line-{number}", ValueError(f"Invalid JSON on line {number}: {e}")
+                continue
+            if not isinstance(request, dict):
+                yield f"line-{number}", ValueError(f"Line {number} is not a JSON object")
+                continue
+            request_id = request.get('id')
+            yield (f"line-{number}" if request_id is None else str(request_id)), request
+
+
+def completed_ids(path):
+    # Ids with a successful result in an earlier run; a torn last line or a line without an id is ignored
+    done = set()
+    if not os.path.exists(path):
+        return done
+    with open(path, encoding='utf-8') as f:
+        for line in f:
+            try:
+                result = json.loads(line)
+            except json.JSONDecodeError:
+                continue
+            if isinstance(result, dict) and 'error' not in result and result.get('id') is not None:
+                done.add(str(result['id']))
+    return done
+
+
+def _torn(path):
+    if not os.path.getsize(path):
+        return False
+    with open(path, 'rb') as f:
+        f.seek(-1, os.SEEK_END)
+        return f.read(1) != b'\n'
+
+
+def _converse_content(block):
+    # text.json style file blocks become table text; None values (e.g. "top_k": null) are dropped
+    if 'file' not in block:
+        return block
+    file = block['file']
+    data = base64.b64decode(file['data'])
+    filetype = file.get('type') or file.get('name', '').split('.')[-1]
+    buffer = io.StringIO()
+    if ingest.is_xlsx(filetype) or file.get('name', '').endswith('.xlsx'):
+        buffer.write(f"{file.get('name', 'Excel file')} contents:\n")
+        ingest.write_xlsx_text(buffer, data)
+    elif ingest.is_csv(filetype) or file.get('name', '').endswith('.csv'):
+        buffer.write(f"{file.get('name', 'CSV file')} contents:\n")
+        ingest.write_csv_text(buffer, data)
+    else:
+        raise ValueError(f"Unsupported file type in request: {filetype}")
+    return {'text': buffer.getvalue()}
+
+
+def _without_none(value):
+    if isinstance(value, dict):
+        return {k: _without_none(v) for k, v in value.items() if v is not None}
+    return value
+
+
+def invoke(client, request, model_id=MODEL_ID):
+    # Run one request and return (response payload, usage)
+    model_id = request.get('modelId', model_id)
+    if 'messages' in request and 'anthropic_version' not in request:
+        messages = [dict(message, content=[_converse_content(block) for block in message['content']])
+                    for message in request['messages']]
+        params = {name: _without_none(request[name]) for name in CONVERSE_FIELDS if request.get(name)}
+        response = ratelimit.converse(client, modelId=model_id, messages=messages, **params)
+        response.pop('ResponseMetadata', None)
+        return response, response.get('usage', {})
+
+    body = request.get('body') or {k: v for k, v in request.items() if k not in ('id', 'modelId')}
+    if 'prompt' in request and 'body' not in request:
+        body = {
+            "anthropic_version": "bedrock-2023-05-31",
+            "max_tokens": request.get('max_tokens', MAX_TOKENS),
+            "messages": [
+                {
+                    "role": "user",
+                    "content": [
+                        {
+                            "type": "text",
+                            "text": request['prompt']
+                        }
+                    ]
+                }
+            ]
+        }
+    response = responsecache.invoke_model(client, modelId=model_id, body=codec.encode(body))
+    payload = codec.decode(response).payload
+    return payload, payload.get('usage', {})
+
+
+def run(input_path, output_path, client=None, concurrency=CONCURRENCY, model_id=MODEL_ID):
+    # Returns a summary with counts, elapsed time and summed token usage
+    client = client or clients.bedrock_runtime()
+    done = completed_ids(output_path)
+    summary = {'completed': 0, 'failed': 0, 'skipped': 0, 'usage': {}}
+    lock = threading.Lock()
+    started = time.perf_counter()
+
+    with open(output_path, 'a', encoding='utf-8') as out:
+        # Start on a fresh line if the previous run died mid-write
+        if _torn(output_path):
+            out.write('\n')
+
+        def work(item):
+            request_id, request = item
+            request_started = time.perf_counter()
+            try:
+                if isinstance(request, Exception):
+                    raise request
+                payload, usage = invoke(client, request, model_id)
+                result = {'id': request_id, 'response': payload}
+            except Exception as e:
+                logging.warning(f"Batch request {request_id} failed: {e}")
+                result, usage = {'id': request_id, 'error': str(e)}, {}
+            result['latency'] = time.perf_counter() - request_started
+            line = json.dumps(result, default=str) + '\n'
+            with lock:
+                out.write(line)
+                out.flush()
+                summary['failed' if 'error' in result else 'completed'] += 1
+                for name, count in usage.items():
+                    if isinstance(count, int):
+                        summary['usage'][name] = summary['usage'].get(name, 0) + count
+
+        # Keep a bounded number of requests in flight so huge inputs are streamed
+        with ThreadPoolExecutor(max_workers=concurrency) as pool:
+            pending = set()
+            for request_id, request in read_requests(input_path):
+                if request_id in done:
+                    summary['skipped'] += 1
+                    continue
+                done.add(request_id)
+                if len(pending) >= concurrency * 2:
+                    finished, pending = wait(pending, return_when=FIRST_COMPLETED)
+                    for future in finished:
+                        future.result()
+                pending.add(pool.submit(work, (request_id, request)))
+            for future in pending:
+                future.result()
+        os.fsync(out.fileno())
+
+    summary['elapsed'] = time.perf_counter() - started
+    return summary
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Run a JSONL file of Bedrock requests concurrently")
+    parser.add_argument('input', help="JSONL file with one request per line")
+    parser.add_argument('output', help="JSONL results file; rerunning resumes from it")
+    parser.add_argument('--concurrency', type=int, default=CONCURRENCY)
+    parser.add_argument('--model-id', default=MODEL_ID)
+    args = parser.parse_args()
+    summary = run(args.input, args.output, concurrency=args.concurrency, model_id=args.model_id)
+    print(f"{summary['completed']} completed, {summary['failed']} failed, {summary['skipped']} already done "
+          f"in {summary['elapsed']:.1f} s; usage {summary['usage']}")
+
+
+if __name__ == "__main__":
+    main()
@@ -1,8 +1,17 @@
 import json
-import boto3
-import openpyxl
-from io import BytesIO
+import clients
+import codec
+import ratelimit
+import responsecache
+import router
+import tracing
+import time
+import io
+import ingest
+import s3cache
 
+@tracing.traced('bedrockdoc')
+@ratelimit.lambda_deadline
 def lambda_handler(event, context):
     print(event)
     user_prompt=event['prompt']
@@ -11,6 +20,7 @@ def lambda_handler(event, context):
     request_body = event.get('body', {
         "anthropic_version": "bedrock-2023-05-31",
         "max_tokens": 50,
+        "temperature": 0,
         "messages": [
             {
                 "role": "user",
@@ -24,56 +34,60 @@ def lambda_handler(event, context):
         ]
     })
 
-    # Create an S3 client
-    s3_client = boto3.client('s3')
+    # Shared S3 client, reused across invocations
+    s3_client = clients.s3()
 
     # S3 bucket and file key details
     bucket_name = 'bedrocktest03'
     file_key = 'Employee_Details-2.xlsx'
 
     try:
-        # Retrieve the file from S3
-        s3_object = s3_client.get_object(Bucket=bucket_name, Key=file_key)
-        file_data = s3_object['Body'].read()
-
-        # Read the Excel file
-        excel_file = BytesIO(file_data)
-        workbook = openpyxl.load_workbook(excel_file)
-        sheet = workbook.active
-
-        # Extract information from the Excel file
-        excel_info = []
-        for row in sheet.iter_rows(values_only=True):
-            excel_info.append(list(row))
-
-        # Convert Excel data to a readable string format
-        excel_data_text = "\n".join([", ".join(map(str, row)) for row in excel_info])
+        # Retrieve the parsed tables, reusing them while the object's ETag is unchanged; event
+        # 'columns' limits them to those header names (read alone from the Parquet sidecar)
+        tables = s3cache.get_sheets(s3_client, bucket_name, file_key, event.get('sheets'), event.get('columns'))
+        buffer = io.StringIO()
+        buffer.write("Excel file contents:\n")
+        ingest.write_sheets(buffer, tables)
 
         # Add Excel data as text to the request body
         request_body["messages"][0]["content"].append({
             "type": "text",
-            "text": f"Excel file contents:\n{excel_data_text}"
+            "text": buffer.getvalue()
         })
 
-        # Create a Bedrock runtime client (replace with your region)
-        client = boto3.client('bedrock-runtime', region_name='us-east-1')
+        # Encode the request once, straight to the bytes that are sent
+        with tracing.span('encode_request'):
+            body = codec.encode(request_body)
+        tracing.count('request_bytes', len(body))
+
+        # Shared Bedrock runtime client, reused across invocations
+        client = clients.bedrock_runtime()
 
-        # Set the model ID for Claude 3 Sonnet
-        model_id = "anthropic.claude-3-sonnet-20240229-v1:0"
+        # Small, simple requests go to a faster model, large or analytical ones to a stronger one; event 'model_id' pins one
+        route = router.route('table', body.input_tokens, user_prompt, event.get('model_id'))
+        model_id = route.model_id
 
-        # Send the request to Bedrock using the 'invoke' API method
-        response = client.invoke_model(
-            modelId=model_id,
-            body=json.dumps(request_body)
-        )
+        # Send the request to Bedrock using the 'invoke' API method; repeated requests are answered from the response cache
+        with tracing.span('bedrock_invoke'):
+            started = time.perf_counter()
+            response = responsecache.invoke_model(
+                client,
+                modelId=model_id,
+                body=body
+            )
+            router.record(route, started, response)
 
-        # Read the content from the StreamingBody
-        response_payload = response['body'].read().decode('utf-8')
-        print("Full Response Payload:", response_payload)
+        # Hit rate and invoke latency saved so far
+        print("Response cache:", response.get('cache'), responsecache.stats())
+        print("Route latency:", router.stats())
 
-        # Parse the payload
-        payload = json.loads(response_payload)
-        generated_text = payload.get('completions', [{}])[0].get('text', '')
+        # Parse the payload straight from the response bytes
+        with tracing.span('decode_response'):
+            completion = codec.decode(response)
+        payload = completion.payload
+        tracing.usage(completion.usage)
+        print("Full Response Payload:", payload)
+        generated_text = completion.text
 
         # Return the generated text
         return {
@@ -82,8 +96,8 @@ def lambda_handler(event, context):
         }
 
     except Exception as e:
-        # Handle any errors that occurred during the process
+        # Handle any errors that occurred during the process; throttling that outlasted the retries is a 429
         return {
-            'statusCode': 500,
+            'statusCode': 429 if ratelimit.is_throttle(e) else 500,
             'body': json.dumps({'error': str(e)})
         }
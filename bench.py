@@ -0,0 +1,757 @@
+# Micro benchmarks for the ingestion and request pipeline.
+#
+# Usage: python bench.py <name> [options]
+# Each benchmark prints a small table; nothing here talks to AWS.
+
+import argparse
+import datetime
+import io
+import os
+import random
+import resource
+import subprocess
+import sys
+import tempfile
+import time
+
+import openpyxl
+
+import ingest
+import retrieval
+import tokens
+
+
+def make_xlsx(path, rows, cols=8):
+    # Write a synthetic employee-style sheet using openpyxl's write-only mode
+    workbook = openpyxl.Workbook(write_only=True)
+    sheet = workbook.create_sheet("Sheet1")
+    sheet.append([f"col_{c}" for c in range(cols)])
+    departments = ["Finance", "Engineering", "Sales", "Support", "HR"]
+    for r in range(rows):
+        row = [r, f"Employee {r}", departments[r % len(departments)], 1000.5 + r, None]
+        row += [f"note {r % 97}"] * (cols - len(row))
+        sheet.append(row[:cols])
+    workbook.save(path)
+
+
+def legacy_xlsx_text(file_contents):
+    # The original full-DOM path, kept here only as the benchmark baseline
+    workbook = openpyxl.load_workbook(ingest.BytesIO(file_contents))
+    sheet = workbook.active
+    excel_info = []
+    for row in sheet.iter_rows(values_only=True):
+        excel_info.append(list(row))
+    return "\n".join([", ".join(map(str, row)) for row in excel_info])
+
+
+def peak_rss_mb():
+    # ru_maxrss is in kilobytes on Linux
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+def _xlsx_rss_child(mode, path):
+    with open(path, 'rb') as f:
+        file_contents = f.read()
+    before = peak_rss_mb()
+    start = time.perf_counter()
+    if mode == 'legacy':
+        text = legacy_xlsx_text(file_contents)
+    else:
+        text = ingest.xlsx_to_text(file_contents)
+    elapsed = time.perf_counter() - start
+    print(f"{before:.1f} {peak_rss_mb():.1f} {elapsed:.3f} {len(text)}")
+
+
+def bench_xlsx_memory(args):
+    print(f"{'rows':>8} {'mode':>10} {'base MB':>9} {'peak MB':>9} {'delta MB':>9} {'seconds':>8}")
+    with tempfile.TemporaryDirectory() as tmp:
+        for rows in args.rows:
+            path = os.path.join(tmp, f"sheet_{rows}.xlsx")
+            make_xlsx(path, rows)
+            for mode in ('legacy', 'streaming'):
+                # Run each mode in a fresh interpreter so peak RSS is not shared
+                out = subprocess.run(
+                    [sys.executable, __file__, '_xlsx_rss', mode, path],
+                    check=True, capture_output=True, text=True
+                ).stdout.split()
+                base, peak, seconds = float(out[0]), float(out[1]), float(out[2])
+                print(f"{rows:>8} {mode:>10} {base:>9.1f} {peak:>9.1f} {peak - base:>9.1f} {seconds:>8.2f}")
+
+
+def make_rows(rows, cols=8):
+    departments = ["Finance", "Engineering", "Sales", "Support", "HR"]
+    yield tuple(f"col_{c}" for c in range(cols))
+    for r in range(rows):
+        row = (r, f"Employee {r}", departments[r % len(departments)], 1000.5 + r, None)
+        yield (row + (f"note {r % 97}",) * (cols - len(row)))[:cols]
+
+
+def bench_format(args):
+    print(f"{'rows':>8} {'legacy s':>9} {'columnar s':>11} {'speedup':>8}")
+    for rows in args.rows:
+        data = list(make_rows(rows))
+        start = time.perf_counter()
+        "\n".join([", ".join(map(str, row)) for row in data])
+        legacy = time.perf_counter() - start
+        start = time.perf_counter()
+        ingest.write_table_text(io.StringIO(), data)
+        columnar = time.perf_counter() - start
+        print(f"{rows:>8} {legacy:>9.3f} {columnar:>11.3f} {legacy / columnar:>7.2f}x")
+
+
+def representative_sheets(rows):
+    # Synthetic stand-ins for the kinds of sheets users upload
+    rng = random.Random(0)
+    departments = ["Finance", "Engineering", "Sales", "Support", "Human Resources", "Legal", "Marketing", "Operations"]
+    titles = ["Analyst", "Senior Analyst", "Manager", "Director", "Engineer", "Senior Engineer", "Associate"]
+    locations = ["New York", "London", "Singapore", "Sydney", "Toronto", "Berlin"]
+    employees = [("Employee ID", "Name", "Department", "Title", "Location", "Salary", "Bonus %", "Start Date", "Manager ID", "Active")]
+    for r in range(rows):
+        employees.append((
+            10000 + r, f"Employee {r}", rng.choice(departments), rng.choice(titles), rng.choice(locations),
+            round(rng.uniform(40000, 250000), 2), rng.uniform(0, 0.3),
+            datetime.datetime(2010, 1, 1) + datetime.timedelta(days=rng.randrange(5000)),
+            10000 + rng.randrange(rows) if rng.random() < 0.7 else None, rng.random() < 0.9,
+        ))
+
+    accounts = [f"{6000 + i} Operating Expense {i}" for i in range(40)]
+    cost_centers = ["CC-100 Corporate", "CC-200 Retail", "CC-300 Wholesale", "CC-400 Online"]
+    ledger = [("Posting Date", "Account", "Cost Center", "Amount", "Currency", "Memo")]
+    for r in range(rows):
+        ledger.append((
+            datetime.date(2024, 1, 1) + datetime.timedelta(days=rng.randrange(365)),
+            rng.choice(accounts), rng.choice(cost_centers), rng.uniform(-5000, 50000),
+            rng.choice(["USD", "EUR", "GBP"]), f"Invoice {rng.randrange(10 ** 6)}" if rng.random() < 0.2 else None,
+        ))
+
+    survey = [tuple(f"Q{q}" for q in range(1, 21))]
+    for r in range(rows):
+        survey.append(tuple(rng.choice(["Agree", "Disagree", "Neutral", "Strongly Agree"]) if rng.random() < 0.3 else None
+                            for _ in range(20)))
+    return {'employees': employees, 'ledger': ledger, 'sparse survey': survey}
+
+
+def bench_encoding(args):
+    print(f"{'sheet':>14} {'encoding':>9} {'bytes':>10} {'est tokens':>11} {'vs legacy':>10}")
+    for name, data in representative_sheets(args.rows).items():
+        legacy = "\n".join([", ".join(map(str, row)) for row in data])
+        baseline = tokens.estimate_tokens(legacy)
+        print(f"{name:>14} {'legacy':>9} {len(legacy.encode()):>10} {baseline:>11} {'':>10}")
+        for encoding in ingest.ENCODERS:
+            buffer = io.StringIO()
+            ingest.write_table_text(buffer, data, encoding=encoding)
+            text = buffer.getvalue()
+            estimate = tokens.estimate_tokens(text)
+            print(f"{name:>14} {encoding:>9} {len(text.encode()):>10} {estimate:>11} {estimate / baseline - 1:>+9.1%}")
+
+
+def make_workbook(path, sheets, rows, cols=8):
+    workbook = openpyxl.Workbook(write_only=True)
+    for s in range(sheets):
+        sheet = workbook.create_sheet(f"Sheet{s + 1}")
+        for row in make_rows(rows, cols):
+            sheet.append(row)
+    workbook.save(path)
+
+
+def bench_sheets(args):
+    print(f"{'sheets':>7} {'rows/sheet':>11} {'list s':>8} {'serial s':>9} {'parallel s':>11} {'speedup':>8}  ({os.cpu_count()} CPUs)")
+    with tempfile.TemporaryDirectory() as tmp:
+        path = os.path.join(tmp, "workbook.xlsx")
+        make_workbook(path, args.sheets, args.rows)
+        with open(path, 'rb') as f:
+            file_contents = f.read()
+        start = time.perf_counter()
+        ingest.list_sheets(file_contents)
+        listing = time.perf_counter() - start
+        start = time.perf_counter()
+        ingest.load_sheets(file_contents, 'all', max_workers=1)
+        serial = time.perf_counter() - start
+        start = time.perf_counter()
+        ingest.load_sheets(file_contents, 'all')
+        parallel = time.perf_counter() - start
+        print(f"{args.sheets:>7} {args.rows:>11} {listing:>8.4f} {serial:>9.2f} {parallel:>11.2f} {serial / parallel:>7.2f}x")
+
+
+def bench_retrieval(args):
+    questions = ["What is the salary of Employee 1234?", "Senior Engineers in London",
+                 "Department: Legal managers hired in 2015", "Who reports to manager 10042?"]
+    print(f"{'rows':>8} {'build s':>8} {'query ms':>9} {'full tokens':>12} {'top-k tokens':>13}")
+    for rows in args.rows:
+        data = representative_sheets(rows)['employees']
+        table = ingest.Table.concat(ingest.iter_tables(data))
+        start = time.perf_counter()
+        index = retrieval.RowIndex(table)
+        build = time.perf_counter() - start
+        start = time.perf_counter()
+        for question in questions:
+            index.search(question)
+        query = (time.perf_counter() - start) / len(questions) * 1000
+        full = tokens.estimate_tokens(table.to_text())
+        context = tokens.estimate_tokens(retrieval.context_text(index, questions[1]))
+        print(f"{rows:>8} {build:>8.2f} {query:>9.2f} {full:>12} {context:>13}")
+
+
+def bench_clients(args):
+    # Client construction cost paid per request before vs after the shared registry.
+    # Connection reuse (TLS handshakes saved) needs a real endpoint and is not measured here.
+    import boto3
+    import clients
+    os.environ.setdefault('AWS_ACCESS_KEY_ID', 'bench')
+    os.environ.setdefault('AWS_SECRET_ACCESS_KEY', 'bench')
+    print(f"{'service':>16} {'boto3.client ms':>16} {'registry ms':>12}")
+    for service in ('bedrock-runtime', 's3'):
+        start = time.perf_counter()
+        for _ in range(args.iterations):
+            boto3.client(service, region_name='us-east-1')
+        fresh = (time.perf_counter() - start) / args.iterations * 1000
+        clients.get_client(service, 'us-east-1')
+        start = time.perf_counter()
+        for _ in range(args.iterations):
+            clients.get_client(service, 'us-east-1')
+        shared = (time.perf_counter() - start) / args.iterations * 1000
+        print(f"{service:>16} {fresh:>16.2f} {shared:>12.4f}")
+
+
+def bench_response_cache(args):
+    # Repeated identical questions against a stub client with a fixed invoke latency
+    import io
+    import json
+    os.environ['RESPONSE_CACHE_DB'] = os.path.join(tempfile.mkdtemp(), 'responses.sqlite3')
+    import responsecache
+
+    class StubClient:
+        def invoke_model(self, modelId, body):
+            time.sleep(args.latency)
+            return {'body': io.BytesIO(json.dumps({'content': [{'type': 'text', 'text': 'answer'}]}).encode())}
+
+    client = StubClient()
+    questions = [f"question {i % args.distinct}" for i in range(args.requests)]
+    start = time.perf_counter()
+    for question in questions:
+        body = json.dumps({"anthropic_version": "bedrock-2023-05-31", "max_tokens": 900, "temperature": 0,
+                           "messages": [{"role": "user", "content": [{"type": "text", "text": question}]}]})
+        responsecache.invoke_model(client, modelId="model", body=body)
+    elapsed = time.perf_counter() - start
+    # A restarted process only has the SQLite tier
+    responsecache._memory.clear()
+    start = time.perf_counter()
+    responsecache.invoke_model(client, modelId="model", body=body)
+    disk = (time.perf_counter() - start) * 1000
+    stats = responsecache.stats()
+    print(f"{args.requests} requests, {args.distinct} distinct: {elapsed:.2f} s "
+          f"(uncached {args.requests * args.latency:.2f} s), hit rate {stats['hit_rate']:.0%}, "
+          f"latency saved {stats['latency_saved']:.2f} s, SQLite hit {disk:.2f} ms")
+
+
+def bench_throttling(args):
+    # A stub model endpoint that throttles above a fixed rate, hammered by concurrent callers:
+    # plain calls (a throttle is a failed request) vs the adaptive limiter with retries
+    import json
+    import threading
+    from concurrent.futures import ThreadPoolExecutor
+    from botocore.exceptions import ClientError
+    import ratelimit
+
+    class ThrottlingClient:
+        def __init__(self):
+            self.lock = threading.Lock()
+            self.level, self.updated = 1.0, time.monotonic()
+
+        def invoke_model(self, modelId, body):
+            with self.lock:
+                now = time.monotonic()
+                self.level = min(2.0, self.level + (now - self.updated) * args.rate)
+                self.updated = now
+                allowed = self.level >= 1
+                if allowed:
+                    self.level -= 1
+            if not allowed:
+                time.sleep(0.005)
+                raise ClientError({'Error': {'Code': 'ThrottlingException', 'Message': 'Too many requests'}},
+                                  'InvokeModel')
+            time.sleep(args.latency)
+            return {'body': json.dumps({'content': []})}
+
+    body = json.dumps({"anthropic_version": "bedrock-2023-05-31", "max_tokens": 10, "messages": []})
+    print(f"{args.workers} workers for {args.seconds:.0f} s, endpoint limit {args.rate}/s")
+    for label, invoke in (("plain calls", lambda c: c.invoke_model(modelId='model', body=body)),
+                          ("rate limiter", lambda c: ratelimit.invoke_model(c, modelId='model', body=body))):
+        client = ThrottlingClient()
+        ratelimit.reset()
+        # Configured well above the endpoint's real limit, so the limiter has to adapt
+        ratelimit.MODEL_LIMITS['model'] = {'rpm': args.rate * 60 * 2, 'tpm': 10 ** 9}
+        stop = time.monotonic() + args.seconds
+        counts = {'succeeded': 0, 'failed': 0}
+        lock = threading.Lock()
+
+        def worker():
+            while time.monotonic() < stop:
+                try:
+                    invoke(client)
+                    outcome = 'succeeded'
+                except ClientError:
+                    outcome = 'failed'
+                with lock:
+                    counts[outcome] += 1
+
+        threads = [threading.Thread(target=worker) for _ in range(args.workers)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        print(f"{label:>14}: {counts['succeeded'] / args.seconds:6.1f} requests/s answered, "
+              f"{counts['failed'] / args.seconds:6.1f} requests/s failed")
+
+
+def bench_tracing(args):
+    # Tracing overhead on the hot path: CSV -> prompt text with and without an active trace
+    import tracing
+    tracing.EXPORT = 'none'
+    data = ("\n".join(", ".join(str(v) for v in row) for row in make_rows(args.rows))).encode()
+
+    def build():
+        return ingest.write_csv_text(io.StringIO(), data)
+
+    # End-to-end times are noisy at this scale; the per-span cost below is the real bound
+    import gc
+    untraced = traced_time = float('inf')
+    for _ in range(args.repeat):
+        gc.collect()
+        start = time.perf_counter()
+        build()
+        untraced = min(untraced, time.perf_counter() - start)
+        gc.collect()
+        start = time.perf_counter()
+        tracing.traced('bench')(build)()
+        traced_time = min(traced_time, time.perf_counter() - start)
+
+    trace = tracing.Trace('bench')
+    start = time.perf_counter()
+    for _ in range(100000):
+        with trace.span('stage'):
+            pass
+    per_span = (time.perf_counter() - start) / 100000
+    spans = len(range(0, args.rows, ingest.CHUNK_ROWS)) * 2 + 1
+    print(f"{args.rows} rows: untraced {untraced * 1000:.1f} ms, traced {traced_time * 1000:.1f} ms "
+          f"({(traced_time / untraced - 1) * 100:+.2f}%); one span {per_span * 1e6:.2f} us, "
+          f"{spans} spans = {spans * per_span / untraced * 100:.3f}% of the request")
+
+
+def bench_codec(args):
+    # Building a request around an N MB image, legacy str path vs codec, including the
+    # response cache key and rate-limit estimate each request also needs
+    import base64
+    import gc
+    import io
+    import json
+    import tracemalloc
+    import codec
+    import ratelimit
+    import responsecache
+
+    def request(content):
+        return {"anthropic_version": "bedrock-2023-05-31", "max_tokens": 1000,
+                "messages": [{"role": "user", "content": [{"type": "text", "text": "What is in this image?"}, content]}]}
+
+    def legacy_encode(image):
+        encoded = base64.b64encode(image).decode('utf-8')
+        return json.dumps(request({"type": "image", "source": {"type": "base64", "media_type": "image/png",
+                                                               "data": encoded}}))
+
+    def legacy(image):
+        body = legacy_encode(image)
+        responsecache.cache_key('model', body)
+        ratelimit.request_tokens(body)
+        return body.encode('utf-8')    # what botocore sends
+
+    def single_pass_encode(image):
+        return codec.encode(request(codec.image_block(image, "image/png")))
+
+    def single_pass(image):
+        body = single_pass_encode(image)
+        responsecache.cache_key('model', body)
+        ratelimit.request_tokens(body)
+        return body.data
+
+    def measure(fn, *fn_args):
+        best = float('inf')
+        for _ in range(args.repeat):
+            gc.collect()
+            start = time.perf_counter()
+            fn(*fn_args)
+            best = min(best, time.perf_counter() - start)
+        tracemalloc.start()
+        fn(*fn_args)
+        peak = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+        return best * 1000, peak / 2 ** 20
+
+    print(f"JSON backend: {codec.BACKEND}")
+    for size in args.image_mb:
+        image = os.urandom(int(size * 2 ** 20))
+        assert json.loads(legacy(image)) == json.loads(single_pass(image))
+        (old_ms, old_mb), (new_ms, new_mb) = measure(legacy_encode, image), measure(single_pass_encode, image)
+        print(f"{size:g} MB image, encode only: legacy {old_ms:.1f} ms, peak {old_mb:.1f} MB; "
+              f"codec {new_ms:.1f} ms, peak {new_mb:.1f} MB ({old_ms / new_ms:.1f}x)")
+        (old_ms, old_mb), (new_ms, new_mb) = measure(legacy, image), measure(single_pass, image)
+        print(f"{size:g} MB image, with cache key and quota estimate: legacy {old_ms:.1f} ms, peak {old_mb:.1f} MB; "
+              f"codec {new_ms:.1f} ms, peak {new_mb:.1f} MB ({old_ms / new_ms:.1f}x)")
+
+    payload = json.dumps({"content": [{"type": "text", "text": "word " * 200000}],
+                          "usage": {"input_tokens": 1, "output_tokens": 200000}}).encode()
+    old_ms, _ = measure(lambda: json.loads(io.BytesIO(payload).read().decode('utf-8')))
+    new_ms, _ = measure(lambda: codec.decode({'body': io.BytesIO(payload)}))
+    print(f"{len(payload) / 2 ** 20:.1f} MB response: read/decode/json.loads {old_ms:.2f} ms, codec.decode {new_ms:.2f} ms")
+
+
+def bench_images(args):
+    # Camera photos and a screenshot: prepare time cold and cached, bytes and tokens before and after
+    from PIL import Image, ImageDraw
+    import images
+
+    def encoded(image, kind, **options):
+        out = io.BytesIO()
+        image.save(out, kind, **options)
+        return out.getvalue()
+
+    samples = []
+    for megapixels in args.megapixels:
+        width = int((megapixels * 1e6 * 4 / 3) ** 0.5)
+        size = (width, width * 3 // 4)
+        gradient = Image.linear_gradient('L').resize(size)
+        photo = Image.merge('RGB', [Image.blend(gradient, Image.effect_noise(size, 40), 0.3) for _ in range(3)])
+        samples.append((f"{megapixels:g} MP photo", encoded(photo, 'JPEG', quality=92)))
+    screenshot = Image.new('RGB', (2560, 1440), 'white')
+    draw = ImageDraw.Draw(screenshot)
+    for y in range(0, 1440, 18):
+        draw.text((10, y), f"row {y}  employee {y * 7}  salary {y * 31}", fill='black')
+    samples.append(("2560x1440 screenshot", encoded(screenshot, 'PNG')))
+
+    for name, data in samples:
+        images.clear()
+        start = time.perf_counter()
+        prepared = images.prepare(data)
+        cold = time.perf_counter() - start
+        start = time.perf_counter()
+        images.prepare(data)
+        cached = time.perf_counter() - start
+        print(f"{name}: {len(data) / 2 ** 20:.2f} MB -> {len(prepared.data) / 2 ** 20:.2f} MB {prepared.media_type} "
+              f"{prepared.width}x{prepared.height}, base64 upload {len(data) * 4 / 3 / 2 ** 20:.2f} -> "
+              f"{len(prepared.data) * 4 / 3 / 2 ** 20:.2f} MB, ~{prepared.original_tokens} -> ~{prepared.tokens} tokens; "
+              f"prepare {cold * 1000:.0f} ms cold, {cached * 1000:.2f} ms cached")
+
+
+def bench_multi_image(args):
+    # N photos from a stub S3 with fixed GET latency: one at a time vs images.load_all
+    from PIL import Image
+    import images
+
+    class StubS3:
+        def __init__(self, objects):
+            self.objects = objects
+
+        def get_object(self, Bucket, Key):
+            time.sleep(args.latency)
+            return {'Body': io.BytesIO(self.objects[Key])}
+
+    objects = {}
+    for n in range(max(args.images)):
+        out = io.BytesIO()
+        Image.new('RGB', (800, 600), (n * 10 % 256, 80, 160)).save(out, 'JPEG')
+        objects[f"photo-{n}.jpg"] = out.getvalue()
+    s3 = StubS3(objects)
+
+    for count in args.images:
+        keys = list(objects)[:count]
+        images.clear()
+        start = time.perf_counter()
+        serial = [images.prepare(s3.get_object(Bucket='b', Key=key)['Body'].read()) for key in keys]
+        serial_time = time.perf_counter() - start
+        images.clear()
+        start = time.perf_counter()
+        concurrent = images.load_all(s3, 'b', keys)
+        concurrent_time = time.perf_counter() - start
+        assert [p.data for p in concurrent] == [p.data for p in serial]
+        print(f"{count} images, {args.latency * 1000:.0f} ms per GET: serial {serial_time * 1000:.0f} ms, "
+              f"concurrent {concurrent_time * 1000:.0f} ms ({serial_time / concurrent_time:.1f}x)")
+
+
+class StubS3Object:
+    # Local S3 stand-in: first-byte latency, then a fixed bandwidth per connection
+    def __init__(self, data, latency, bandwidth):
+        self.data = data
+        self.latency = latency
+        self.bandwidth = bandwidth
+
+    class Body:
+        def __init__(self, data, bandwidth):
+            self.data = memoryview(data)
+            self.bandwidth = bandwidth
+
+        def read(self, amount=None):
+            chunk = self.data[:amount] if amount is not None else self.data
+            self.data = self.data[len(chunk):]
+            time.sleep(len(chunk) / self.bandwidth)
+            return bytes(chunk)
+
+        def close(self):
+            pass
+
+    def get_object(self, Bucket, Key, Range=None, IfMatch=None):
+        time.sleep(self.latency)
+        response = {'ETag': '"stub"', 'ContentLength': len(self.data)}
+        data = self.data
+        if Range:
+            start, end = (int(n) for n in Range[len('bytes='):].split('-'))
+            data = data[start:end + 1]
+            response['ContentRange'] = f"bytes {start}-{end}/{len(self.data)}"
+            response['ContentLength'] = len(data)
+        response['Body'] = self.Body(data, self.bandwidth)
+        return response
+
+
+def bench_s3_read(args):
+    # Download throughput by object size and part count, then CSV parsing fed by each
+    import s3stream
+    bandwidth = args.bandwidth * 2 ** 20
+    for size_mb in args.sizes:
+        data = os.urandom(int(size_mb * 2 ** 20))
+        s3 = StubS3Object(data, args.latency, bandwidth)
+        results = []
+        for parts in args.parts:
+            start = time.perf_counter()
+            if parts == 1:
+                read = s3.get_object(Bucket='b', Key='k')['Body'].read()
+            else:
+                s3_object = s3.get_object(Bucket='b', Key='k')
+                with s3stream.RangedReader(s3, 'b', 'k', len(data), s3_object['ETag'], s3_object['Body'],
+                                           concurrency=parts) as body:
+                    read = body.read()
+            elapsed = time.perf_counter() - start
+            assert read == data
+            results.append(f"{parts} connection{'s' if parts > 1 else ''} {size_mb / elapsed:.0f} MB/s")
+        print(f"{size_mb:g} MB object, {s3stream.PART_BYTES // 2 ** 20} MB parts: " + ", ".join(results))
+
+    data = ("\n".join(", ".join(str(v) for v in row) for row in make_rows(args.csv_rows))).encode()
+    s3 = StubS3Object(data, args.latency, bandwidth)
+    start = time.perf_counter()
+    ingest.load_table(data, 'csv')
+    print(f"CSV {len(data) / 2 ** 20:.0f} MB parsed from memory: {time.perf_counter() - start:.2f} s")
+    for parts in (1, max(args.parts)):
+        start = time.perf_counter()
+        s3_object = s3.get_object(Bucket='b', Key='k')
+        body = s3_object['Body'] if parts == 1 else s3stream.RangedReader(
+            s3, 'b', 'k', len(data), s3_object['ETag'], s3_object['Body'], concurrency=parts)
+        table = ingest.load_table(body, 'csv')
+        body.close()
+        print(f"CSV {len(data) / 2 ** 20:.0f} MB, {table.num_rows} rows, {parts} connection{'s' if parts > 1 else ''}: "
+              f"download + parse {time.perf_counter() - start:.2f} s")
+
+
+def bench_s3_listing(args):
+    # A 100k-object bucket behind a stub paginator: first listing, rerun, prefix narrowing, refresh
+    import bisect
+    import s3listing
+
+    keys = sorted(f"team{n % 50:02d}/report-{n:06d}.{('xlsx', 'csv', 'pdf', 'png')[n % 4]}" for n in range(args.objects))
+
+    class StubS3:
+        def get_paginator(self, name):
+            return self
+
+        def paginate(self, Bucket, Prefix=''):
+            start = bisect.bisect_left(keys, Prefix)
+            while start < len(keys) and keys[start].startswith(Prefix):
+                time.sleep(args.page_latency)
+                page = [key for key in keys[start:start + 1000] if key.startswith(Prefix)]
+                start += 1000
+                yield {'Contents': [{'Key': key} for key in page]}
+
+    s3 = StubS3()
+    steps = [("first listing", '', False), ("rerun", '', False), ("prefix team07/", 'team07/', False),
+             ("prefix team07/report-0001", 'team07/report-0001', False), ("refresh", '', True)]
+    first_page = keys[:1000]
+    print(f"{args.objects} objects; a single list_objects_v2 call would show {len(first_page)} of them")
+    for name, prefix, refresh in steps:
+        start = time.perf_counter()
+        found = s3listing.list_keys(s3, 'bucket', prefix, ('xlsx', 'csv'), refresh=refresh)
+        print(f"{name}: {len(found)} spreadsheets in {(time.perf_counter() - start) * 1000:.2f} ms")
+    print(s3listing.stats())
+
+
+def bench_sidecar(args):
+    # Cold XLSX parse vs loading the Parquet sidecar, whole and projected to two columns
+    import pyarrow.parquet as pq
+    import s3stream
+    import sidecar
+    bandwidth = args.bandwidth * 2 ** 20
+    with tempfile.TemporaryDirectory() as tmp:
+        for rows in args.rows:
+            path = os.path.join(tmp, f"{rows}.xlsx")
+            make_xlsx(path, rows)
+            with open(path, 'rb') as f:
+                xlsx = f.read()
+            start = time.perf_counter()
+            table = ingest.load_table(xlsx, 'xlsx')
+            parse_time = time.perf_counter() - start
+            data = sidecar.to_bytes(table)
+
+            start = time.perf_counter()
+            loaded = sidecar.from_bytes(data)
+            full_time = time.perf_counter() - start
+            assert loaded.names == table.names and loaded.num_rows == table.num_rows
+
+            # Projection through ranged GETs against a local stand-in with S3-like latency
+            s3 = StubS3Object(data, args.latency, bandwidth)
+            source = s3stream.ObjectFile(s3, 'b', 'k', len(data), '"stub"')
+            start = time.perf_counter()
+            projected = sidecar._read(pq.ParquetFile(source), table.names[:2])
+            projected_time = time.perf_counter() - start
+            assert projected.num_rows == table.num_rows
+            print(f"{rows} rows: xlsx {len(xlsx) / 2 ** 20:.1f} MB parsed in {parse_time:.2f} s; "
+                  f"sidecar {len(data) / 2 ** 20:.2f} MB loaded in {full_time * 1000:.0f} ms "
+                  f"({parse_time / full_time:.0f}x); 2 of {len(table.names)} columns over {source.requests} "
+                  f"ranged GETs in {projected_time * 1000:.0f} ms")
+
+
+def bench_app_cache(args):
+    # Work done by one Streamlit rerun after an upload: parsing and checks every time vs appcache lookups
+    import hashlib
+    import pandas as pd
+    import appcache
+
+    class Upload:
+        # Stand-in for Streamlit's UploadedFile
+        def __init__(self, data):
+            self.data = data
+            self.file_id = hashlib.md5(data).hexdigest()
+            self.type = 'text/csv'
+
+        def getvalue(self):
+            return self.data
+
+    def rerun(upload, cached):
+        data = upload.getvalue()
+        if not cached:
+            dataframe = pd.read_csv(io.BytesIO(data))
+            dataframe.filter(regex="(?i)date").columns.tolist()
+            return ingest.load_file_tables(data, upload.type)
+        key = appcache.upload_key(upload)
+        dataframe = appcache.data((key, 'dataframe'), lambda: pd.read_csv(io.BytesIO(data)))
+        appcache.data((key, 'data_quality'),
+                      lambda: dataframe.filter(regex="(?i)date").columns.tolist())
+        return appcache.data((key, 'tables', 'None'), lambda: ingest.load_file_tables(data, upload.type))
+
+    for rows in args.rows:
+        upload = Upload(("\n".join(", ".join(str(v) for v in row) for row in make_rows(rows))).encode())
+        results = []
+        for cached in (False, True):
+            appcache.clear()
+            times = []
+            for _ in range(args.reruns):
+                start = time.perf_counter()
+                rerun(upload, cached)
+                times.append(time.perf_counter() - start)
+            results.append(f"{'appcache' if cached else 'no cache'} first {times[0] * 1000:.0f} ms, "
+                           f"later reruns {sum(times[1:]) / (len(times) - 1) * 1000:.2f} ms")
+        print(f"{rows} rows ({len(upload.data) / 2 ** 20:.1f} MB CSV): " + "; ".join(results))
+    print(appcache.stats())
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Ingestion benchmarks")
+    sub = parser.add_subparsers(dest='name', required=True)
+
+    p = sub.add_parser('xlsx-memory', help="peak RSS of legacy vs streaming XLSX ingestion")
+    p.add_argument('--rows', type=int, nargs='+', default=[10000, 100000])
+    p.set_defaults(func=bench_xlsx_memory)
+
+    p = sub.add_parser('format', help="row-wise str() join vs columnar serializer")
+    p.add_argument('--rows', type=int, nargs='+', default=[10000, 100000, 1000000])
+    p.set_defaults(func=bench_format)
+
+    p = sub.add_parser('encoding', help="prompt bytes and estimated tokens per table encoding")
+    p.add_argument('--rows', type=int, default=5000)
+    p.set_defaults(func=bench_encoding)
+
+    p = sub.add_parser('sheets', help="serial vs process-pool parsing of a multi-sheet workbook")
+    p.add_argument('--sheets', type=int, default=4)
+    p.add_argument('--rows', type=int, default=25000)
+    p.set_defaults(func=bench_sheets)
+
+    p = sub.add_parser('retrieval', help="row index build time, query latency and prompt size")
+    p.add_argument('--rows', type=int, nargs='+', default=[10000, 100000])
+    p.set_defaults(func=bench_retrieval)
+
+    p = sub.add_parser('clients', help="per-request client construction vs the shared registry")
+    p.add_argument('--iterations', type=int, default=50)
+    p.set_defaults(func=bench_clients)
+
+    p = sub.add_parser('response-cache', help="repeated questions with and without the response cache")
+    p.add_argument('--requests', type=int, default=200)
+    p.add_argument('--distinct', type=int, default=20)
+    p.add_argument('--latency', type=float, default=0.05, help="simulated invoke_model seconds")
+    p.set_defaults(func=bench_response_cache)
+
+    p = sub.add_parser('throttling', help="plain calls vs adaptive rate limiting against a throttling stub")
+    p.add_argument('--seconds', type=float, default=10.0)
+    p.add_argument('--workers', type=int, default=16)
+    p.add_argument('--rate', type=float, default=40.0, help="endpoint requests per second")
+    p.add_argument('--latency', type=float, default=0.05)
+    p.set_defaults(func=bench_throttling)
+
+    p = sub.add_parser('tracing', help="overhead of per-stage tracing on prompt building")
+    p.add_argument('--rows', type=int, default=50000)
+    p.add_argument('--repeat', type=int, default=5)
+    p.set_defaults(func=bench_tracing)
+
+    p = sub.add_parser('codec', help="request encoding around large images, legacy vs single pass")
+    p.add_argument('--image-mb', type=float, nargs='+', default=[1, 5, 10])
+    p.add_argument('--repeat', type=int, default=5)
+    p.set_defaults(func=bench_codec)
+
+    p = sub.add_parser('images', help="image preparation: bytes, tokens and time per photo size")
+    p.add_argument('--megapixels', type=float, nargs='+', default=[2, 12, 24])
+    p.set_defaults(func=bench_images)
+
+    p = sub.add_parser('multi-image', help="serial vs concurrent fetch and preparation of N S3 images")
+    p.add_argument('--images', type=int, nargs='+', default=[1, 5, 10, 20])
+    p.add_argument('--latency', type=float, default=0.15)
+    p.set_defaults(func=bench_multi_image)
+
+    p = sub.add_parser('s3-read', help="single-stream vs parallel ranged S3 reads against a local stand-in")
+    p.add_argument('--sizes', type=float, nargs='+', default=[16, 64, 256])
+    p.add_argument('--parts', type=int, nargs='+', default=[1, 4, 8, 16])
+    p.add_argument('--bandwidth', type=float, default=40, help="MB/s per connection")
+    p.add_argument('--latency', type=float, default=0.03, help="seconds to first byte")
+    p.add_argument('--csv-rows', type=int, default=200000)
+    p.set_defaults(func=bench_s3_read)
+
+    p = sub.add_parser('s3-listing', help="paginated, cached S3 listing against a stub bucket")
+    p.add_argument('--objects', type=int, default=100000)
+    p.add_argument('--page-latency', type=float, default=0.05)
+    p.set_defaults(func=bench_s3_listing)
+
+    p = sub.add_parser('sidecar', help="cold XLSX parse vs Parquet sidecar load, full and projected")
+    p.add_argument('--rows', type=int, nargs='+', default=[10000, 100000])
+    p.add_argument('--bandwidth', type=float, default=40, help="MB/s per connection")
+    p.add_argument('--latency', type=float, default=0.03, help="seconds to first byte")
+    p.set_defaults(func=bench_sidecar)
+
+    p = sub.add_parser('app-cache', help="per-rerun parsing in the Streamlit apps, with and without appcache")
+    p.add_argument('--rows', type=int, nargs='+', default=[10000, 100000])
+    p.add_argument('--reruns', type=int, default=10)
+    p.set_defaults(func=bench_app_cache)
+
+    p = sub.add_parser('_xlsx_rss')
+    p.add_argument('mode')
+    p.add_argument('path')
+    p.set_defaults(func=lambda a: _xlsx_rss_child(a.mode, a.path))
+
+    args = parser.parse_args()
+    args.func(args)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,7 +1,15 @@
 import json
-import boto3
-import base64
+import clients
+import codec
+import images
+import ratelimit
+import responsecache
+import router
+import tracing
+import time
 
+@tracing.traced('claude')
+@ratelimit.lambda_deadline
 def lambda_handler(event, context):
     # Extract request body from the event
     request_body = event.get('body', {
@@ -20,50 +28,64 @@ def lambda_handler(event, context):
         ]
     })
 
-    # Create an S3 client
-    s3_client = boto3.client('s3')
+    # Shared S3 client, reused across invocations
+    s3_client = clients.s3()
 
-    # S3 bucket and image key details
-    bucket_name = 'bedrocktest02'
-    image_key = 'testimage.png'
+    # S3 bucket and image keys (event 'image_keys'), plus any inline base64 images (event 'images');
+    # without either, the test image
+    bucket_name = event.get('bucket', 'bedrocktest02')
+    inline_images = event.get('images', [])
+    image_keys = event.get('image_keys', [] if inline_images else ['testimage.png'])
+    if len(image_keys) + len(inline_images) > images.MAX_IMAGES:
+        return {
+            'statusCode': 400,
+            'body': json.dumps({'error': f'At most {images.MAX_IMAGES} images per request'})
+        }
 
     try:
-        # Retrieve the image from S3
-        s3_object = s3_client.get_object(Bucket=bucket_name, Key=image_key)
-        image_data = s3_object['Body'].read()
+        # Retrieve the images from S3 concurrently, downscale them to what the model can use and
+        # re-encode (cached by content)
+        prepared_images = images.load_all(s3_client, bucket_name, image_keys, inline_images)
+        print("Images:", images.stats())
 
-        # Encode the image data to base64
-        encoded_image_data = base64.b64encode(image_data).decode('utf-8')
+        # Add the images to the request body in the order given; their base64 bytes are spliced
+        # into the encoded request as they are
+        request_body["messages"][0]["content"].extend(images.content_blocks(prepared_images))
 
-        # Add image data to the request body
-        request_body["messages"][0]["content"].append({
-            "type": "image",
-            "source": {
-                "type": "base64",
-                "media_type": "image/png",
-                "data": encoded_image_data
-            }
-        })
+        # Encode the request once, straight to the bytes that are sent
+        with tracing.span('encode_request'):
+            body = codec.encode(request_body)
+        tracing.count('request_bytes', len(body))
 
-        # Create a Bedrock runtime client (replace with your region)
-        client = boto3.client('bedrock-runtime', region_name='us-east-1')
+        # Shared Bedrock runtime client, reused across invocations
+        client = clients.bedrock_runtime()
 
-        # Set the model ID for Claude 3 Sonnet
-        model_id = "anthropic.claude-3-sonnet-20240229-v1:0"
+        # Small, simple requests go to a faster model, large or analytical ones to a stronger one; event 'model_id' pins one
+        question = " ".join(block['text'] for block in request_body['messages'][0]['content'] if block['type'] == 'text')
+        route = router.route('image', body.input_tokens, question, event.get('model_id'))
+        model_id = route.model_id
 
-        # Send the request to Bedrock using the 'invoke' API method
-        response = client.invoke_model(
-            modelId=model_id,
-            body=json.dumps(request_body)
-        )
+        # Send the request to Bedrock using the 'invoke' API method; repeated requests are answered from the response cache
+        with tracing.span('bedrock_invoke'):
+            started = time.perf_counter()
+            response = responsecache.invoke_model(
+                client,
+                modelId=model_id,
+                body=body
+            )
+            router.record(route, started, response)
 
-        # Read the content from the StreamingBody
-        response_payload = response['body'].read().decode('utf-8')
-        print("Full Response Payload:", response_payload)
+        # Hit rate and invoke latency saved so far
+        print("Response cache:", response.get('cache'), responsecache.stats())
+        print("Route latency:", router.stats())
 
-        # Parse the payload
-        payload = json.loads(response_payload)
-        generated_text = payload.get('completions', [{}])[0].get('text', '')
+        # Parse the payload straight from the response bytes
+        with tracing.span('decode_response'):
+            completion = codec.decode(response)
+        payload = completion.payload
+        tracing.usage(completion.usage)
+        print("Full Response Payload:", payload)
+        generated_text = completion.text
 
         # Return the generated text
         return {
@@ -72,8 +94,8 @@ def lambda_handler(event, context):
         }
 
     except Exception as e:
-        # Handle any errors that occurred during the process
+        # Handle any errors that occurred during the process; throttling that outlasted the retries is a 429
         return {
-            'statusCode': 500,
+            'statusCode': 429 if ratelimit.is_throttle(e) else 500,
             'body': json.dumps({'error': str(e)})
         }
@@ -0,0 +1,79 @@
+# Shared boto3 clients for the Lambda handlers and the Streamlit apps.
+#
+# Clients are created once per process and reused across warm Lambda invocations
+# and Streamlit reruns, so requests skip client construction, endpoint resolution
+# and (thanks to the pooled keep-alive connections) most TLS handshakes. boto3
+# clients are thread-safe once built; construction goes through one lock and one
+# Session because the default session is not.
+
+import os
+import threading
+
+import boto3
+from botocore.config import Config
+
+MAX_POOL_CONNECTIONS = int(os.environ.get('AWS_MAX_POOL_CONNECTIONS', '50'))
+CONNECT_TIMEOUT = float(os.environ.get('AWS_CONNECT_TIMEOUT', '5'))
+# Long completions can take minutes before the first byte of a non-streaming response
+READ_TIMEOUT = float(os.environ.get('AWS_READ_TIMEOUT', '300'))
+MAX_ATTEMPTS = int(os.environ.get('AWS_MAX_ATTEMPTS', '3'))
+DEFAULT_RETRIES = {'max_attempts': MAX_ATTEMPTS, 'mode': 'standard'}
+
+# Bedrock throttling and transient errors are retried by ratelimit.py, which also adapts the
+# request rate, so botocore must not retry them out of sight first. Callers that do not go
+# through ratelimit (e.g. LangChain's BedrockChat) ask for their own client with
+# retries=DEFAULT_RETRIES.
+SERVICE_CONFIG = {
+    'bedrock-runtime': {'retries': {'total_max_attempts': 1, 'mode': 'standard'}},
+}
+
+_lock = threading.Lock()
+_session = None
+_clients = {}
+
+
+def client_config(**overrides):
+    settings = {
+        'max_pool_connections': MAX_POOL_CONNECTIONS,
+        'connect_timeout': CONNECT_TIMEOUT,
+        'read_timeout': READ_TIMEOUT,
+        'tcp_keepalive': True,
+        'retries': DEFAULT_RETRIES,
+    }
+    settings.update(overrides)
+    return Config(**settings)
+
+
+def get_client(service_name, region_name=None, **config_overrides):
+    # Return the process-wide client for this service, region and config
+    key = (service_name, region_name, tuple(sorted((k, repr(v)) for k, v in config_overrides.items())))
+    client = _clients.get(key)
+    if client is not None:
+        return client
+    global _session
+    with _lock:
+        client = _clients.get(key)
+        if client is None:
+            if _session is None:
+                _session = boto3.session.Session()
+            client = _session.client(service_name, region_name=region_name,
+                                     config=client_config(**{**SERVICE_CONFIG.get(service_name, {}),
+                                                             **config_overrides}))
+            _clients[key] = client
+    return client
+
+
+def bedrock_runtime(region_name='us-east-1', **config_overrides):
+    return get_client('bedrock-runtime', region_name, **config_overrides)
+
+
+def s3(region_name=None, **config_overrides):
+    return get_client('s3', region_name, **config_overrides)
+
+
+def reset():
+    # Drop cached clients (e.g. after credentials change)
+    global _session
+    with _lock:
+        _clients.clear()
+        _session = None
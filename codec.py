@@ -0,0 +1,138 @@
+# Request and response encoding for invoke_model calls.
+#
+# encode() serializes a Messages request once, straight to the UTF-8 bytes that
+# are sent: with orjson when it is installed, otherwise with the json module
+# (JSON_BACKEND picks one explicitly). Images added with image_block() are
+# base64-encoded to bytes once and spliced into the encoded body. Before this
+# they went through str, the JSON escaper and back to bytes again, which meant
+# three more copies of a multi-MB string. The EncodedRequest keeps the request
+# it was built from and its quota estimate, so the response cache and the rate
+# limiter never parse the body back.
+#
+# decode() parses a response body from bytes into a Completion.
+
+import base64
+import json
+import os
+from collections import namedtuple
+
+import tokens
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+BACKEND = os.environ.get('JSON_BACKEND', 'orjson' if orjson is not None else 'json')
+# Claude's input cost for an image at its largest effective size, used when the real size is unknown
+IMAGE_TOKENS = 1600
+
+Completion = namedtuple('Completion', ['payload', 'text', 'usage', 'stop_reason', 'cache'])
+
+
+class Blob:
+    # Base64 data written into the encoded request as a JSON string, without escaping
+    __slots__ = ('data', 'tokens')
+
+    def __init__(self, data, tokens=IMAGE_TOKENS):
+        self.data = data
+        self.tokens = tokens
+
+
+class EncodedRequest:
+    # The bytes to send plus the request they encode; len() is the body size
+    __slots__ = ('data', 'request', '_skeleton', '_blob_tokens', '_input_tokens')
+
+    def __init__(self, data, request, skeleton, blob_tokens):
+        self.data = data
+        self.request = request
+        self._skeleton = skeleton
+        self._blob_tokens = blob_tokens
+        self._input_tokens = None
+
+    def __len__(self):
+        return len(self.data)
+
+    @property
+    def input_tokens(self):
+        # Estimated from the text and JSON structure, with images at their own estimate;
+        # computed on first use, since cache hits never need it
+        if self._input_tokens is None:
+            self._input_tokens = tokens.estimate_tokens(self._skeleton.decode('utf-8')) + self._blob_tokens
+        return self._input_tokens
+
+    @property
+    def tokens(self):
+        # Quota cost, as in ratelimit.request_tokens: input plus the reserved max_tokens
+        return self.input_tokens + self.request.get('max_tokens', 0)
+
+
+def dumps(value, default=None):
+    if BACKEND == 'orjson':
+        return orjson.dumps(value, default=default)
+    return json.dumps(value, ensure_ascii=False, separators=(',', ':'), default=default).encode('utf-8')
+
+
+def loads(data):
+    # bytes in, no decode() first: both backends read UTF-8 directly
+    return orjson.loads(data) if BACKEND == 'orjson' else json.loads(data)
+
+
+def image_block(image, media_type, image_tokens=IMAGE_TOKENS):
+    # Messages image block. Raw bytes are base64-encoded here; a str is taken as base64 already.
+    data = image.encode('ascii') if isinstance(image, str) else base64.b64encode(image)
+    return {
+        "type": "image",
+        "source": {
+            "type": "base64",
+            "media_type": media_type,
+            "data": Blob(data, image_tokens)
+        }
+    }
+
+
+def encode(request):
+    # Serialize with a placeholder for each Blob, then splice the base64 bytes into the placeholders' quotes
+    blobs = []
+    marker = f"blob-{os.urandom(8).hex()}-"
+
+    def placeholder(value):
+        if isinstance(value, Blob):
+            blobs.append(value)
+            return f"{marker}{len(blobs) - 1}"
+        raise TypeError(f"Object of type {type(value).__name__} is not JSON serializable")
+
+    skeleton = dumps(request, default=placeholder)
+    if not blobs:
+        return EncodedRequest(skeleton, request, skeleton, 0)
+
+    view = memoryview(skeleton)
+    parts = []
+    start = 0
+    for index, blob in enumerate(blobs):
+        # Blobs are serialized in document order, so each placeholder follows the previous one
+        at = skeleton.index(f'"{marker}{index}"'.encode('ascii'), start) + 1
+        parts.append(view[start:at])
+        parts.append(blob.data)
+        start = at + len(marker) + len(str(index))
+    parts.append(view[start:])
+    return EncodedRequest(b"".join(parts), request, skeleton, sum(blob.tokens for blob in blobs))
+
+
+def body_bytes(body):
+    # What goes on the wire for any body invoke_model accepts
+    return body.data if isinstance(body, EncodedRequest) else body
+
+
+def response_text(payload):
+    # Messages content blocks, or the legacy text-completions shape
+    if 'content' in payload:
+        return "".join(part.get('text', '') for part in payload['content'])
+    return payload.get('completions', [{}])[0].get('text', '')
+
+
+def decode(response):
+    # Parse an invoke_model response (or a response cache answer) straight from its body bytes
+    payload = loads(response['body'].read())
+    return Completion(payload, response_text(payload), payload.get('usage', {}),
+                      payload.get('stop_reason'), response.get('cache'))
@@ -0,0 +1,269 @@
+# Image preparation before base64 encoding.
+#
+# Claude downscales any image whose long edge is over 1568 px or whose area is
+# over about 1.15 megapixels, and charges roughly width * height / 750 input
+# tokens for what is left. Anything larger is uploaded for nothing. prepare()
+# detects the real media type from the file's magic bytes, applies the EXIF
+# orientation, downscales to IMAGE_MAX_EDGE / IMAGE_MAX_PIXELS (the model's
+# limits by default; lower them to trade detail for tokens) and re-encodes:
+# PNG and GIF sources (screenshots, diagrams) stay PNG while that fits in
+# IMAGE_TARGET_BYTES, transparent ones always, and everything else becomes JPEG
+# at the highest quality that fits. An image that is already within the limits
+# and in a format Claude reads (PNG, JPEG, GIF, WebP, checked from its bytes) is
+# sent as it is; any other format Pillow can open (BMP, TIFF, ...) is converted.
+#
+# Results are cached by content hash (IMAGE_CACHE_BYTES of prepared images), and
+# stats() reports the bytes and estimated tokens saved. Without Pillow, only
+# images in a format Claude reads are accepted, and they are passed through.
+#
+# load_all() fetches several S3 images and decodes inline base64 ones on a
+# bounded thread pool (IMAGE_FETCH_CONCURRENCY), so N images take about as long
+# as the slowest one, and content_blocks() turns them into message content in
+# the order they were given.
+
+import base64
+import contextvars
+import functools
+import hashlib
+import io
+import logging
+import math
+import os
+import threading
+from collections import OrderedDict, namedtuple
+from concurrent.futures import ThreadPoolExecutor
+
+import codec
+import tracing
+
+try:
+    from PIL import Image, ImageOps
+    DECODE_ERRORS = (OSError, ValueError, Image.DecompressionBombError)
+except ImportError:
+    Image = None
+    DECODE_ERRORS = (OSError, ValueError)
+
+# What the model itself keeps of an image
+MODEL_MAX_EDGE = 1568
+MODEL_MAX_PIXELS = 1150000
+PIXELS_PER_TOKEN = 750
+
+MAX_EDGE = int(os.environ.get('IMAGE_MAX_EDGE', str(MODEL_MAX_EDGE)))
+MAX_PIXELS = int(os.environ.get('IMAGE_MAX_PIXELS', str(MODEL_MAX_PIXELS)))
+TARGET_BYTES = int(os.environ.get('IMAGE_TARGET_BYTES', str(1024 * 1024)))
+CACHE_BYTES = int(os.environ.get('IMAGE_CACHE_BYTES', str(64 * 1024 * 1024)))
+MAX_IMAGES = 20           # images Claude accepts in one Bedrock request
+# One wave for a full request by default; well within the S3 client's connection pool
+FETCH_CONCURRENCY = int(os.environ.get('IMAGE_FETCH_CONCURRENCY', str(MAX_IMAGES)))
+JPEG_QUALITIES = (85, 75, 65, 50)
+LOSSLESS_FORMATS = ('PNG', 'GIF')
+
+SIGNATURES = (
+    (b'\x89PNG\r\n\x1a\n', 'image/png'),
+    (b'\xff\xd8\xff', 'image/jpeg'),
+    (b'GIF87a', 'image/gif'),
+    (b'GIF89a', 'image/gif'),
+)
+
+PreparedImage = namedtuple('PreparedImage', ['data', 'media_type', 'width', 'height', 'tokens',
+                                             'original_bytes', 'original_tokens'])
+
+_lock = threading.Lock()
+_cache = OrderedDict()    # content hash -> PreparedImage
+_cache_bytes = 0
+_stats = {
+    'images': 0,
+    'cache_hits': 0,
+    'reencoded': 0,
+    'bytes_in': 0,
+    'bytes_out': 0,
+    'tokens_saved': 0,
+}
+
+
+def media_type(data):
+    # Media type from the file's magic bytes, or None when it is not a format Claude reads
+    for signature, kind in SIGNATURES:
+        if data.startswith(signature):
+            return kind
+    if data[:4] == b'RIFF' and data[8:12] == b'WEBP':
+        return 'image/webp'
+    return None
+
+
+def estimate_tokens(width, height, max_edge=MODEL_MAX_EDGE, max_pixels=MODEL_MAX_PIXELS):
+    # Input tokens for an image of this size, after the model's own downscaling
+    width, height = fit(width, height, max_edge, max_pixels)
+    return math.ceil(width * height / PIXELS_PER_TOKEN)
+
+
+def fit(width, height, max_edge=MAX_EDGE, max_pixels=MAX_PIXELS):
+    # Largest size with the same aspect ratio inside both limits
+    scale = min(1.0, max_edge / max(width, height), math.sqrt(max_pixels / (width * height)))
+    if scale >= 1.0:
+        return width, height
+    return max(1, int(width * scale)), max(1, int(height * scale))
+
+
+def stats():
+    with _lock:
+        result = dict(_stats)
+        result['cache_entries'] = len(_cache)
+    result['bytes_saved'] = result['bytes_in'] - result['bytes_out']
+    return result
+
+
+def clear():
+    global _cache_bytes
+    with _lock:
+        _cache.clear()
+        _cache_bytes = 0
+        for name in _stats:
+            _stats[name] = 0
+
+
+def _record(prepared, hit):
+    with _lock:
+        _stats['images'] += 1
+        _stats['cache_hits'] += hit
+        _stats['reencoded'] += not hit and len(prepared.data) != prepared.original_bytes
+        _stats['bytes_in'] += prepared.original_bytes
+        _stats['bytes_out'] += len(prepared.data)
+        _stats['tokens_saved'] += prepared.original_tokens - prepared.tokens
+    tracing.count('image_bytes_saved', prepared.original_bytes - len(prepared.data))
+
+
+def _cache_put(key, prepared):
+    global _cache_bytes
+    with _lock:
+        if key in _cache:
+            return
+        _cache[key] = prepared
+        _cache_bytes += len(prepared.data)
+        while _cache_bytes > CACHE_BYTES and _cache:
+            _cache_bytes -= len(_cache.popitem(last=False)[1].data)
+
+
+def _has_alpha(image):
+    return image.mode in ('RGBA', 'LA', 'PA') or (image.mode == 'P' and 'transparency' in image.info)
+
+
+def _encode(image, source_format):
+    # PNG for transparency and lossless sources, else the best JPEG quality within TARGET_BYTES
+    if _has_alpha(image) or source_format in LOSSLESS_FORMATS:
+        out = io.BytesIO()
+        image.save(out, 'PNG', optimize=True)
+        # JPEG cannot keep transparency, so a transparent image stays PNG whatever its size
+        if out.tell() <= TARGET_BYTES or _has_alpha(image):
+            return out.getvalue(), 'image/png'
+    rgb = image.convert('RGB')
+    for quality in JPEG_QUALITIES:
+        out = io.BytesIO()
+        rgb.save(out, 'JPEG', quality=quality, optimize=True)
+        if out.tell() <= TARGET_BYTES:
+            break
+    return out.getvalue(), 'image/jpeg'
+
+
+def _prepare(data):
+    # Only bytes recognised as a format Claude reads may be sent as they are
+    kind = media_type(data)
+    if Image is None:
+        if kind is None:
+            raise ValueError("Unsupported image format (install Pillow to convert it)")
+        return PreparedImage(data, kind, None, None, codec.IMAGE_TOKENS, len(data), codec.IMAGE_TOKENS)
+    image = Image.open(io.BytesIO(data))
+    width, height = image.size
+    original_tokens = estimate_tokens(width, height)
+    orientation = image.getexif().get(0x0112, 1)    # rotated photos must be re-encoded upright
+    size = fit(*((height, width) if orientation in (5, 6, 7, 8) else (width, height)))
+    if kind and size == (width, height) and orientation == 1 and len(data) <= TARGET_BYTES:
+        return PreparedImage(data, kind, width, height, original_tokens, len(data), original_tokens)
+
+    source_format = image.format
+    if source_format == 'JPEG':
+        # Decode at the nearest power-of-two reduction above the target size (much faster)
+        image.draft('RGB', size if orientation not in (5, 6, 7, 8) else size[::-1])
+    image.seek(0)                                   # first frame of an animated GIF or WebP
+    image = ImageOps.exif_transpose(image)
+    if image.mode not in ('RGB', 'RGBA', 'L', 'LA', 'P'):
+        image = image.convert('RGBA' if _has_alpha(image) else 'RGB')
+    if image.size != size:
+        if image.mode == 'P':
+            image = image.convert('RGBA' if _has_alpha(image) else 'RGB')
+        image = image.resize(size, Image.LANCZOS)
+    encoded, kind = _encode(image, source_format)
+    width, height = image.size
+    return PreparedImage(encoded, kind, width, height, estimate_tokens(width, height), len(data), original_tokens)
+
+
+def prepare(data):
+    # PreparedImage for these image bytes; ValueError when they are no image Claude can be sent
+    key = hashlib.sha256(data).hexdigest()
+    with _lock:
+        prepared = _cache.get(key)
+        if prepared is not None:
+            _cache.move_to_end(key)
+    if prepared is not None:
+        _record(prepared, True)
+        return prepared
+    with tracing.span('image_prepare'):
+        try:
+            prepared = _prepare(data)
+        except DECODE_ERRORS as e:
+            kind = media_type(data)
+            if kind is None:
+                raise ValueError(f"Unsupported or unreadable image ({len(data)} bytes): {e}") from e
+            # A format Claude reads that Pillow cannot decode: send it as it is and let the model report it
+            logging.warning(f"Image left as is ({len(data)} bytes): {e}")
+            prepared = PreparedImage(data, kind, None, None, codec.IMAGE_TOKENS, len(data), codec.IMAGE_TOKENS)
+    _cache_put(key, prepared)
+    _record(prepared, False)
+    logging.debug(f"Image {prepared.original_bytes} -> {len(prepared.data)} bytes, "
+                  f"{prepared.original_tokens} -> {prepared.tokens} tokens ({prepared.media_type})")
+    return prepared
+
+
+def image_block(data):
+    # codec.image_block for prepared image bytes, with the image's own token estimate
+    prepared = prepare(data)
+    return codec.image_block(prepared.data, prepared.media_type, prepared.tokens)
+
+
+def _load_s3(s3_client, bucket, key):
+    with tracing.span('s3_get'):
+        data = s3_client.get_object(Bucket=bucket, Key=key)['Body'].read()
+    tracing.count('s3_bytes', len(data))
+    return prepare(data)
+
+
+def _load_inline(data):
+    return prepare(base64.b64decode(data))
+
+
+def load_all(s3_client=None, bucket=None, keys=(), inline=(), concurrency=FETCH_CONCURRENCY):
+    # PreparedImages for S3 keys, then inline base64 images, in the order given; fetched,
+    # decoded and prepared concurrently
+    tasks = [functools.partial(_load_s3, s3_client, bucket, key) for key in keys]
+    tasks += [functools.partial(_load_inline, data) for data in inline]
+    if len(tasks) > MAX_IMAGES:
+        raise ValueError(f"{len(tasks)} images given, at most {MAX_IMAGES} fit in one request")
+    if len(tasks) <= 1:
+        return [task() for task in tasks]
+    with ThreadPoolExecutor(max_workers=max(1, min(concurrency, len(tasks)))) as pool:
+        # Each task runs in a copy of the caller's context so its trace and deadline apply
+        futures = [pool.submit(contextvars.copy_context().run, task) for task in tasks]
+        return [future.result() for future in futures]
+
+
+def content_blocks(prepared_images):
+    # Message content for the images; several are labelled "Image 1:", "Image 2:", ... so the
+    # question can refer to them
+    if len(prepared_images) == 1:
+        prepared = prepared_images[0]
+        return [codec.image_block(prepared.data, prepared.media_type, prepared.tokens)]
+    blocks = []
+    for number, prepared in enumerate(prepared_images, 1):
+        blocks.append({"type": "text", "text": f"Image {number}:"})
+        blocks.append(codec.image_block(prepared.data, prepared.media_type, prepared.tokens))
+    return blocks
@@ -1,10 +1,27 @@
 import json
-import boto3
+import clients
+import codec
+import images
+import ratelimit
+import responsecache
+import router
+import tracing
+import time
 
+@tracing.traced('image_prompt')
+@ratelimit.lambda_deadline
 def lambda_handler(event, context):
-    # Extract user prompt and (optional) image data from the event object
+    # Extract user prompt and (optional) image data from the event object: 'image_data' is one base64
+    # image or a list of them, 'image_keys' are S3 keys in 'bucket'
     user_prompt = event.get('prompt', None)
     image_data = event.get('image_data', None)
+    inline_images = image_data if isinstance(image_data, list) else [image_data] if image_data else []
+    image_keys = event.get('image_keys', [])
+    if len(image_keys) + len(inline_images) > images.MAX_IMAGES:
+        return {
+            'statusCode': 400,
+            'body': json.dumps({'error': f'At most {images.MAX_IMAGES} images per request'})
+        }
 
     # Construct the request body for Bedrock API
     request_body = {
@@ -23,31 +40,41 @@ def lambda_handler(event, context):
         ]
     }
 
-    # If image data is provided, include it in the request
-    if image_data:
-        request_body["messages"][0]["content"].append({
-            "type": "image",
-            "source": {
-                "type": "base64",
-                "media_type": "image/jpeg",
-                "data": image_data
-            }
-        })
+    # If images are provided, include them in the order given, fetched and decoded concurrently,
+    # with their real media types detected and downscaled to what the model can use
+    if image_keys or inline_images:
+        s3_client = clients.s3() if image_keys else None
+        prepared_images = images.load_all(s3_client, event.get('bucket', 'bedrocktest02'), image_keys, inline_images)
+        request_body["messages"][0]["content"].extend(images.content_blocks(prepared_images))
+        print("Images:", images.stats())
+
+    # Encode the request once, straight to the bytes that are sent
+    with tracing.span('encode_request'):
+        body = codec.encode(request_body)
+    tracing.count('request_bytes', len(body))
 
-    # Create a Bedrock runtime client (replace with your region)
-    client = boto3.client('bedrock-runtime', region_name='us-east-1')
+    # Shared Bedrock runtime client, reused across invocations
+    client = clients.bedrock_runtime()
 
-    # Set the model ID for Claude 3.5 Sonnet
-    model_id = "anthropic.claude-3-5-sonnet-20240620-v1:0"
+    # Small, simple requests go to a faster model, large or analytical ones to a stronger one; event 'model_id' pins one
+    route = router.route('image' if image_keys or inline_images else 'chat', body.input_tokens, user_prompt or '', event.get('model_id'))
+    model_id = route.model_id
 
-    # Send the request to Bedrock using the 'invoke' API method
-    response = client.invoke_model(
-        modelId=model_id,
-        body=json.dumps(request_body)
-    )
+    # Send the request to Bedrock using the 'invoke' API method; repeated requests are answered from the response cache
+    with tracing.span('bedrock_invoke'):
+        started = time.perf_counter()
+        response = responsecache.invoke_model(
+            client,
+            modelId=model_id,
+            body=body
+        )
+        router.record(route, started, response)
 
-    # Extract the generated response from the payload
-    generated_text = response['payload'].get('completions', [{}])[0].get('text', '')
+    # Parse the payload straight from the response bytes and extract the generated text
+    with tracing.span('decode_response'):
+        completion = codec.decode(response)
+    tracing.usage(completion.usage)
+    generated_text = completion.text
 
     # Return the generated text
     return {
@@ -0,0 +1,546 @@
+# Shared spreadsheet ingestion used by the Lambda handlers and the Streamlit apps.
+#
+# Workbooks are opened in openpyxl's read-only mode and rows are collected into
+# small columnar chunks (one NumPy array per column plus a null mask). Each chunk
+# is formatted column-wise and written straight into the prompt buffer, so peak
+# memory stays proportional to one chunk instead of the whole sheet.
+
+import codecs
+import csv
+import io
+import itertools
+import logging
+import os
+import sys
+import zipfile
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from io import BytesIO
+from xml.etree import ElementTree
+
+import numpy as np
+import openpyxl
+
+import tracing
+
+# Filetype strings we treat as Excel workbooks (extension or the tail of a MIME type)
+XLSX_TYPES = ['xlsx', 'xls', "vnd.openxmlformats-officedocument.spreadsheetml.sheet"]
+CSV_TYPES = ['csv']
+
+SPREADSHEET_NS = "http://schemas.openxmlformats.org/spreadsheetml/2006/main"
+
+# Workbooks smaller than this parse their sheets serially; a process pool costs more than it saves
+PARALLEL_MIN_BYTES = 1024 * 1024
+
+# Rows per columnar chunk when streaming a sheet into the prompt
+CHUNK_ROWS = 4096
+
+# Bytes read up front to detect the encoding and dialect of a CSV file
+CSV_SAMPLE_BYTES = 64 * 1024
+CSV_DELIMITERS = ",;\t|"
+
+# Separator between cells of a row in the prompt text
+CELL_SEPARATOR = ", "
+
+# Prompt table encoding used when a caller does not pick one ('plain' or 'compact')
+DEFAULT_ENCODING = os.environ.get('PROMPT_TABLE_ENCODING', 'plain')
+
+# Compact encoding: decimals kept for floats, and when a text column is dictionary encoded
+FLOAT_DIGITS = 2
+DICTIONARY_MAX_VALUES = 64
+DICTIONARY_MIN_LENGTH = 4
+MIDNIGHT = " 00:00:00"
+COMPACT_PREAMBLE = "(tab separated; coded columns use the '# column: code=value' legends)\n"
+
+
+def is_xlsx(filetype):
+    return bool(filetype) and filetype.lower().split('/')[-1] in XLSX_TYPES
+
+
+def is_csv(filetype):
+    return bool(filetype) and filetype.lower().split('/')[-1] in CSV_TYPES
+
+
+class Column:
+    # kind is one of 'int', 'float', 'bool' or 'str'; mask is True where the cell is empty. text, when
+    # set, holds the source text of a number column whose cells would not format back the same
+    # (e.g. "1000.50", "1e3", "007"), so prompts show the cells as they were written
+    text = None
+
+    def __init__(self, kind, values, mask, text=None):
+        self.kind = kind
+        self.values = values
+        self.mask = mask
+        self.text = text
+
+    def __len__(self):
+        return len(self.values)
+
+    @property
+    def nbytes(self):
+        # Memory held by the arrays, including the str objects of a text column
+        size = self.values.nbytes + self.mask.nbytes
+        if self.values.dtype == object:
+            size += sum(map(sys.getsizeof, self.values))
+        if self.text is not None:
+            size += self.text.nbytes + sum(map(sys.getsizeof, self.text))
+        return size
+
+    def take(self, index):
+        # The rows picked by index (a slice or an index array) as a new column
+        return Column(self.kind, self.values[index], self.mask[index],
+                      None if self.text is None else self.text[index])
+
+    @classmethod
+    def from_cells(cls, cells):
+        cells = np.array(cells, dtype=object)
+        mask = np.equal(cells, None) | np.equal(cells, '')
+        present = cells[~mask]
+        kinds = set(map(type, present))
+
+        if kinds and kinds <= {bool}:
+            values = np.zeros(len(cells), dtype=bool)
+            values[~mask] = present.astype(bool)
+            return cls('bool', values, mask)
+
+        if kinds and kinds <= {int, float}:
+            kind = 'int' if kinds == {int} else 'float'
+            try:
+                values = np.zeros(len(cells), dtype=np.int64 if kind == 'int' else np.float64)
+                values[~mask] = present.astype(values.dtype)
+                return cls(kind, values, mask)
+            except OverflowError:
+                pass
+
+        if kinds == {str}:
+            # CSV cells arrive as text; a column that parses as numbers is numeric, and keeps its
+            # source text when any cell would format differently
+            for kind, dtype in (('int', np.int64), ('float', np.float64)):
+                try:
+                    parsed = present.astype(dtype)
+                except (ValueError, OverflowError):
+                    continue
+                values = np.zeros(len(cells), dtype=dtype)
+                values[~mask] = parsed
+                text = None
+                if not np.array_equal(parsed.astype(str), present.astype(str)):
+                    text = np.full(len(cells), '', dtype=object)
+                    text[~mask] = present
+                return cls(kind, values, mask, text)
+
+        # Text columns stay as object arrays of str so formatting them is free
+        cells[mask] = ''
+        if kinds - {str}:
+            cells = np.array(list(map(str, cells)), dtype=object)
+        return cls('str', cells, mask)
+
+    def format(self):
+        # Vectorized conversion of the whole column to text, empty cells become ''
+        if self.kind == 'str':
+            return self.values
+        if self.text is not None:
+            return self.text
+        if self.kind == 'bool':
+            text = np.where(self.values, 'True', 'False').astype(object)
+        else:
+            text = self.values.astype(str).astype(object)
+        if self.mask.any():
+            text[self.mask] = ''
+        return text
+
+    @classmethod
+    def concat(cls, columns):
+        kinds = {column.kind for column in columns}
+        mask = np.concatenate([column.mask for column in columns])
+        text = None
+        if kinds <= {'int', 'float'} and any(column.text is not None for column in columns):
+            text = np.concatenate([column.format() for column in columns])
+        if len(kinds) == 1:
+            kind = kinds.pop()
+            return cls(kind, np.concatenate([column.values for column in columns]), mask, text)
+        if kinds <= {'int', 'float'}:
+            return cls('float', np.concatenate([column.values.astype(np.float64) for column in columns]), mask, text)
+        return cls('str', np.concatenate([column.format() for column in columns]), mask)
+
+
+class Table:
+    def __init__(self, names, columns):
+        self.names = names
+        self.columns = columns
+
+    @property
+    def num_rows(self):
+        return len(self.columns[0]) if self.columns else 0
+
+    @property
+    def nbytes(self):
+        return sum(column.nbytes for column in self.columns)
+
+    @classmethod
+    def from_rows(cls, names, rows):
+        widths = set(map(len, rows))
+        width = max(widths | {len(names)})
+        names = list(names) + [''] * (width - len(names))
+        if widths and widths != {width}:
+            # Pad ragged rows so every column has one cell per row
+            rows = [tuple(row) + (None,) * (width - len(row)) for row in rows]
+        columns = [Column.from_cells(cells) for cells in zip(*rows)]
+        if not columns:
+            columns = [Column('str', np.array([], dtype=object), np.array([], dtype=bool)) for _ in names]
+        return cls(names, columns)
+
+    @classmethod
+    def concat(cls, tables):
+        tables = list(tables)
+        width = max(len(table.columns) for table in tables)
+        names = max((table.names for table in tables), key=len)
+        columns = []
+        for i in range(width):
+            parts = []
+            for table in tables:
+                if i < len(table.columns):
+                    parts.append(table.columns[i])
+                else:
+                    parts.append(Column('str', np.full(table.num_rows, '', dtype=object), np.ones(table.num_rows, dtype=bool)))
+            columns.append(Column.concat(parts))
+        return cls(names, columns)
+
+    def header_line(self):
+        return CELL_SEPARATOR.join('' if name is None else str(name) for name in self.names)
+
+    def lines(self):
+        # Format each column in one vectorized pass, then join the cells of each row
+        formatted = [column.format().tolist() for column in self.columns]
+        return map(CELL_SEPARATOR.join, zip(*formatted))
+
+    def write_text(self, buffer, header=True):
+        if header:
+            buffer.write(self.header_line())
+        if self.num_rows:
+            if header:
+                buffer.write("\n")
+            buffer.write("\n".join(self.lines()))
+
+    def to_text(self, header=True):
+        buffer = io.StringIO()
+        self.write_text(buffer, header)
+        return buffer.getvalue()
+
+    def slice(self, start, stop):
+        # Rows [start, stop) as a new table sharing the column arrays
+        return Table(self.names, [column.take(slice(start, stop)) for column in self.columns])
+
+    def select(self, names):
+        # The named columns, in the given order, as a new table sharing the column arrays
+        positions = [self.names.index(name) for name in names]
+        return Table([self.names[i] for i in positions], [self.columns[i] for i in positions])
+
+    def take(self, indices):
+        # The given rows, in the given order, as a new table
+        return Table(self.names, [column.take(indices) for column in self.columns])
+
+
+def list_sheets(file_contents):
+    # Sheet names straight from xl/workbook.xml, without loading shared strings or any sheet
+    with zipfile.ZipFile(BytesIO(file_contents)) as archive:
+        root = ElementTree.fromstring(archive.read('xl/workbook.xml'))
+    return [sheet.get('name') for sheet in root.iter(f"{{{SPREADSHEET_NS}}}sheet")]
+
+
+def iter_xlsx_rows(file_contents, sheet_name=None):
+    # Open the workbook in read-only mode so cells are parsed lazily as we iterate
+    workbook = openpyxl.load_workbook(BytesIO(file_contents), read_only=True)
+    try:
+        sheet = workbook[sheet_name] if sheet_name else workbook.active
+        for row in sheet.iter_rows(values_only=True):
+            yield row
+    finally:
+        # Read-only workbooks keep the zip archive open until closed
+        workbook.close()
+
+
+def _select_sheets(file_contents, sheets):
+    # sheets is None (active sheet only), 'all', or a list of names
+    if sheets is None:
+        return None
+    names = list_sheets(file_contents)
+    if sheets == 'all':
+        return names
+    missing = [name for name in sheets if name not in names]
+    if missing:
+        raise ValueError(f"Sheets not found in workbook: {', '.join(missing)}")
+    return list(sheets)
+
+
+def _load_sheet(args):
+    # Process pool worker: parse one sheet into a table
+    file_contents, sheet_name = args
+    tables = list(iter_tables(iter_xlsx_rows(file_contents, sheet_name)))
+    if not tables:
+        return sheet_name, Table([], [])
+    return sheet_name, tables[0] if len(tables) == 1 else Table.concat(tables)
+
+
+def load_sheets(file_contents, sheets='all', max_workers=None):
+    # Parse the selected sheets, in a process pool when the workbook is large enough to pay off
+    names = _select_sheets(file_contents, sheets) or [None]
+    jobs = [(file_contents, name) for name in names]
+    workers = min(len(jobs), max_workers or os.cpu_count() or 1)
+    if workers > 1 and len(file_contents) >= PARALLEL_MIN_BYTES:
+        try:
+            with ProcessPoolExecutor(max_workers=workers) as pool:
+                return dict(pool.map(_load_sheet, jobs))
+        except (OSError, BrokenProcessPool) as e:
+            # AWS Lambda has no /dev/shm, so process pools cannot start there
+            logging.debug(f"Parsing sheets serially, process pool unavailable: {e}")
+    return dict(map(_load_sheet, jobs))
+
+
+class _PrefixedReader(io.RawIOBase):
+    # Raw byte stream that replays an already-read prefix before the rest of the source
+    def __init__(self, prefix, source):
+        self.prefix = memoryview(prefix)
+        self.source = source
+
+    def readable(self):
+        return True
+
+    def readinto(self, buffer):
+        if self.prefix:
+            n = min(len(buffer), len(self.prefix))
+            buffer[:n] = self.prefix[:n]
+            self.prefix = self.prefix[n:]
+            return n
+        data = self.source.read(len(buffer))
+        buffer[:len(data)] = data
+        return len(data)
+
+
+def _detect_encoding(sample):
+    # BOMs first, then UTF-8 if the sample decodes cleanly, else the Windows code page Excel uses
+    for bom, encoding in ((codecs.BOM_UTF8, 'utf-8-sig'),
+                          (codecs.BOM_UTF16_LE, 'utf-16'),
+                          (codecs.BOM_UTF16_BE, 'utf-16')):
+        if sample.startswith(bom):
+            return encoding
+    try:
+        # final=False tolerates a multi-byte character split at the end of the sample
+        codecs.getincrementaldecoder('utf-8')().decode(sample, final=False)
+        return 'utf-8'
+    except UnicodeDecodeError:
+        return 'cp1252'
+
+
+def _sniff_dialect(text):
+    # Only sniff whole lines so a truncated last line does not confuse the sniffer
+    text = text[:text.rfind('\n') + 1] or text
+    try:
+        return csv.Sniffer().sniff(text, delimiters=CSV_DELIMITERS)
+    except csv.Error:
+        return csv.excel
+
+
+def iter_csv_rows(source, encoding=None):
+    # Decode incrementally from bytes or a binary stream (e.g. an S3 StreamingBody)
+    if isinstance(source, (bytes, bytearray, memoryview)):
+        source = BytesIO(source)
+    sample = source.read(CSV_SAMPLE_BYTES)
+    encoding = encoding or _detect_encoding(sample)
+    text = io.TextIOWrapper(
+        io.BufferedReader(_PrefixedReader(sample, source), CSV_SAMPLE_BYTES),
+        encoding=encoding, errors='replace', newline=''
+    )
+    dialect = _sniff_dialect(sample.decode(encoding, errors='ignore'))
+    yield from csv.reader(text, dialect)
+
+
+def iter_tables(rows, chunk_rows=CHUNK_ROWS):
+    # The first row is the header; the rest are grouped into columnar chunks
+    rows = iter(rows)
+    names = next(rows, None)
+    if names is None:
+        return
+    chunk = list(itertools.islice(rows, chunk_rows))
+    yield Table.from_rows(names, chunk)
+    while len(chunk) == chunk_rows:
+        chunk = list(itertools.islice(rows, chunk_rows))
+        if chunk:
+            yield Table.from_rows(names, chunk)
+
+
+class PlainEncoder:
+    # Today's prompt layout: header row then one ", " separated line per row (no preamble)
+    def __init__(self, preamble=True):
+        self.started = False
+
+    def write(self, buffer, table):
+        if self.started:
+            if table.num_rows:
+                buffer.write("\n")
+            table.write_text(buffer, header=False)
+        else:
+            table.write_text(buffer, header=True)
+            self.started = True
+
+
+class CompactEncoder:
+    # Token-lean layout: tab separated header once, trailing empty cells dropped,
+    # floats rounded, and repetitive text columns replaced by short codes whose
+    # legend is written ("# column: 0=value|1=value") before the rows that use them
+    def __init__(self, float_digits=FLOAT_DIGITS, dictionary=True, preamble=True):
+        self.float_digits = float_digits
+        self.dictionary = dictionary
+        self.preamble = preamble     # False for the second and later sheets of one prompt
+        self.started = False
+        self.codes = {}          # column index -> {value: code}
+        self.plain_columns = set()
+
+    def _dictionary_for(self, index, column):
+        if not self.dictionary or index in self.plain_columns:
+            return None
+        codes = self.codes.get(index)
+        if codes is None:
+            values = column.values[~column.mask]
+            if not len(values):
+                return None
+            # Decide once, on the first chunk that has values for this column
+            uniques = set(values.tolist())
+            average_length = sum(map(len, uniques)) / len(uniques)
+            if (len(uniques) <= DICTIONARY_MAX_VALUES and len(uniques) * 2 <= len(values)
+                    and average_length >= DICTIONARY_MIN_LENGTH):
+                codes = self.codes[index] = {}
+            else:
+                self.plain_columns.add(index)
+        return codes
+
+    def _format(self, index, name, column, legends):
+        if column.kind == 'float':
+            values = np.round(column.values, self.float_digits)
+            text = values.astype(str).astype(object)
+            # Drop the ".0" from whole numbers
+            whole = np.isfinite(values) & (values == np.trunc(values)) & (np.abs(values) < 2 ** 53)
+            text[whole] = values[whole].astype(np.int64).astype(str)
+            text[column.mask] = ''
+            return text
+        if column.kind != 'str':
+            return column.format()
+        codes = self._dictionary_for(index, column)
+        if codes is None:
+            values = column.values.tolist()
+            # Date-only columns from Excel come through as midnight datetimes
+            if all(value.endswith(MIDNIGHT) for value, empty in zip(values, column.mask) if not empty):
+                return np.array([value[:-len(MIDNIGHT)] for value in values], dtype=object)
+            return column.values
+        uniques, inverse = np.unique(column.values, return_inverse=True)
+        new = [value for value in uniques.tolist() if value and value not in codes]
+        for value in new:
+            codes[value] = str(len(codes))
+        if new:
+            legends.append(f"# {name}: " + "|".join(f"{codes[value]}={value}" for value in new))
+        mapped = np.array([codes.get(value, '') for value in uniques.tolist()], dtype=object)
+        return mapped[inverse]
+
+    def write(self, buffer, table):
+        names = ['' if name is None else str(name) for name in table.names]
+        if not self.started:
+            if self.preamble:
+                buffer.write(COMPACT_PREAMBLE)
+            buffer.write("\t".join(names))
+            self.started = True
+        legends = []
+        formatted = [self._format(i, name, column, legends).tolist()
+                     for i, (name, column) in enumerate(zip(names, table.columns))]
+        for legend in legends:
+            buffer.write("\n")
+            buffer.write(legend)
+        if table.num_rows:
+            buffer.write("\n")
+            buffer.write("\n".join("\t".join(cells).rstrip("\t") for cells in zip(*formatted)))
+
+
+ENCODERS = {
+    'plain': PlainEncoder,
+    'compact': CompactEncoder,
+}
+
+
+def make_encoder(encoding=None, preamble=True):
+    encoding = encoding or DEFAULT_ENCODING
+    if encoding not in ENCODERS:
+        raise ValueError(f"Unknown table encoding: {encoding}")
+    return ENCODERS[encoding](preamble=preamble)
+
+
+def write_tables(buffer, tables, encoding=None, preamble=True):
+    # Serialize tables (chunks of one sheet) into the buffer; returns the number of data rows.
+    # preamble=False leaves out the encoding's explanation when an earlier sheet already gave it
+    encoder = make_encoder(encoding, preamble)
+    count = 0
+    tables = iter(tables)
+    while True:
+        # Chunks of a streamed sheet are parsed on demand, so time the two stages apart
+        with tracing.span('parse'):
+            table = next(tables, None)
+        if table is None:
+            break
+        with tracing.span('serialize'):
+            encoder.write(buffer, table)
+        count += table.num_rows
+    tracing.count('rows', count)
+    return count
+
+
+def write_table_text(buffer, rows, chunk_rows=CHUNK_ROWS, encoding=None):
+    return write_tables(buffer, iter_tables(rows, chunk_rows), encoding)
+
+
+def write_sheets(buffer, tables, encoding=None):
+    # Write several named sheets, each under its own "Sheet: name" heading
+    count = 0
+    for i, (name, table) in enumerate(tables.items()):
+        if i:
+            buffer.write("\n\n")
+        if len(tables) > 1:
+            buffer.write(f"Sheet: {name}\n")
+        count += write_tables(buffer, [table], encoding, preamble=not i)
+    return count
+
+
+def write_xlsx_text(buffer, file_contents, encoding=None, sheets=None):
+    # sheets: None streams the active sheet; 'all' or a list of names parses those sheets
+    if sheets is None:
+        return write_table_text(buffer, iter_xlsx_rows(file_contents), encoding=encoding)
+    with tracing.span('parse'):
+        tables = load_sheets(file_contents, sheets)
+    return write_sheets(buffer, tables, encoding)
+
+
+def write_csv_text(buffer, file_contents, encoding=None):
+    return write_table_text(buffer, iter_csv_rows(file_contents), encoding=encoding)
+
+
+def load_table(file_contents, filetype, sheet_name=None):
+    # Load a whole sheet into one columnar table; CSV may also be a binary stream
+    if is_xlsx(filetype):
+        if hasattr(file_contents, 'read'):
+            file_contents = file_contents.read()
+        return _load_sheet((file_contents, sheet_name))[1]
+    if not is_csv(filetype):
+        raise ValueError(f"Unsupported file type: {filetype}")
+    tables = list(iter_tables(iter_csv_rows(file_contents)))
+    if not tables:
+        return Table([], [])
+    return tables[0] if len(tables) == 1 else Table.concat(tables)
+
+
+def load_file_tables(file_contents, filetype, sheets=None):
+    # {sheet name: table} for an uploaded file; CSV files and the active sheet use the name None
+    if is_xlsx(filetype) and sheets is not None:
+        return load_sheets(file_contents, sheets)
+    return {None: load_table(file_contents, filetype)}
+
+
+def xlsx_to_text(file_contents):
+    buffer = io.StringIO()
+    write_xlsx_text(buffer, file_contents)
+    return buffer.getvalue()
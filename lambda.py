@@ -1,18 +1,30 @@
 import json
-import boto3
-import openpyxl
-import csv
+import clients
+import codec
+import ratelimit
+import responsecache
+import router
+import tracing
+import time
+import ingest
+import s3cache
+import mapreduce
 import io
 import mammoth  # For docx/doc to text conversion
 from io import BytesIO
 import base64
 
 
+@tracing.traced('lambda')
+@ratelimit.lambda_deadline
 def lambda_handler(event, context):
     print(event)
     user_prompt = event.get('prompt', '')
     base64_file = event.get('file', '')
     filetype = event.get('filetype', '')  # Default empty string if not provided
+    encoding = event.get('table_encoding')  # 'plain' or 'compact', defaults to PROMPT_TABLE_ENCODING
+    sheets = event.get('sheets')  # 'all' or a list of sheet names, defaults to the active sheet
+    columns = event.get('columns')  # header names to send from the S3 workbook, defaults to every column
 
     # Check if filetype is provided and handle unsupported types
     # if not filetype:
@@ -25,6 +37,7 @@ def lambda_handler(event, context):
     request_body = {
         "anthropic_version": "bedrock-2023-05-31",
         "max_tokens": 200,
+        "temperature": 0,
         "messages": [
             {
                 "role": "user",
@@ -39,59 +52,62 @@ def lambda_handler(event, context):
     }
 
     try:
+        tables = None
         if base64_file:
             # Decode the base64 content
             file_data = base64.b64decode(base64_file)
         else:
-            # Create an S3 client
-            s3_client = boto3.client('s3')
+            # Shared S3 client, reused across invocations
+            s3_client = clients.s3()
             filetype = 'xlsx'
 
             # S3 bucket and file key details
             bucket_name = 'bedrocktest03'
             file_key = 'Employee_Details-2.' + filetype  # Adjust file extension based on 'filetype'
 
-            # Retrieve the file from S3
-            s3_object = s3_client.get_object(Bucket=bucket_name, Key=file_key)
-            file_data = s3_object['Body'].read()
-
-        if filetype.lower() == 'xlsx' or filetype.lower() == 'xls':
-            # Read the Excel file
-            excel_file = BytesIO(file_data)
-            workbook = openpyxl.load_workbook(excel_file)
-            sheet = workbook.active
-
-            # Extract information from the Excel file
-            excel_info = []
-            for row in sheet.iter_rows(values_only=True):
-                excel_info.append(list(row))
+            # Reuse the parsed tables while the object's ETag is unchanged; with columns, only those
+            # are read from the Parquet sidecar
+            tables = s3cache.get_sheets(s3_client, bucket_name, file_key, sheets, columns)
+            print("Table cache:", s3cache.stats())
+
+        if event.get('mode') == 'mapreduce' and (ingest.is_xlsx(filetype) or ingest.is_csv(filetype)):
+            # Split the table into token-bounded chunks, answer them concurrently and combine;
+            # event 'mapreduce' may set chunk_tokens, concurrency, map_prompt and reduce_prompt
+            if tables is None:
+                tables = ingest.load_file_tables(file_data, filetype, sheets)
+            client = clients.bedrock_runtime()
+            payload = mapreduce.run(client, user_prompt, tables, encoding=encoding, **event.get('mapreduce', {}))
+            print("Map-reduce chunks:", payload['chunks'], "usage:", payload['total_usage'])
+            return {
+                'statusCode': 200,
+                'body': json.dumps({'generated_text': codec.response_text(payload), 'response': payload})
+            }
 
-            # Convert Excel data to a readable string format
-            excel_data_text = "\n".join([", ".join(map(str, row)) for row in excel_info])
+        if ingest.is_xlsx(filetype):
+            buffer = io.StringIO()
+            buffer.write("Excel file contents:\n")
+            if tables is not None:
+                ingest.write_sheets(buffer, tables, encoding)
+            else:
+                # Stream Excel rows straight into the text buffer
+                ingest.write_xlsx_text(buffer, file_data, encoding, sheets)
 
             # Add Excel data as text to the request body
             request_body["messages"][0]["content"].append({
                 "type": "text",
-                "text": f"Excel file contents:\n{excel_data_text}"
+                "text": buffer.getvalue()
             })
 
-        elif filetype.lower() == 'csv':
-            # Read the CSV file
-            csv_data = file_data.decode('utf-8')  # Decode bytes to string
-            csv_reader = csv.reader(io.StringIO(csv_data))
-
-            # Process CSV rows
-            csv_info = []
-            for row in csv_reader:
-                csv_info.append(row)
-
-            # Convert CSV data to a readable string format
-            csv_data_text = "\n".join([", ".join(map(str, row)) for row in csv_info])
+        elif ingest.is_csv(filetype):
+            # Stream CSV rows straight into the text buffer
+            buffer = io.StringIO()
+            buffer.write("CSV file contents:\n")
+            ingest.write_csv_text(buffer, file_data, encoding)
 
             # Add CSV data as text to the request body
             request_body["messages"][0]["content"].append({
                 "type": "text",
-                "text": f"CSV file contents:\n{csv_data_text}"
+                "text": buffer.getvalue()
             })
 
 
@@ -102,25 +118,39 @@ def lambda_handler(event, context):
                 'body': json.dumps({'error': f'Unsupported file type: {filetype}'})
             }
 
-        # Create a Bedrock runtime client (replace with your region)
-        client = boto3.client('bedrock-runtime', region_name='us-east-1')
-
-        # Set the model ID for Claude 3 Sonnet
-        model_id = "anthropic.claude-3-sonnet-20240229-v1:0"
-
-        # Send the request to Bedrock using the 'invoke' API method
-        response = client.invoke_model(
-            modelId=model_id,
-            body=json.dumps(request_body)
-        )
-
-        # Read the content from the StreamingBody
-        response_payload = response['body'].read().decode('utf-8')
-        print("Full Response Payload:", response_payload)
-
-        # Parse the payload
-        payload = json.loads(response_payload)
-        generated_text = payload.get('completions', [{}])[0].get('text', '')
+        # Encode the request once, straight to the bytes that are sent
+        with tracing.span('encode_request'):
+            body = codec.encode(request_body)
+        tracing.count('request_bytes', len(body))
+
+        # Shared Bedrock runtime client, reused across invocations
+        client = clients.bedrock_runtime()
+
+        # Small, simple requests go to a faster model, large or analytical ones to a stronger one; event 'model_id' pins one
+        route = router.route('table', body.input_tokens, user_prompt, event.get('model_id'))
+        model_id = route.model_id
+
+        # Send the request to Bedrock using the 'invoke' API method; repeated requests are answered from the response cache
+        with tracing.span('bedrock_invoke'):
+            started = time.perf_counter()
+            response = responsecache.invoke_model(
+                client,
+                modelId=model_id,
+                body=body
+            )
+            router.record(route, started, response)
+
+        # Hit rate and invoke latency saved so far
+        print("Response cache:", response.get('cache'), responsecache.stats())
+        print("Route latency:", router.stats())
+
+        # Parse the payload straight from the response bytes
+        with tracing.span('decode_response'):
+            completion = codec.decode(response)
+        payload = completion.payload
+        tracing.usage(completion.usage)
+        print("Full Response Payload:", payload)
+        generated_text = completion.text
 
         # Return the generated text
         return {
@@ -129,8 +159,8 @@ def lambda_handler(event, context):
         }
 
     except Exception as e:
-        # Handle any errors that occurred during the process
+        # Handle any errors that occurred during the process; throttling that outlasted the retries is a 429
         return {
-            'statusCode': 500,
+            'statusCode': 429 if ratelimit.is_throttle(e) else 500,
             'body': json.dumps({'error': str(e)})
         }
@@ -1,5 +1,7 @@
+import io
 import streamlit as st
-import boto3
+import appcache
+import clients
 import pandas as pd
 from langchain_community.chat_models import BedrockChat
 from langchain_experimental.agents import create_pandas_dataframe_agent
@@ -13,9 +15,8 @@ st.title("Pandas DataFrame Agent with Claude")
 uploaded_file = st.file_uploader("Upload your CSV or Excel file", type=["csv", "xlsx"])
 query = st.text_input("Enter your query")
 
-# Set up the BedrockChat model
-client = boto3.client('bedrock-runtime', region_name='us-east-1')
-
+# Set up the BedrockChat model; the script reruns on every interaction, so the model, the chain and
+# each upload's DataFrame and agent are built once and kept by appcache
 model_id = "anthropic.claude-3-sonnet-20240229-v1:0"
 model_kwargs = {
     "max_tokens": 2048,
@@ -25,25 +26,41 @@ model_kwargs = {
     "stop_sequences": ["\n\nHuman"],
 }
 
-model = BedrockChat(
-    client=client,
+model = appcache.resource(f"bedrock_chat:{model_id}", lambda: BedrockChat(
+    # BedrockChat calls the client directly, not through ratelimit, so keep botocore's retries
+    client=clients.bedrock_runtime(retries=clients.DEFAULT_RETRIES),
     model_id=model_id,
     model_kwargs=model_kwargs
-)
+))
+
+
+def load_dataframe_agent(data, name):
+    # Read the file into a DataFrame and create the agent; the agent holds the DataFrame, so they are
+    # cached (and evicted) together
+    if name.endswith('.csv'):
+        df = pd.read_csv(io.BytesIO(data))
+    elif name.endswith('.xlsx'):
+        df = pd.read_excel(io.BytesIO(data))
+    return df, create_pandas_dataframe_agent(model, df, verbose=True, allow_dangerous_code=True)
+
+
+def knowledge_chain():
+    system_template = "Answer the question precisely using your {Knowledge}"
+    prompt_template = ChatPromptTemplate.from_messages([
+        ('system', system_template),
+        ('user', '{text}')
+    ])
+    parser = StrOutputParser()
+    return prompt_template | model | parser
+
 
 if uploaded_file is not None:
-    # Read the file into a DataFrame
-    if uploaded_file.name.endswith('.csv'):
-        df = pd.read_csv(uploaded_file)
-    elif uploaded_file.name.endswith('.xlsx'):
-        df = pd.read_excel(uploaded_file)
-    
+    df, agent = appcache.data((appcache.upload_key(uploaded_file), 'dataframe_agent', model_id),
+                              lambda: load_dataframe_agent(uploaded_file.getvalue(), uploaded_file.name))
+
     st.write("DataFrame Preview:")
     st.write(df.head())
 
-    # Create the agent
-    agent = create_pandas_dataframe_agent(model, df, verbose=True, allow_dangerous_code=True)
-
     if query:
       with st.spinner("Processing your query..."):  
         try:
@@ -56,15 +73,7 @@ else:
     if query:
      with st.spinner("Processing your query..."):
         try:
-
-            system_template = "Answer the question precisely using your {Knowledge}"
-            prompt_template = ChatPromptTemplate.from_messages([
-                ('system', system_template),
-                ('user', '{text}')
-            ])
-            parser = StrOutputParser()
-
-            chain = prompt_template | model | parser
+            chain = appcache.resource(f"knowledge_chain:{model_id}", knowledge_chain)
 
             # Chain Invoke
             result = chain.invoke({"Knowledge":"Prior Knowledge","text":query})
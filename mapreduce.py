@@ -0,0 +1,131 @@
+# Map-reduce question answering for spreadsheets larger than one model call.
+#
+# The table is split into row chunks that fit a token budget, each chunk is sent
+# to Bedrock concurrently (bounded thread pool) with the question, and a final
+# reduce call combines the partial answers. A table that fits in one chunk is
+# answered with a single call.
+
+import contextvars
+import io
+import logging
+import os
+from concurrent.futures import ThreadPoolExecutor
+
+import codec
+import ingest
+import responsecache
+import tokens
+
+MODEL_ID = "anthropic.claude-3-sonnet-20240229-v1:0"
+CHUNK_TOKENS = int(os.environ.get('MAPREDUCE_CHUNK_TOKENS', '20000'))
+CONCURRENCY = int(os.environ.get('MAPREDUCE_CONCURRENCY', '4'))
+MAX_TOKENS = 900
+
+NO_DATA = "NO RELEVANT DATA"
+
+MAP_PROMPT = (
+    "You are reading part {part} of {parts} of a spreadsheet. Answer the question using only "
+    "the rows below. If they contain nothing relevant, reply exactly " + NO_DATA + ". For counts, "
+    "sums, averages, minimums or maximums give the partial figures for these rows (count, sum, "
+    "min, max) so they can be combined with the other parts.\n\n"
+    "Question: {question}\n\n{table}"
+)
+
+REDUCE_PROMPT = (
+    "A spreadsheet was split into {parts} parts and the question was answered for each part "
+    "separately. Combine the partial answers below into one final answer. Ignore parts that say "
+    + NO_DATA + " and combine partial counts, sums, minimums and maximums arithmetically. "
+    "The answer should be in three lines. Do not provide any code.\n\n"
+    "Question: {question}\n\n{answers}"
+)
+
+
+def split_chunks(tables, chunk_tokens=CHUNK_TOKENS, encoding=None):
+    # Yield prompt-ready text chunks of whole rows, each within roughly chunk_tokens
+    for name, table in tables.items():
+        heading = f"Sheet: {name}\n" if name else ""
+        header_tokens = tokens.estimate_tokens(heading + table.header_line())
+        start = 0
+        used = header_tokens
+        for i, line in enumerate(table.lines()):
+            cost = tokens.estimate_tokens(line) + 1
+            if i > start and used + cost > chunk_tokens:
+                yield _chunk_text(heading, table.slice(start, i), encoding)
+                start, used = i, header_tokens
+            used += cost
+        if table.num_rows > start or not table.num_rows:
+            yield _chunk_text(heading, table.slice(start, table.num_rows), encoding)
+
+
+def _chunk_text(heading, table, encoding):
+    # Every chunk repeats the header (and its own code legends) so it stands alone
+    buffer = io.StringIO()
+    buffer.write(heading)
+    ingest.write_tables(buffer, [table], encoding)
+    return buffer.getvalue()
+
+
+def invoke(client, prompt, model_id=MODEL_ID, max_tokens=MAX_TOKENS):
+    request_body = {
+        "anthropic_version": "bedrock-2023-05-31",
+        "max_tokens": max_tokens,
+        "temperature": 0,
+        "messages": [
+            {
+                "role": "user",
+                "content": [
+                    {
+                        "type": "text",
+                        "text": prompt
+                    }
+                ]
+            }
+        ]
+    }
+    response = responsecache.invoke_model(client, modelId=model_id, body=codec.encode(request_body))
+    return codec.decode(response).payload
+
+
+response_text = codec.response_text
+
+
+def run(client, question, tables, chunk_tokens=CHUNK_TOKENS, concurrency=CONCURRENCY,
+        map_prompt=MAP_PROMPT, reduce_prompt=REDUCE_PROMPT, model_id=MODEL_ID,
+        max_tokens=MAX_TOKENS, encoding=None):
+    # Returns a Messages-shaped payload for the final answer plus the partial answers
+    chunks = list(split_chunks(tables, chunk_tokens, encoding))
+    parts = len(chunks)
+    logging.debug(f"Map-reduce over {parts} chunks with concurrency {concurrency}")
+
+    def map_chunk(numbered):
+        part, chunk = numbered
+        prompt = map_prompt.format(part=part, parts=parts, question=question, table=chunk)
+        return invoke(client, prompt, model_id, max_tokens)
+
+    with ThreadPoolExecutor(max_workers=max(1, min(concurrency, parts))) as pool:
+        # Each task runs in a copy of the caller's context so rate-limit deadlines apply;
+        # results are collected in chunk order
+        futures = [pool.submit(contextvars.copy_context().run, map_chunk, numbered)
+                   for numbered in enumerate(chunks, 1)]
+        partials = [future.result() for future in futures]
+
+    usage = {'input_tokens': 0, 'output_tokens': 0}
+    for payload in partials:
+        for name in usage:
+            usage[name] += payload.get('usage', {}).get(name, 0)
+
+    if parts == 1:
+        payload = partials[0]
+    else:
+        answers = "\n\n".join(f"Part {part}:\n{response_text(p)}" for part, p in enumerate(partials, 1)
+                              if NO_DATA not in response_text(p))
+        payload = invoke(client, reduce_prompt.format(parts=parts, question=question,
+                                                      answers=answers or NO_DATA), model_id, max_tokens)
+        for name in usage:
+            usage[name] += payload.get('usage', {}).get(name, 0)
+
+    payload = dict(payload)
+    payload['partials'] = [response_text(p) for p in partials]
+    payload['chunks'] = parts
+    payload['total_usage'] = usage
+    return payload
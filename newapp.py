@@ -4,13 +4,22 @@ import numpy as np
 import pandas as pd
 import requests
 import streamlit as st
-import boto3
-import openpyxl
-import csv
+import appcache
+import clients
+import codec
+import responsecache
+import router
+import tracing
+import ingest
+import mapreduce
+import retrieval
+import queryengine
+import streaming
 import io
 import base64
 import json
 import logging
+import time
 from io import BytesIO
 from streamlit_chat import message
 
@@ -36,17 +45,61 @@ if 'messages' not in st.session_state:
 # Allow user to upload CSV file
 uploaded_file = st.file_uploader("Choose a file")
 
+# Compact encoding sends the same table in fewer input tokens
+table_encoding = st.selectbox("Table encoding", list(ingest.ENCODERS), index=list(ingest.ENCODERS).index(ingest.DEFAULT_ENCODING))
+
+# Every rerun (each widget change and chat message) reuses what was parsed from this upload,
+# keyed by its content hash (appcache.py)
+upload_key = appcache.upload_key(uploaded_file) if uploaded_file is not None else None
+
+# Let the user pick sheets of an uploaded workbook (names are read without parsing the sheets)
+sheets = None
+if uploaded_file is not None and ingest.is_xlsx(uploaded_file.name.split('.')[-1]):
+    sheet_names = appcache.data((upload_key, 'sheet_names'), lambda: ingest.list_sheets(uploaded_file.getvalue()))
+    sheets = st.multiselect("Sheets", sheet_names, default=sheet_names[:1]) or None
+
+# How the table is sent: all rows, only the rows relevant to each question, or map-reduce chunks
+ANSWER_MODES = {
+    "Full table": None,
+    "Relevant rows": 'retrieval',
+    "Map-reduce for large files": 'mapreduce',
+    "Exact query (schema only)": 'query',
+}
+answer_mode = ANSWER_MODES[st.radio("Answer mode", list(ANSWER_MODES))]
+
+# Show the answer as it is generated (full-table and relevant-rows answers)
+stream_answers = st.checkbox("Stream response", value=True, disabled=answer_mode not in (None, 'retrieval'))
+
+def upload_tables():
+    # {sheet name: table} for the upload and the chosen sheets, parsed once
+    return appcache.data((upload_key, 'tables', repr(sheets)),
+                         lambda: ingest.load_file_tables(uploaded_file.getvalue(), uploaded_file.type, sheets))
+
+def data_quality(dataframe):
+    # Column names with trailing spaces, and (name, holds only dates) for the text columns named like dates
+    trailing_spaces = list(dataframe.columns[dataframe.columns.str.contains("\s+$", regex=True)])
+    date_cols = dataframe.select_dtypes(include="object").filter(regex="(?i)date").columns
+    date_checks = [(col, pd.to_datetime(dataframe[col], errors="coerce").isna().sum() == 0) for col in date_cols]
+    return trailing_spaces, date_checks
+
+# Parse the upload and build the row index once per file, not once per question
+table = row_index = None
+if uploaded_file is not None and answer_mode in ('retrieval', 'query'):
+    table = appcache.data((upload_key, 'table', repr(sheets)), lambda: ingest.Table.concat(upload_tables().values()))
+    if answer_mode == 'retrieval':
+        row_index = appcache.data((upload_key, 'row_index', repr(sheets)), lambda: retrieval.RowIndex(table))
+
 if uploaded_file is not None:
     # Read uploaded file as a Pandas DataFrame
-    dataframe = pd.read_csv(uploaded_file)
+    dataframe = appcache.data((upload_key, 'dataframe'), lambda: pd.read_csv(io.BytesIO(uploaded_file.getvalue())))
     st.write(dataframe)
     data_quality_check = st.checkbox('Request Data Quality Check')
     
     if data_quality_check:
+        trailing_spaces, date_checks = appcache.data((upload_key, 'data_quality'), lambda: data_quality(dataframe))
         st.write("The following data quality analysis has been made")
         st.markdown("**1. The dataset column names have been checked for trailing spaces**")
-        trailing_spaces = dataframe.columns[dataframe.columns.str.contains("\s+$", regex=True)]
-        if trailing_spaces.empty:
+        if not trailing_spaces:
             st.markdown('*Columns_ names_ are_ found_ ok*')
         else:
             st.markdown("*Columns with trailing spaces:* ")
@@ -54,66 +107,95 @@ if uploaded_file is not None:
 
         # Check data type of columns with name 'date'
         st.markdown("**2. The dataset's date columns have been checked for the correct data type**")
-        date_cols = dataframe.select_dtypes(include="object").filter(regex="(?i)date").columns
-        for col in date_cols:
-            if pd.to_datetime(dataframe[col], errors="coerce").isna().sum() > 0:
+        for col, only_dates in date_checks:
+            if not only_dates:
                 st.write(f"Column {col} should contain dates but has wrong data type")
             else:
                 st.write("Columns with date are of the correct data type")
         st.markdown("**:red[CSV BOT recommends fixing data quality issues prior to querying your data]**")
 
+# Build the full prompt: the question, then the table rows (all of them or the relevant ones)
+def build_prompt(prompt, file_contents=None, filetype=None, encoding=None, sheets=None, mode=None, row_index=None, tables=None):
+    if mode == 'retrieval' and file_contents:
+        # Send only the schema and the rows relevant to this question
+        if row_index is None:
+            tables = ingest.load_file_tables(file_contents, filetype, sheets)
+            row_index = retrieval.RowIndex(ingest.Table.concat(tables.values()))
+        prompt += "\ndata:\n" + retrieval.context_text(row_index, prompt, encoding=encoding)
+
+    elif tables is not None:
+        # Tables the caller already parsed from the upload
+        buffer = io.StringIO()
+        buffer.write(prompt)
+        buffer.write("\ndata:\n")
+        row_count = ingest.write_sheets(buffer, tables, encoding)
+        logging.debug(f"Rows written from parsed tables: {row_count}")
+        prompt = buffer.getvalue()
+
+    elif file_contents:
+        logging.debug("Processing file contents...")
+        if ingest.is_xlsx(filetype):
+            # Stream Excel rows straight into the prompt buffer
+            buffer = io.StringIO()
+            buffer.write(prompt)
+            buffer.write("\ndata:\n")
+            row_count = ingest.write_xlsx_text(buffer, file_contents, encoding, sheets)
+            logging.debug(f"Excel rows written: {row_count}")
+            prompt = buffer.getvalue()
+
+        elif ingest.is_csv(filetype):
+            # Stream CSV rows straight into the prompt buffer
+            buffer = io.StringIO()
+            buffer.write(prompt)
+            buffer.write("\ndata:\n")
+            row_count = ingest.write_csv_text(buffer, file_contents, encoding)
+            logging.debug(f"CSV rows written: {row_count}")
+            prompt = buffer.getvalue()
+
+        else:
+            logging.debug(f"Unhandled file type: {filetype}")
+
+    prompt += "Retrieve information from the DataFrame based on the given query if it involves manipulation. The answer should be in three lines. Do not provide any code."
+    return prompt
+
 # Define function to generate response from user input using AWS Bedrock Claude model
-def generate_response(prompt, file_contents=None, filetype=None):
+@tracing.traced('csv_bot', attach=True)
+def generate_response(prompt, file_contents=None, filetype=None, encoding=None, sheets=None, mode=None, mapreduce_options=None, row_index=None, table=None, tables=None):
     try:
         logging.debug(f"Prompt: {prompt}")
         logging.debug(f"Filetype: {filetype}")
 
-        if file_contents:
-            logging.debug("Processing file contents...")
-            if filetype.lower() in ['xlsx', 'xls', "vnd.openxmlformats-officedocument.spreadsheetml.sheet"]:
-                # Read Excel file
-                excel_file = BytesIO(file_contents)
-                workbook = openpyxl.load_workbook(excel_file)
-                sheet = workbook.active
-
-                # Process Excel data
-                excel_info = []
-                for row in sheet.iter_rows(values_only=True):
-                    excel_info.append(list(row))
-
-                # Convert Excel data to a readable string format
-                excel_data_text = "\n".join([", ".join(map(str, row)) for row in excel_info])
-                logging.debug(f"Excel data text: {excel_data_text}")
-
-                # Add Excel data as text to the request body
-                prompt += f"\ndata:\n{excel_data_text}"
-
-            elif filetype.lower() == 'csv':
-                # Read CSV file
-                csv_data = file_contents.decode('utf-8')
-                csv_reader = csv.reader(io.StringIO(csv_data))
-
-                # Process CSV rows
-                csv_info = []
-                for row in csv_reader:
-                    csv_info.append(row)
-
-                # Convert CSV data to a readable string format
-                csv_data_text = "\n".join([", ".join(map(str, row)) for row in csv_info])
-                logging.debug(f"CSV data text: {csv_data_text}")
-
-                # Add CSV data as text to the request body
-                prompt += f"\ndata:\n{csv_data_text}"
-
-            else:
-                logging.debug(f"Unhandled file type: {filetype}")
-
-        prompt += "Retrieve information from the DataFrame based on the given query if it involves manipulation. The answer should be in three lines. Do not provide any code."
+        if mode == 'mapreduce' and file_contents:
+            # Split the table into token-bounded chunks, answer them concurrently and combine
+            if tables is None:
+                tables = ingest.load_file_tables(file_contents, filetype, sheets)
+            client = clients.get_client('bedrock-runtime')
+            payload = mapreduce.run(client, prompt, tables, encoding=encoding, **(mapreduce_options or {}))
+            logging.debug(f"Map-reduce chunks: {payload['chunks']}, usage: {payload['total_usage']}")
+            return {
+                'generated_text': codec.response_text(payload),
+                'response': payload
+            }
+
+        if mode == 'query' and file_contents:
+            # Only the schema goes to the model; its query plan runs locally over every row
+            if table is None:
+                table = ingest.Table.concat(ingest.load_file_tables(file_contents, filetype, sheets).values())
+            answer = queryengine.ask(clients.get_client('bedrock-runtime'), prompt, table)
+            logging.debug(f"Query plan: {answer['plan']}")
+            return {
+                'generated_text': queryengine.answer_text(answer),
+                'response': queryengine.answer_payload(answer)
+            }
+
+        question = prompt
+        prompt = build_prompt(prompt, file_contents, filetype, encoding, sheets, mode, row_index, tables)
 
         # Create a request body for Bedrock
         request_body = {
             "anthropic_version": "bedrock-2023-05-31",
             "max_tokens": 900,
+            "temperature": 0,
             "messages": [
                 {
                     "role": "user",
@@ -127,26 +209,39 @@ def generate_response(prompt, file_contents=None, filetype=None):
             ]
         }
 
-        logging.debug(f"Request Body: {json.dumps(request_body)}")
-
-        # Create a Bedrock runtime client
-        client = boto3.client('bedrock-runtime')
-
-        # Set the model ID for Claude 3 Sonnet
-        model_id = "anthropic.claude-3-sonnet-20240229-v1:0"
-
-        # Send the request to Bedrock using the 'invoke' API method
-        response = client.invoke_model(
-            modelId=model_id,
-            body=json.dumps(request_body)
-        )
-
-        # Read the content from the StreamingBody
-        response_payload = response['body'].read().decode('utf-8')
-        logging.debug(f"Response Payload: {response_payload}")
-
-        payload = json.loads(response_payload)
-        generated_text = payload.get('completions', [{}])[0].get('text', '')
+        # Encode the request once, straight to the bytes that are sent
+        with tracing.span('encode_request'):
+            body = codec.encode(request_body)
+        tracing.count('request_bytes', len(body))
+        logging.debug("Request Body: %s", body.data)
+
+        # Shared Bedrock runtime client, reused across reruns
+        client = clients.get_client('bedrock-runtime')
+
+        # Small, simple requests go to a faster model, large or analytical ones to a stronger one
+        route = router.route('table', body.input_tokens, question)
+        model_id = route.model_id
+
+        # Send the request to Bedrock using the 'invoke' API method; repeated requests are answered from the response cache
+        with tracing.span('bedrock_invoke'):
+            started = time.perf_counter()
+            response = responsecache.invoke_model(
+                client,
+                modelId=model_id,
+                body=body
+            )
+            router.record(route, started, response)
+
+        # Hit rate and invoke latency saved so far
+        logging.debug(f"Response cache: {response.get('cache')} {responsecache.stats()}")
+
+        # Parse the payload straight from the response bytes
+        with tracing.span('decode_response'):
+            completion = codec.decode(response)
+        payload = completion.payload
+        tracing.usage(completion.usage)
+        logging.debug("Response Payload: %s", payload)
+        generated_text = completion.text
 
         # Return the generated text
         return {
@@ -160,6 +255,15 @@ def generate_response(prompt, file_contents=None, filetype=None):
             'error': str(e)
         }
 
+# Stream the answer as text deltas; the returned stream carries usage and latency once consumed
+def stream_response(prompt, file_contents=None, filetype=None, encoding=None, sheets=None, mode=None, row_index=None, tables=None):
+    question = prompt
+    prompt = build_prompt(prompt, file_contents, filetype, encoding, sheets, mode, row_index, tables)
+    # Encoded once: routing and the rate limiter share its memoized token estimate
+    body = streaming.prompt_body(prompt)
+    route = router.route('table', body.input_tokens, question)
+    return streaming.MessageStream(clients.get_client('bedrock-runtime'), body, route.model_id)
+
 # container for chat history
 response_container = st.container()
 
@@ -177,9 +281,32 @@ with input_container:
         try:
             file_contents = uploaded_file.getvalue() if uploaded_file else None
             filetype = uploaded_file.type if uploaded_file else None
-            query_response = generate_response(user_input, file_contents, filetype)
+            # Full-table and map-reduce answers reuse the tables parsed for the first question
+            tables = None
+            if uploaded_file and answer_mode in (None, 'mapreduce') and (ingest.is_xlsx(filetype) or ingest.is_csv(filetype)):
+                tables = upload_tables()
+            if stream_answers and answer_mode in (None, 'retrieval'):
+                # Render text deltas as they arrive; the finished answer joins the chat history
+                response_placeholder = st.empty()
+                stream = stream_response(user_input, file_contents, filetype, table_encoding, sheets,
+                                         answer_mode, row_index=row_index, tables=tables)
+                text = ""
+                for delta in stream:
+                    text += delta
+                    response_placeholder.markdown(text)
+                response_placeholder.empty()
+                stats = stream.stats()
+                logging.debug(f"Streamed response stats: {stats}")
+                st.caption(f"Time to first token: {stats['time_to_first_token'] or 0:.2f} s, "
+                           f"total: {stats['total_latency']:.2f} s, "
+                           f"tokens in/out: {stats['input_tokens']}/{stats['output_tokens']}")
+                generated_text = stream.text
+            else:
+                query_response = generate_response(user_input, file_contents, filetype, table_encoding, sheets,
+                                                   answer_mode, row_index=row_index, table=table, tables=tables)
+                generated_text = query_response['generated_text']
             st.session_state['past'].append(user_input)
-            st.session_state['generated'].append(query_response['generated_text'])
+            st.session_state['generated'].append(generated_text)
         except Exception as e:
             st.error(f"An error occurred: {str(e)}")
 
@@ -1,84 +1,118 @@
-import boto3
-import openpyxl
-import csv
+import clients
+import codec
+import responsecache
+import router
+import tracing
+import ingest
+import s3cache
+import mapreduce
+import queryengine
+import streaming
 import io
 from io import BytesIO
 import base64
 import json
 import logging
+import time
 
 logging.basicConfig(level=logging.DEBUG)
 
-def process_event(prompt, file_contents, filetype):
+def build_prompt(prompt, file_contents, filetype, encoding=None, sheets=None, s3_key=None, tables=None):
+    # The question followed by the table text: tables already parsed from the upload, the upload
+    # itself, the S3 object s3_key or the default S3 workbook
+    if tables is not None:
+        buffer = io.StringIO()
+        buffer.write(prompt)
+        buffer.write("\nData Frame:\n" if ingest.is_csv(filetype) else "\ndata frame:\n")
+        row_count = ingest.write_sheets(buffer, tables, encoding)
+        logging.debug(f"Rows written from parsed tables: {row_count}")
+        prompt = buffer.getvalue()
+
+    elif file_contents:
+        logging.debug("Processing file contents...")
+        if ingest.is_xlsx(filetype):
+            # Stream Excel rows straight into the prompt buffer
+            buffer = io.StringIO()
+            buffer.write(prompt)
+            buffer.write("\ndata frame:\n")
+            row_count = ingest.write_xlsx_text(buffer, file_contents, encoding, sheets)
+            logging.debug(f"Excel rows written: {row_count}")
+            prompt = buffer.getvalue()
+
+        elif ingest.is_csv(filetype):
+            # Stream CSV rows straight into the prompt buffer
+            buffer = io.StringIO()
+            buffer.write(prompt)
+            buffer.write("\nData Frame:\n")
+            row_count = ingest.write_csv_text(buffer, file_contents, encoding)
+            logging.debug(f"CSV rows written: {row_count}")
+            prompt = buffer.getvalue()
+        
+        else:
+            logging.debug(f"Unhandled file type: {filetype}")
+
+    else:
+        logging.debug("No file contents provided, using S3 file.")
+        # Simulate fetching a file from S3 if no file is uploaded
+        s3_client = clients.s3()
+        bucket_name = 'bedrocktest03'
+        file_key = s3_key or 'Employee_Details-2.xlsx'  # Adjust file extension based on 'filetype'
+
+        # Reuse the parsed tables while the object's ETag is unchanged (or its Parquet sidecar)
+        tables = s3cache.get_sheets(s3_client, bucket_name, file_key, sheets)
+        buffer = io.StringIO()
+        buffer.write(prompt)
+        buffer.write("\nCSV file contents:\n" if ingest.is_csv(file_key.rsplit('.', 1)[-1]) else "\nExcel file contents:\n")
+        row_count = ingest.write_sheets(buffer, tables, encoding)
+        logging.debug(f"Excel rows written from S3: {row_count} ({s3cache.stats()})")
+        prompt = buffer.getvalue()
+    
+    prompt += "Gets the information from the given Query from the Dataframe, if the query is realted to manipulation and the answer should be in 3 lines don't provide any code"
+    return prompt
+
+@tracing.traced('process_event', attach=True)
+def process_event(prompt, file_contents, filetype, encoding=None, sheets=None, mode=None, mapreduce_options=None, s3_key=None, tables=None):
     try:
         logging.debug(f"Prompt: {prompt}")
         logging.debug(f"Filetype: {filetype}")
+        logging.debug(f"Table encoding: {encoding or ingest.DEFAULT_ENCODING}")
+        logging.debug(f"Sheets: {sheets or 'active'}")
 
-        if file_contents:
-            logging.debug("Processing file contents...")
-            if filetype.lower() in ['xlsx', 'xls',"vnd.openxmlformats-officedocument.spreadsheetml.sheet"]:
-                # Read Excel file
-                excel_file = BytesIO(file_contents)
-                workbook = openpyxl.load_workbook(excel_file)
-                sheet = workbook.active
-
-                # Process Excel data
-                excel_info = []
-                for row in sheet.iter_rows(values_only=True):
-                    excel_info.append(list(row))
-
-                # Convert Excel data to a readable string format
-                excel_data_text = "\n".join([", ".join(map(str, row)) for row in excel_info])
-                logging.debug(f"Excel data text: {excel_data_text}")
-
-                # Add Excel data as text to the request body
-                prompt += f"\ndata frame:\n{excel_data_text}"
-
-            elif filetype.lower() == 'csv':
-                # Read CSV file
-                csv_data = file_contents.decode('utf-8')
-                csv_reader = csv.reader(io.StringIO(csv_data))
-
-                # Process CSV rows
-                csv_info = []
-                for row in csv_reader:
-                    csv_info.append(row)
-
-                # Convert CSV data to a readable string format
-                csv_data_text = "\n".join([", ".join(map(str, row)) for row in csv_info])
-                logging.debug(f"CSV data text: {csv_data_text}")
-
-                # Add CSV data as text to the request body
-                prompt += f"\nData Frame:\n{csv_data_text}"
-            
+        if mode in ('mapreduce', 'query') and tables is None:
+            if file_contents:
+                tables = ingest.load_file_tables(file_contents, filetype, sheets)
             else:
-                logging.debug(f"Unhandled file type: {filetype}")
+                tables = s3cache.get_sheets(clients.s3(), 'bedrocktest03', s3_key or 'Employee_Details-2.xlsx', sheets)
+
+        # Shared Bedrock runtime client, reused across invocations
+        client = clients.bedrock_runtime()
+
+        if mode == 'query':
+            # Only the schema goes to the model; its query plan runs locally over every row
+            answer = queryengine.ask(client, prompt, ingest.Table.concat(tables.values()))
+            logging.debug(f"Query plan: {answer['plan']}")
+            return {
+                'generated_text': queryengine.answer_text(answer),
+                'response': queryengine.answer_payload(answer)
+            }
+
+        if mode == 'mapreduce':
+            # Split the table into token-bounded chunks, answer them concurrently and combine
+            payload = mapreduce.run(client, prompt, tables, encoding=encoding, **(mapreduce_options or {}))
+            logging.debug(f"Map-reduce chunks: {payload['chunks']}, usage: {payload['total_usage']}")
+            return {
+                'generated_text': codec.response_text(payload),
+                'response': payload
+            }
+
+        question = prompt
+        prompt = build_prompt(prompt, file_contents, filetype, encoding, sheets, s3_key, tables)
 
-        else:
-            logging.debug("No file contents provided, using S3 file.")
-            # Simulate fetching a file from S3 if no file is uploaded
-            s3_client = boto3.client('s3')
-            bucket_name = 'bedrocktest03'
-            file_key = 'Employee_Details-2.xlsx'  # Adjust file extension based on 'filetype'
-            s3_object = s3_client.get_object(Bucket=bucket_name, Key=file_key)
-            file_data = s3_object['Body'].read()
-
-            # Assume the file is an Excel file for this example
-            excel_file = BytesIO(file_data)
-            workbook = openpyxl.load_workbook(excel_file)
-            sheet = workbook.active
-            excel_info = []
-            for row in sheet.iter_rows(values_only=True):
-                excel_info.append(list(row))
-            excel_data_text = "\n".join([", ".join(map(str, row)) for row in excel_info])
-            logging.debug(f"Excel data text from S3: {excel_data_text}")
-            prompt += f"\nExcel file contents:\n{excel_data_text}"
-        
-        prompt += "Gets the information from the given Query from the Dataframe, if the query is realted to manipulation and the answer should be in 3 lines don't provide any code"
         # Create a request body for Bedrock
         request_body = {
             "anthropic_version": "bedrock-2023-05-31",
             "max_tokens": 900,
+            "temperature": 0,
             "messages": [
                 {
                     "role": "user",
@@ -92,26 +126,36 @@ def process_event(prompt, file_contents, filetype):
             ]
         }
 
-        logging.debug(f"Request Body: {json.dumps(request_body)}")
-
-        # Create a Bedrock runtime client (replace with your region)
-        client = boto3.client('bedrock-runtime', region_name='us-east-1')
-
-        # Set the model ID for Claude 3 Sonnet
-        model_id = "anthropic.claude-3-sonnet-20240229-v1:0"
-
-        # Send the request to Bedrock using the 'invoke' API method
-        response = client.invoke_model(
-            modelId=model_id,
-            body=json.dumps(request_body)
-        )
-
-        # Read the content from the StreamingBody
-        response_payload = response['body'].read().decode('utf-8')
-        logging.debug(f"Response Payload: {response_payload}")
-
-        payload = json.loads(response_payload)
-        generated_text = payload.get('completions', [{}])[0].get('text', '')
+        # Encode the request once, straight to the bytes that are sent
+        with tracing.span('encode_request'):
+            body = codec.encode(request_body)
+        tracing.count('request_bytes', len(body))
+        logging.debug("Request Body: %s", body.data)
+
+        # Small, simple requests go to a faster model, large or analytical ones to a stronger one
+        route = router.route('table', body.input_tokens, question)
+        model_id = route.model_id
+
+        # Send the request to Bedrock using the 'invoke' API method; repeated requests are answered from the response cache
+        with tracing.span('bedrock_invoke'):
+            started = time.perf_counter()
+            response = responsecache.invoke_model(
+                client,
+                modelId=model_id,
+                body=body
+            )
+            router.record(route, started, response)
+
+        # Hit rate and invoke latency saved so far
+        logging.debug(f"Response cache: {response.get('cache')} {responsecache.stats()}")
+
+        # Parse the payload straight from the response bytes
+        with tracing.span('decode_response'):
+            completion = codec.decode(response)
+        payload = completion.payload
+        tracing.usage(completion.usage)
+        logging.debug("Response Payload: %s", payload)
+        generated_text = completion.text
 
         # Return the generated text
         return {
@@ -124,3 +168,12 @@ def process_event(prompt, file_contents, filetype):
         return {
             'error': str(e)
         }
+
+def stream_event(prompt, file_contents, filetype, encoding=None, sheets=None, s3_key=None, tables=None):
+    # Same prompt as process_event, answered as a stream of text deltas
+    question = prompt
+    prompt = build_prompt(prompt, file_contents, filetype, encoding, sheets, s3_key, tables)
+    # Encoded once: routing and the rate limiter share its memoized token estimate
+    body = streaming.prompt_body(prompt)
+    route = router.route('table', body.input_tokens, question)
+    return streaming.MessageStream(clients.bedrock_runtime(), body, route.model_id)
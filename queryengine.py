@@ -0,0 +1,282 @@
+# Schema-only question answering with a local, deterministic query engine.
+#
+# Only the table schema and column statistics go to the model, which replies with
+# a small JSON query plan (filter / group / aggregate / sort). The plan is checked
+# against the schema and run locally with pandas over the full table, so the
+# prompt size does not grow with the row count and the arithmetic is exact.
+#
+# Plan format:
+# {
+#   "filters": [{"column": "Department", "op": "==", "value": "Finance"}],
+#   "group_by": ["Location"],
+#   "aggregates": [{"column": "Salary", "func": "mean", "as": "avg_salary"}],
+#   "select": ["Name", "Salary"],            (used when there are no aggregates)
+#   "sort": [{"column": "avg_salary", "descending": true}],
+#   "limit": 10
+# }
+
+import json
+import re
+
+import numpy as np
+import pandas as pd
+
+import mapreduce
+
+OPERATORS = {'==', '!=', '>', '>=', '<', '<=', 'in', 'not in', 'contains', 'is null', 'not null'}
+FUNCTIONS = {'count', 'sum', 'mean', 'median', 'min', 'max', 'nunique'}
+NUMERIC_FUNCTIONS = {'sum', 'mean', 'median'}
+MAX_RESULT_ROWS = 200
+
+PLAN_PROMPT = """You translate questions about a table into a JSON query plan. You do not see the rows, only this schema:
+
+{schema}
+
+Reply with one JSON object and nothing else, using only these keys:
+- "filters": list of {{"column", "op", "value"}}, op one of {operators}
+- "group_by": list of column names
+- "aggregates": list of {{"column", "func", "as"}}, func one of {functions}; use "column": "*" with "count" to count rows
+- "select": list of column names to return when there are no aggregates
+- "sort": list of {{"column", "descending"}}; column may be a group_by column or an aggregate "as" name
+- "limit": maximum number of result rows
+
+Question: {question}"""
+
+
+class PlanError(ValueError):
+    pass
+
+
+def to_dataframe(table):
+    # Typed pandas columns from the columnar table; empty cells become NA
+    data = {}
+    for i, (name, column) in enumerate(zip(table.names, table.columns)):
+        name = str(name) if name not in (None, '') else f"column_{i + 1}"
+        if column.kind == 'int':
+            series = pd.array(column.values, dtype='Int64')
+            series[column.mask] = pd.NA
+        elif column.kind == 'float':
+            series = np.where(column.mask, np.nan, column.values)
+        elif column.kind == 'bool':
+            series = pd.array(column.values, dtype='boolean')
+            series[column.mask] = pd.NA
+        else:
+            series = pd.Series(column.values, dtype=object).where(~column.mask, None)
+            # Text columns kept as str for prompt fidelity (e.g. "1.50") are still numbers here
+            try:
+                series = pd.to_numeric(series)
+            except (ValueError, TypeError):
+                pass
+        data[name] = series
+    return pd.DataFrame(data)
+
+
+def schema_summary(df, top_values=5):
+    # retrieval.schema_summary for the frame the plan runs against, so numeric text columns
+    # are described as numbers
+    lines = []
+    for name in df.columns:
+        series = df[name]
+        present = series.dropna()
+        if pd.api.types.is_bool_dtype(series):
+            kind = 'bool'
+        elif pd.api.types.is_integer_dtype(series):
+            kind = 'int'
+        elif pd.api.types.is_float_dtype(series):
+            kind = 'float'
+        else:
+            kind = 'str'
+        line = f"- {name} ({kind}, {len(present)} of {len(df)} filled)"
+        if kind in ('int', 'float') and len(present):
+            line += f": min {present.min()}, max {present.max()}, mean {present.mean():.6g}"
+        elif kind == 'str' and len(present):
+            counts = present.astype(str).value_counts(sort=False)
+            common = counts.sort_values(ascending=False, kind='stable').index[:top_values]
+            line += f": {len(counts)} distinct, e.g. " + ", ".join(common.tolist())
+        lines.append(line)
+    return "\n".join(lines)
+
+
+def parse_plan(text):
+    # Take the outermost JSON object from the reply, tolerating code fences or stray text
+    match = re.search(r"\{.*\}", text, re.DOTALL)
+    if not match:
+        raise PlanError(f"No JSON query plan in model reply: {text[:200]}")
+    try:
+        return json.loads(match.group(0))
+    except json.JSONDecodeError as e:
+        raise PlanError(f"Invalid JSON query plan: {e}")
+
+
+def _coerce_value(series, value, column):
+    # A filter value converted to the column's type, so comparisons cannot fail at run time
+    if isinstance(value, (dict, list)) or value is None:
+        raise PlanError(f"Filter value for {column} must be a single value, not {json.dumps(value)}")
+    if pd.api.types.is_bool_dtype(series):
+        if isinstance(value, str) and value.strip().lower() in ('true', 'false'):
+            return value.strip().lower() == 'true'
+        if isinstance(value, bool):
+            return value
+        raise PlanError(f"Column {column} is true/false; {value!r} is not")
+    if pd.api.types.is_numeric_dtype(series):
+        if isinstance(value, (int, float)) and not isinstance(value, bool):
+            return value
+        if isinstance(value, str):
+            for number in (int, float):
+                try:
+                    return number(value.strip())
+                except ValueError:
+                    pass
+        raise PlanError(f"Column {column} is numeric; {value!r} is not a number")
+    return value if isinstance(value, str) else str(value)
+
+
+def validate_plan(plan, df):
+    # Check a model-written plan against the frame it will run on; filter values are
+    # converted to their column's type in place
+    if not isinstance(plan, dict):
+        raise PlanError("Query plan must be a JSON object")
+    unknown = set(plan) - {'filters', 'group_by', 'aggregates', 'select', 'sort', 'limit'}
+    if unknown:
+        raise PlanError(f"Unknown plan keys: {', '.join(sorted(unknown))}")
+    columns = set(df.columns)
+
+    def entries(key, kind):
+        value = plan.get(key, [])
+        if not isinstance(value, list) or not all(isinstance(entry, kind) for entry in value):
+            raise PlanError(f'"{key}" must be a list of {"objects" if kind is dict else "column names"}')
+        return value
+
+    def check_column(name, allowed=columns):
+        if not isinstance(name, str):
+            raise PlanError(f"Column names must be strings, not {json.dumps(name)}")
+        if name not in allowed:
+            raise PlanError(f"Unknown column: {name}")
+
+    for f in entries('filters', dict):
+        check_column(f.get('column'))
+        op = f.get('op')
+        if op not in OPERATORS:
+            raise PlanError(f"Unsupported filter op: {op}")
+        series = df[f['column']]
+        if op in ('in', 'not in'):
+            values = f.get('value') if isinstance(f.get('value'), list) else [f.get('value')]
+            f['value'] = [_coerce_value(series, value, f['column']) for value in values]
+        elif op == 'contains':
+            f['value'] = str(f.get('value'))
+        elif op not in ('is null', 'not null'):
+            f['value'] = _coerce_value(series, f.get('value'), f['column'])
+    for name in entries('group_by', str):
+        check_column(name)
+    outputs = set(plan.get('group_by', []))
+    for agg in entries('aggregates', dict):
+        func, column = agg.get('func'), agg.get('column')
+        if func not in FUNCTIONS:
+            raise PlanError(f"Unsupported aggregate: {func}")
+        if not (column == '*' and func == 'count'):
+            check_column(column)
+            series = df[column]
+            if func in NUMERIC_FUNCTIONS and (not pd.api.types.is_numeric_dtype(series)
+                                              or pd.api.types.is_bool_dtype(series)):
+                raise PlanError(f"{func} needs a numeric column; {column} is not numeric")
+        name = agg.get('as') or f"{func}_{column}"
+        if not isinstance(name, str):
+            raise PlanError(f"Aggregate names must be strings, not {json.dumps(name)}")
+        outputs.add(name)
+    for name in entries('select', str):
+        check_column(name)
+    sortable = outputs if plan.get('aggregates') else columns
+    for s in entries('sort', dict):
+        check_column(s.get('column'), sortable)
+        if not isinstance(s.get('descending', False), bool):
+            raise PlanError("sort \"descending\" must be true or false")
+    limit = plan.get('limit')
+    if limit is not None and (not isinstance(limit, int) or isinstance(limit, bool) or limit < 1):
+        raise PlanError("limit must be a positive integer")
+    return plan
+
+
+def _filter_mask(df, f):
+    series, op, value = df[f['column']], f['op'], f.get('value')
+    if op == 'is null':
+        return series.isna()
+    if op == 'not null':
+        return series.notna()
+    if op == 'contains':
+        return series.astype(str).str.contains(value, case=False, regex=False, na=False)
+    if op in ('in', 'not in'):
+        mask = series.isin(value)
+        return ~mask if op == 'not in' else mask
+    compare = {'==': series.eq, '!=': series.ne, '>': series.gt, '>=': series.ge, '<': series.lt, '<=': series.le}[op]
+    return compare(value).fillna(False).astype(bool)
+
+
+def execute(plan, df):
+    # Run a validated plan with vectorized pandas operations
+    for f in plan.get('filters', []):
+        df = df[_filter_mask(df, f)]
+
+    aggregates = plan.get('aggregates', [])
+    group_by = plan.get('group_by', [])
+    if aggregates:
+        named = {}
+        for agg in aggregates:
+            column = agg['column']
+            name = agg.get('as') or f"{agg['func']}_{column}"
+            if column == '*':
+                column = df.columns[0]
+                named[name] = pd.NamedAgg(column=column, aggfunc='size')
+            else:
+                named[name] = pd.NamedAgg(column=column, aggfunc=agg['func'])
+        if group_by:
+            result = df.groupby(group_by, dropna=False).agg(**named).reset_index()
+        else:
+            result = pd.DataFrame({name: [df[a.column].agg(a.aggfunc) if a.aggfunc != 'size' else len(df)]
+                                   for name, a in named.items()})
+    else:
+        result = df
+
+    sort = plan.get('sort', [])
+    if sort:
+        result = result.sort_values([s['column'] for s in sort],
+                                    ascending=[not s.get('descending', False) for s in sort], kind='stable')
+    result = result.head(plan.get('limit') or MAX_RESULT_ROWS)
+    # Projected last, so rows can be sorted on a column that is not selected
+    if not aggregates and plan.get('select'):
+        result = result[plan['select']]
+    return result.reset_index(drop=True)
+
+
+def ask(client, question, table, model_id=mapreduce.MODEL_ID, max_tokens=500):
+    # Returns the validated plan, the result frame and the usage of the planning call
+    df = to_dataframe(table)
+    prompt = PLAN_PROMPT.format(schema=schema_summary(df), operators=", ".join(sorted(OPERATORS)),
+                                functions=", ".join(sorted(FUNCTIONS)), question=question)
+    payload = mapreduce.invoke(client, prompt, model_id, max_tokens)
+    plan = validate_plan(parse_plan(mapreduce.response_text(payload)), df)
+    try:
+        result = execute(plan, df)
+    except (KeyError, TypeError, ValueError) as e:
+        raise PlanError(f"Query plan could not be run: {e}") from e
+    return {
+        'plan': plan,
+        'result': result,
+        'usage': payload.get('usage', {}),
+    }
+
+
+def answer_text(answer):
+    # Plain-text rendering of a query answer for chat output
+    result = answer['result']
+    text = result.to_string(index=False) if len(result) else "No matching rows."
+    return f"{text}\n\nQuery plan: {json.dumps(answer['plan'])}"
+
+
+def answer_payload(answer):
+    # Messages-shaped payload so callers can display it like a model response
+    return {
+        'content': [{'type': 'text', 'text': answer_text(answer)}],
+        'plan': answer['plan'],
+        'rows': answer['result'].to_dict(orient='records'),
+        'usage': answer['usage'],
+    }
@@ -0,0 +1,237 @@
+# Client-side rate limiting and throttling-aware retries for Bedrock calls.
+#
+# Each model gets a limiter with two token buckets, requests per minute and
+# tokens per minute (estimated input tokens plus max_tokens, which is what
+# Bedrock reserves against the quota). Rates adapt AIMD-style: every throttled
+# call cuts them by 30%, every success adds a small step back up to the configured
+# ceiling. Throttled calls, transient server errors (5xx) and dropped or timed
+# out connections are retried with full-jitter exponential backoff; botocore's
+# own retries are off for bedrock-runtime (clients.py), so this is the only
+# retry layer.
+# Every wait respects the current deadline, set with `with deadline(seconds):`
+# (e.g. from the Lambda context), so a request gives up while there is still
+# time to answer instead of being killed mid-retry.
+#
+# Limits: BEDROCK_RPM / BEDROCK_TPM for every model, or per model with
+# BEDROCK_RATE_LIMITS='{"model-id": {"rpm": 20, "tpm": 100000}}'.
+
+import contextlib
+import contextvars
+import functools
+import json
+import os
+import random
+import threading
+import time
+
+from botocore.exceptions import ClientError, ConnectionClosedError, ConnectionError, ReadTimeoutError
+
+import codec
+import tokens
+
+REQUESTS_PER_MINUTE = float(os.environ.get('BEDROCK_RPM', '100'))
+TOKENS_PER_MINUTE = float(os.environ.get('BEDROCK_TPM', '400000'))
+MODEL_LIMITS = json.loads(os.environ.get('BEDROCK_RATE_LIMITS', '{}'))
+MAX_ATTEMPTS = int(os.environ.get('BEDROCK_MAX_ATTEMPTS', '6'))
+BACKOFF_BASE = 0.5
+BACKOFF_CAP = 20.0
+BURST_SECONDS = 10        # bucket capacity, in seconds of the current rate
+DECREASE_FACTOR = 0.7
+INCREASE_STEP = 0.02      # share of the ceiling added back per success
+MIN_SHARE = 0.05          # rates never drop below this share of the ceiling
+DEADLINE_MARGIN = 1.0     # seconds a Lambda handler keeps to build its response
+
+THROTTLE_CODES = {'ThrottlingException', 'TooManyRequestsException', 'ServiceUnavailableException',
+                  'ModelNotReadyException', 'ServiceQuotaExceededException'}
+TRANSIENT_CODES = {'InternalServerException', 'InternalFailure', 'InternalError', 'ServiceUnavailable',
+                   'RequestTimeout', 'RequestTimeoutException'}
+TRANSIENT_STATUS = {500, 502, 503, 504}
+# EndpointConnectionError and ConnectTimeoutError are ConnectionErrors; the other two are not
+TRANSPORT_ERRORS = (ConnectionError, ReadTimeoutError, ConnectionClosedError)
+
+_deadline = contextvars.ContextVar('bedrock_deadline', default=None)
+_lock = threading.Lock()
+_limiters = {}
+
+
+class DeadlineExceeded(TimeoutError):
+    pass
+
+
+@contextlib.contextmanager
+def deadline(seconds):
+    # Calls inside the block must finish within `seconds`; nested deadlines keep the earliest
+    current = _deadline.get()
+    at = time.monotonic() + seconds
+    token = _deadline.set(at if current is None else min(current, at))
+    try:
+        yield
+    finally:
+        _deadline.reset(token)
+
+
+def lambda_deadline(handler):
+    # Decorator: run a Lambda handler under the invocation's remaining time
+    @functools.wraps(handler)
+    def wrapper(event, context):
+        get_remaining = getattr(context, 'get_remaining_time_in_millis', None)
+        if get_remaining is None:
+            return handler(event, context)
+        with deadline(get_remaining() / 1000 - DEADLINE_MARGIN):
+            return handler(event, context)
+    return wrapper
+
+
+def remaining():
+    at = _deadline.get()
+    return None if at is None else at - time.monotonic()
+
+
+def is_throttle(error):
+    return isinstance(error, ClientError) and error.response.get('Error', {}).get('Code') in THROTTLE_CODES
+
+
+def is_transient(error):
+    # Worth retrying as it is: a server-side failure or a connection that dropped or timed out
+    if isinstance(error, TRANSPORT_ERRORS):
+        return True
+    if not isinstance(error, ClientError):
+        return False
+    return (error.response.get('Error', {}).get('Code') in TRANSIENT_CODES
+            or error.response.get('ResponseMetadata', {}).get('HTTPStatusCode') in TRANSIENT_STATUS)
+
+
+class _Bucket:
+    def __init__(self, per_minute):
+        self.ceiling = per_minute / 60.0
+        self.rate = self.ceiling
+        self.level = self.capacity
+
+    @property
+    def capacity(self):
+        return max(1.0, self.rate * BURST_SECONDS)
+
+    def refill(self, elapsed):
+        self.level = min(self.capacity, self.level + elapsed * self.rate)
+
+    def wait_for(self, amount):
+        # Seconds until `amount` is available; requests larger than the bucket wait for a full one
+        amount = min(amount, self.capacity)
+        return 0.0 if self.level >= amount else (amount - self.level) / self.rate
+
+
+class RateLimiter:
+    def __init__(self, requests_per_minute=REQUESTS_PER_MINUTE, tokens_per_minute=TOKENS_PER_MINUTE):
+        self.requests = _Bucket(requests_per_minute)
+        self.tokens = _Bucket(tokens_per_minute)
+        self.throttles = 0
+        self._updated = time.monotonic()
+        self._condition = threading.Condition()
+
+    def _refill(self):
+        now = time.monotonic()
+        for bucket in (self.requests, self.tokens):
+            bucket.refill(now - self._updated)
+        self._updated = now
+
+    def acquire(self, token_count=0):
+        # Block until one request and token_count tokens fit, or the deadline would pass
+        with self._condition:
+            while True:
+                self._refill()
+                wait = max(self.requests.wait_for(1), self.tokens.wait_for(token_count))
+                if not wait:
+                    self.requests.level -= 1
+                    self.tokens.level -= min(token_count, self.tokens.capacity)
+                    return
+                left = remaining()
+                if left is not None and wait > left:
+                    raise DeadlineExceeded(f"Rate limit wait of {wait:.1f}s exceeds the remaining {left:.1f}s")
+                self._condition.wait(wait)
+
+    def throttled(self):
+        # Multiplicative decrease, and drop any burst the limiter thought it had
+        with self._condition:
+            self.throttles += 1
+            for bucket in (self.requests, self.tokens):
+                bucket.rate = max(bucket.ceiling * MIN_SHARE, bucket.rate * DECREASE_FACTOR)
+                bucket.level = min(bucket.level, 0.0)
+
+    def succeeded(self):
+        # Additive increase back towards the configured ceiling
+        with self._condition:
+            for bucket in (self.requests, self.tokens):
+                bucket.rate = min(bucket.ceiling, bucket.rate + bucket.ceiling * INCREASE_STEP)
+            self._condition.notify_all()
+
+    def stats(self):
+        with self._condition:
+            return {
+                'requests_per_minute': self.requests.rate * 60,
+                'tokens_per_minute': self.tokens.rate * 60,
+                'throttles': self.throttles,
+            }
+
+
+def limiter(model_id):
+    # One shared limiter per model, so all threads of a process share the quota
+    with _lock:
+        model_limiter = _limiters.get(model_id)
+        if model_limiter is None:
+            limits = MODEL_LIMITS.get(model_id, {})
+            model_limiter = RateLimiter(limits.get('rpm', REQUESTS_PER_MINUTE), limits.get('tpm', TOKENS_PER_MINUTE))
+            _limiters[model_id] = model_limiter
+        return model_limiter
+
+
+def reset():
+    with _lock:
+        _limiters.clear()
+
+
+def backoff(attempt):
+    return random.uniform(0, min(BACKOFF_CAP, BACKOFF_BASE * 2 ** attempt))
+
+
+def call(model_id, token_count, fn, max_attempts=MAX_ATTEMPTS):
+    # Run fn() under the model's limiter, retrying throttling, transient server and connection errors
+    model_limiter = limiter(model_id)
+    for attempt in range(max_attempts):
+        model_limiter.acquire(token_count)
+        try:
+            result = fn()
+        except (ClientError,) + TRANSPORT_ERRORS as e:
+            if not (is_throttle(e) or is_transient(e)) or attempt == max_attempts - 1:
+                raise
+            if is_throttle(e):
+                model_limiter.throttled()
+            delay = backoff(attempt)
+            left = remaining()
+            if left is not None and delay > left:
+                raise
+            time.sleep(delay)
+            continue
+        model_limiter.succeeded()
+        return result
+
+
+def request_tokens(body):
+    # Quota cost of an invoke_model body: estimated prompt tokens plus the reserved max_tokens
+    if isinstance(body, codec.EncodedRequest):
+        return body.tokens
+    text = body.decode('utf-8') if isinstance(body, bytes) else body if isinstance(body, str) else json.dumps(body)
+    return tokens.estimate_tokens(text) + json.loads(text).get('max_tokens', 0)
+
+
+def invoke_model(client, modelId, body, **kwargs):
+    # Drop-in for client.invoke_model(modelId=..., body=...) with rate limiting and retries;
+    # body may also be a codec.EncodedRequest
+    data = codec.body_bytes(body)
+    return call(modelId, request_tokens(body), lambda: client.invoke_model(modelId=modelId, body=data, **kwargs))
+
+
+def converse(client, method='converse', **request):
+    # Same for client.converse / client.converse_stream (pass method='converse_stream')
+    max_tokens = request.get('inferenceConfig', {}).get('maxTokens', 0)
+    token_count = tokens.estimate_tokens(json.dumps(request.get('messages', []), default=str)) + max_tokens
+    return call(request['modelId'], token_count, lambda: getattr(client, method)(**request))
@@ -0,0 +1,231 @@
+# Exact-match response cache for Bedrock invoke_model calls.
+#
+# Responses are keyed by a hash of the model ID, the request body in canonical
+# JSON (sorted keys, no whitespace) and the remaining call parameters, so the
+# same question about the same table is answered once. A codec.EncodedRequest is
+# already deterministic, so its bytes are hashed as they are. The in-process LRU tier
+# lives at module level and survives warm Lambda invocations and Streamlit
+# reruns; the SQLite tier (RESPONSE_CACHE_DB, /tmp by default, '' to disable)
+# survives restarts, expires entries after RESPONSE_CACHE_TTL seconds and
+# evicts the least recently used ones beyond RESPONSE_CACHE_DB_BYTES.
+#
+# Requests with a temperature above 0, including those that leave it at the
+# model's default of 1.0, ask for varied answers and bypass the cache unless
+# RESPONSE_CACHE_SAMPLED=1; the table handlers ask for temperature 0. RESPONSE_CACHE=0 turns caching off.
+# Calls that do reach Bedrock go through the rate limiter (ratelimit.py).
+
+import hashlib
+import io
+import json
+import logging
+import os
+import sqlite3
+import tempfile
+import threading
+import time
+from collections import OrderedDict
+
+import codec
+import ratelimit
+import tracing
+
+ENABLED = os.environ.get('RESPONSE_CACHE', '1') != '0'
+CACHE_SAMPLED = os.environ.get('RESPONSE_CACHE_SAMPLED', '0') == '1'
+MEMORY_ENTRIES = int(os.environ.get('RESPONSE_CACHE_SIZE', '256'))
+DB_PATH = os.environ.get('RESPONSE_CACHE_DB', os.path.join(tempfile.gettempdir(), 'bedrock-response-cache.sqlite3'))
+DB_MAX_BYTES = int(os.environ.get('RESPONSE_CACHE_DB_BYTES', str(64 * 1024 * 1024)))
+TTL_SECONDS = float(os.environ.get('RESPONSE_CACHE_TTL', str(24 * 3600)))
+DEFAULT_TEMPERATURE = 1.0    # Anthropic models on Bedrock
+
+_lock = threading.Lock()
+_memory = OrderedDict()    # key -> (created, response body bytes, original latency in seconds)
+_db = None
+_stats = {
+    'memory_hits': 0,
+    'disk_hits': 0,
+    'misses': 0,
+    'bypassed': 0,
+    'disk_evictions': 0,
+    'latency_saved': 0.0,
+}
+
+
+def stats():
+    # Snapshot of the hit/miss counters and the invoke latency the hits avoided
+    with _lock:
+        counters = dict(_stats)
+        counters['memory_entries'] = len(_memory)
+    lookups = counters['memory_hits'] + counters['disk_hits'] + counters['misses']
+    counters['hit_rate'] = (lookups - counters['misses']) / lookups if lookups else 0.0
+    return counters
+
+
+def clear():
+    # Drop both tiers and reset the counters
+    with _lock:
+        _memory.clear()
+        for name in _stats:
+            _stats[name] = 0.0 if name == 'latency_saved' else 0
+        db = _connect()
+        if db is not None:
+            db.execute("DELETE FROM responses")
+            db.commit()
+
+
+def _count(name, amount=1):
+    with _lock:
+        _stats[name] += amount
+
+
+def _canonical(value):
+    return json.dumps(value, sort_keys=True, separators=(',', ':'), ensure_ascii=False)
+
+
+def request_body(body):
+    # invoke_model takes the body as a JSON string or bytes; callers may also pass a dict or a codec.EncodedRequest
+    if isinstance(body, codec.EncodedRequest):
+        return body.request
+    if isinstance(body, (bytes, bytearray)):
+        body = body.decode('utf-8')
+    return json.loads(body) if isinstance(body, str) else body
+
+
+def cache_key(model_id, body, **params):
+    # Hash of the model, the normalized request body and the other call parameters
+    if isinstance(body, codec.EncodedRequest):
+        digest = hashlib.sha256(_canonical({'model': model_id, 'params': params}).encode('utf-8'))
+        digest.update(body.data)
+        return digest.hexdigest()
+    text = _canonical({'model': model_id, 'body': request_body(body), 'params': params})
+    return hashlib.sha256(text.encode('utf-8')).hexdigest()
+
+
+def is_cacheable(body):
+    # A request without a temperature is sampled at the model's default
+    temperature = request_body(body).get('temperature', DEFAULT_TEMPERATURE)
+    return CACHE_SAMPLED or not temperature
+
+
+def _connect():
+    # Lazily opened SQLite connection shared by all threads (access goes through _lock)
+    global _db
+    if _db is None and DB_PATH:
+        try:
+            _db = sqlite3.connect(DB_PATH, timeout=5, check_same_thread=False)
+            _db.execute("PRAGMA journal_mode=WAL")
+            _db.execute("CREATE TABLE IF NOT EXISTS responses (key TEXT PRIMARY KEY, body BLOB, latency REAL, "
+                        "created REAL, accessed REAL, size INTEGER)")
+            _db.execute("CREATE INDEX IF NOT EXISTS responses_accessed ON responses (accessed)")
+            _db.commit()
+        except sqlite3.Error as e:
+            logging.warning(f"Response cache database {DB_PATH} unavailable: {e}")
+            _db = None
+    return _db
+
+
+def _memory_get(key, now):
+    with _lock:
+        entry = _memory.get(key)
+        if entry is None:
+            return None
+        if now - entry[0] > TTL_SECONDS:
+            del _memory[key]
+            return None
+        _memory.move_to_end(key)
+        return entry
+
+
+def _memory_put(key, entry):
+    with _lock:
+        _memory[key] = entry
+        _memory.move_to_end(key)
+        while len(_memory) > MEMORY_ENTRIES:
+            _memory.popitem(last=False)
+
+
+def _disk_get(key, now):
+    with _lock:
+        db = _connect()
+        if db is None:
+            return None
+        try:
+            row = db.execute("SELECT created, body, latency FROM responses WHERE key = ? AND created >= ?",
+                             (key, now - TTL_SECONDS)).fetchone()
+            if row is not None:
+                db.execute("UPDATE responses SET accessed = ? WHERE key = ?", (now, key))
+                db.commit()
+        except sqlite3.Error as e:
+            logging.warning(f"Response cache read failed: {e}")
+            return None
+    return (row[0], bytes(row[1]), row[2]) if row is not None else None
+
+
+def _disk_put(key, entry):
+    created, body, latency = entry
+    with _lock:
+        db = _connect()
+        if db is None:
+            return
+        try:
+            db.execute("INSERT OR REPLACE INTO responses VALUES (?, ?, ?, ?, ?, ?)",
+                       (key, body, latency, created, created, len(body)))
+            evicted = _disk_evict(db, created)
+            db.commit()
+        except sqlite3.Error as e:
+            logging.warning(f"Response cache write failed: {e}")
+            return
+        _stats['disk_evictions'] += evicted
+
+
+def _disk_evict(db, now):
+    # Expired entries first, then the least recently used until under the size limit
+    evicted = db.execute("DELETE FROM responses WHERE created < ?", (now - TTL_SECONDS,)).rowcount
+    total = db.execute("SELECT COALESCE(SUM(size), 0) FROM responses").fetchone()[0]
+    if total > DB_MAX_BYTES:
+        for key, size in db.execute("SELECT key, size FROM responses ORDER BY accessed").fetchall():
+            if total <= DB_MAX_BYTES:
+                break
+            db.execute("DELETE FROM responses WHERE key = ?", (key,))
+            total -= size
+            evicted += 1
+    return evicted
+
+
+def _response(body, source):
+    # Same shape as invoke_model's response: callers read() the body
+    return {'body': io.BytesIO(body), 'contentType': 'application/json', 'cache': source}
+
+
+def invoke_model(client, modelId, body, **kwargs):
+    # Drop-in for client.invoke_model(modelId=..., body=...) that answers repeats from the cache
+    if not ENABLED or not is_cacheable(body):
+        _count('bypassed')
+        return ratelimit.invoke_model(client, modelId=modelId, body=body, **kwargs)
+
+    key = cache_key(modelId, body, **kwargs)
+    now = time.time()
+    entry = _memory_get(key, now)
+    source = 'memory'
+    if entry is None:
+        entry = _disk_get(key, now)
+        source = 'disk'
+        if entry is not None:
+            _memory_put(key, entry)
+    if entry is not None:
+        _count(source + '_hits')
+        tracing.count('response_cache_hits')
+        _count('latency_saved', entry[2])
+        return _response(entry[1], source)
+
+    started = time.perf_counter()
+    response = ratelimit.invoke_model(client, modelId=modelId, body=body, **kwargs)
+    data = response['body'].read()
+    entry = (now, data, time.perf_counter() - started)
+    _count('misses')
+    _memory_put(key, entry)
+    _disk_put(key, entry)
+    logging.debug(f"Response cache miss for {modelId}: {stats()}")
+    response = dict(response)
+    response['body'] = io.BytesIO(data)
+    response['cache'] = 'miss'
+    return response
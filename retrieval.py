@@ -0,0 +1,149 @@
+# In-memory row retrieval for chatting with a large table.
+#
+# An inverted index over the cell text of every row is built once per uploaded
+# file. Each question is scored with BM25 and only the top-k rows (plus the
+# header and a schema summary) are sent to the model, instead of the whole table.
+# Exact-match column filters ("Department: Finance" or filters={...}) narrow the
+# candidate rows before ranking.
+
+import io
+import re
+from collections import Counter, defaultdict
+
+import numpy as np
+
+import ingest
+
+TOP_K = 50
+
+# BM25 parameters
+K1 = 1.2
+B = 0.75
+
+_TOKEN = re.compile(r"[a-z0-9]+")
+
+# Common question words that would otherwise match free-text cells
+STOPWORDS = {
+    "a", "an", "and", "are", "by", "do", "does", "for", "from", "give", "has", "have", "how",
+    "in", "is", "it", "list", "me", "many", "much", "of", "on", "or", "show", "tell", "the",
+    "to", "was", "were", "what", "which", "who", "with",
+}
+
+
+def tokenize(text):
+    return [token for token in _TOKEN.findall(text.lower()) if token not in STOPWORDS]
+
+
+class RowIndex:
+    def __init__(self, table):
+        self.table = table
+        self.num_rows = table.num_rows
+        postings = defaultdict(list)
+        frequencies = defaultdict(list)
+        lengths = np.zeros(self.num_rows, dtype=np.float64)
+        for row, line in enumerate(table.lines()):
+            counts = Counter(tokenize(line))
+            lengths[row] = sum(counts.values())
+            for token, count in counts.items():
+                postings[token].append(row)
+                frequencies[token].append(count)
+        # Posting lists as arrays so scoring a term is a single vectorized update
+        self.postings = {token: (np.array(rows, dtype=np.int64), np.array(frequencies[token], dtype=np.float64))
+                         for token, rows in postings.items()}
+        self.length_norm = K1 * (1 - B + B * lengths / (lengths.mean() if self.num_rows else 1.0))
+        # Lower-cased cell text per column for exact-match filters
+        self._filter_columns = {}
+
+    @property
+    def nbytes(self):
+        # Memory held by the index itself; the table is shared with whoever built it
+        size = self.length_norm.nbytes + sum(rows.nbytes + frequencies.nbytes for rows, frequencies in self.postings.values())
+        return size + sum(text.nbytes for text in self._filter_columns.values())
+
+    def _column_text(self, index):
+        text = self._filter_columns.get(index)
+        if text is None:
+            text = np.array([value.lower() for value in self.table.columns[index].format().tolist()], dtype=object)
+            self._filter_columns[index] = text
+        return text
+
+    def _column_index(self, name):
+        lowered = [str(n).strip().lower() for n in self.table.names]
+        return lowered.index(name.strip().lower()) if name.strip().lower() in lowered else None
+
+    def parse_filters(self, question):
+        # Pick up 'Column: value' or 'Column = value' for columns that exist in the table
+        # Longer names are tried first and text an earlier match used is skipped, so
+        # 'Department Name: Finance' does not also set a 'Name' column
+        filters = {}
+        used = []
+        for name in sorted((str(name) for name in self.table.names if name), key=len, reverse=True):
+            pattern = r"(?<!\w)" + re.escape(name) + r"\s*[:=]\s*(\"[^\"]+\"|'[^']+'|[^,;?\s]+)"
+            for match in re.finditer(pattern, question, re.IGNORECASE):
+                start, end = match.span()
+                if all(end <= used_start or start >= used_end for used_start, used_end in used):
+                    filters[name] = match.group(1).strip("\"'")
+                    used.append((start, end))
+                    break
+        return filters
+
+    def filter_mask(self, filters):
+        mask = np.ones(self.num_rows, dtype=bool)
+        for name, value in filters.items():
+            index = self._column_index(name)
+            if index is None:
+                continue
+            mask &= self._column_text(index) == str(value).lower()
+        return mask
+
+    def search(self, question, k=TOP_K, filters=None):
+        # Return the indices of the top-k rows for the question, best first
+        filters = {**self.parse_filters(question), **(filters or {})}
+        scores = np.zeros(self.num_rows, dtype=np.float64)
+        for token in set(tokenize(question)):
+            posting = self.postings.get(token)
+            if posting is None:
+                continue
+            rows, tf = posting
+            idf = np.log(1 + (self.num_rows - len(rows) + 0.5) / (len(rows) + 0.5))
+            scores[rows] += idf * tf * (K1 + 1) / (tf + self.length_norm[rows])
+        candidates = np.flatnonzero(self.filter_mask(filters)) if filters else np.arange(self.num_rows)
+        matched = candidates[scores[candidates] > 0]
+        # Rows that share no term with the question are only used when nothing matches
+        if len(matched):
+            candidates = matched
+        if not len(candidates):
+            return candidates
+        k = min(k, len(candidates))
+        ranked = candidates[np.argpartition(-scores[candidates], k - 1)[:k]]
+        # Best first, ties in original row order
+        return ranked[np.lexsort((ranked, -scores[ranked]))]
+
+
+def schema_summary(table, top_values=5):
+    # One line per column: type, how many cells are filled, and a range or the common values
+    lines = []
+    for i, (name, column) in enumerate(zip(table.names, table.columns)):
+        name = name if name not in (None, '') else f"column_{i + 1}"
+        filled = int((~column.mask).sum())
+        line = f"- {name} ({column.kind}, {filled} of {table.num_rows} filled)"
+        present = column.values[~column.mask]
+        if column.kind in ('int', 'float') and filled:
+            line += f": min {present.min()}, max {present.max()}, mean {present.mean():.6g}"
+        elif column.kind == 'str' and filled:
+            values, counts = np.unique(present.astype(str), return_counts=True)
+            common = values[np.argsort(-counts, kind='stable')[:top_values]]
+            line += f": {len(values)} distinct, e.g. " + ", ".join(common.tolist())
+        lines.append(line)
+    return "\n".join(lines)
+
+
+def context_text(index, question, k=TOP_K, filters=None, encoding=None):
+    # Schema summary plus header and the top-k rows, ready to append to the prompt
+    rows = index.search(question, k, filters)
+    buffer = io.StringIO()
+    buffer.write(f"Schema ({index.num_rows} rows):\n")
+    buffer.write(schema_summary(index.table))
+    buffer.write(f"\n\nMost relevant {len(rows)} of {index.num_rows} rows:\n")
+    ingest.write_tables(buffer, [index.table.take(np.sort(rows))], encoding)
+    return buffer.getvalue()
@@ -0,0 +1,98 @@
+# Size- and task-aware model routing across Claude tiers.
+#
+# Each task type starts on a tier (table lookups and chat on the fast tier,
+# document QA on the standard tier, images on the advanced tier, where the
+# image handler already was) and is escalated one tier when
+# the estimated input is beyond ROUTER_SMALL_TOKENS on the fast tier, and one
+# more when it is beyond ROUTER_LARGE_TOKENS or the question asks for analysis
+# rather than a lookup. Tier models and thresholds are set through the
+# environment; a caller that names a model explicitly always gets it.
+#
+# record() keeps per-route latencies of uncached calls so the thresholds can be
+# tuned from stats() or the logs.
+
+import logging
+import os
+import re
+import threading
+import time
+from collections import defaultdict, deque, namedtuple
+
+import tokens
+
+TIERS = ('fast', 'standard', 'advanced')
+MODELS = {
+    'fast': os.environ.get('ROUTER_FAST_MODEL', "anthropic.claude-3-haiku-20240307-v1:0"),
+    'standard': os.environ.get('ROUTER_STANDARD_MODEL', "anthropic.claude-3-sonnet-20240229-v1:0"),
+    'advanced': os.environ.get('ROUTER_ADVANCED_MODEL', "anthropic.claude-3-5-sonnet-20240620-v1:0"),
+}
+SMALL_TOKENS = int(os.environ.get('ROUTER_SMALL_TOKENS', '4000'))
+LARGE_TOKENS = int(os.environ.get('ROUTER_LARGE_TOKENS', '50000'))
+BASE_TIER = {
+    'table': 'fast',
+    'chat': 'fast',
+    'document': 'standard',
+    'image': 'advanced',
+}
+LATENCY_SAMPLES = 1000
+
+# Questions that need reasoning over the data rather than finding a value in it
+COMPLEX_QUESTION = re.compile(
+    r"\b(why|explain\w*|compar\w*|trends?|analy[sz]\w*|insights?|summar\w*|recommend\w*|predict\w*|"
+    r"forecast\w*|correlat\w*|reason\w*|pattern\w*|anomal\w*)\b", re.IGNORECASE)
+
+Route = namedtuple('Route', ['name', 'model_id', 'task', 'input_tokens', 'reason'])
+
+_lock = threading.Lock()
+_latencies = defaultdict(lambda: deque(maxlen=LATENCY_SAMPLES))    # (task, route name) -> seconds
+
+
+def route(task, input_tokens, question='', model_id=None):
+    # Pick the model for a request of this task type and estimated input size
+    if model_id:
+        return Route('pinned', model_id, task, input_tokens, "model requested by caller")
+    tier = TIERS.index(BASE_TIER.get(task, 'standard'))
+    reasons = [f"{task} task"]
+    if tier == 0 and input_tokens > SMALL_TOKENS:
+        tier += 1
+        reasons.append(f"over {SMALL_TOKENS} input tokens")
+    if input_tokens > LARGE_TOKENS:
+        tier = min(tier + 1, len(TIERS) - 1)
+        reasons.append(f"over {LARGE_TOKENS} input tokens")
+    elif question and COMPLEX_QUESTION.search(question):
+        tier = min(tier + 1, len(TIERS) - 1)
+        reasons.append("analytical question")
+    name = TIERS[tier]
+    chosen = Route(name, MODELS[name], task, input_tokens, ", ".join(reasons))
+    logging.debug(f"Routed to {name} ({chosen.model_id}): {chosen.reason}, ~{input_tokens} tokens")
+    return chosen
+
+
+def route_prompt(task, prompt, question=None, model_id=None):
+    # Same as route() for a prompt string; the question (without the table) decides complexity
+    return route(task, tokens.estimate_tokens(prompt), question if question is not None else prompt, model_id)
+
+
+def record(chosen, started, response=None):
+    # Log and keep the latency of a call made on this route; cached responses are skipped
+    if response is not None and response.get('cache') in ('memory', 'disk'):
+        return
+    elapsed = time.perf_counter() - started
+    with _lock:
+        _latencies[(chosen.task, chosen.name)].append(elapsed)
+    logging.info(f"Route {chosen.task}/{chosen.name} ({chosen.model_id}, ~{chosen.input_tokens} tokens): {elapsed:.2f}s")
+
+
+def stats():
+    # Per task and route: call count and latency percentiles in seconds
+    with _lock:
+        samples = {key: sorted(values) for key, values in _latencies.items()}
+    return {
+        f"{task}/{name}": {
+            'count': len(values),
+            'mean': sum(values) / len(values),
+            'p50': values[len(values) // 2],
+            'p95': values[min(len(values) - 1, int(len(values) * 0.95))],
+        }
+        for (task, name), values in samples.items() if values
+    }
@@ -0,0 +1,267 @@
+# Parsed-table cache for spreadsheets fetched from S3.
+#
+# Tables are keyed by (bucket, key, ETag) plus which sheets were parsed. The
+# in-process LRU tier lives at module level so it survives warm Lambda
+# invocations and Streamlit reruns; the optional disk tier (TABLE_CACHE_DIR,
+# e.g. /tmp/table-cache) survives process restarts on the same host. Once an
+# ETag is known, revalidation is a single conditional GET with If-None-Match
+# that returns 304 without a body when the object is unchanged. Large objects
+# are downloaded in parallel ranged parts while they are parsed (s3stream.py).
+#
+# Below the local tiers, a Parquet sidecar next to the object (sidecar.py) is
+# shared by every process: the first parse writes it, later misses read it, and
+# only the requested columns of it when columns are given. With sidecars on,
+# revalidation is a HEAD instead, so a changed object's sidecar is found
+# before anything is downloaded.
+
+import hashlib
+import logging
+import os
+import pickle
+import threading
+from collections import OrderedDict
+
+from botocore.exceptions import ClientError
+
+import ingest
+import s3stream
+import sidecar
+import tracing
+
+MEMORY_ENTRIES = int(os.environ.get('TABLE_CACHE_SIZE', '8'))
+DISK_DIR = os.environ.get('TABLE_CACHE_DIR', '')
+DISK_MAX_BYTES = int(os.environ.get('TABLE_CACHE_DISK_BYTES', str(256 * 1024 * 1024)))
+
+_lock = threading.Lock()
+_memory = OrderedDict()    # (bucket, key, etag, variant) -> Table or {sheet: Table}
+_latest_etag = {}          # (bucket, key) -> last ETag seen
+_stats = {
+    'memory_hits': 0,
+    'disk_hits': 0,
+    'not_modified': 0,
+    'misses': 0,
+    'sidecar_hits': 0,
+    'disk_evictions': 0,
+}
+
+
+def stats():
+    # Snapshot of the hit/miss counters for logging or metrics scraping
+    with _lock:
+        counters = dict(_stats)
+        counters['memory_entries'] = len(_memory)
+    lookups = counters['memory_hits'] + counters['disk_hits'] + counters['misses']
+    counters['hit_rate'] = (lookups - counters['misses']) / lookups if lookups else 0.0
+    return counters
+
+
+def clear():
+    with _lock:
+        _memory.clear()
+        _latest_etag.clear()
+        for name in _stats:
+            _stats[name] = 0
+
+
+def _count(name):
+    with _lock:
+        _stats[name] += 1
+
+
+def _memory_get(cache_key):
+    with _lock:
+        table = _memory.get(cache_key)
+        if table is not None:
+            _memory.move_to_end(cache_key)
+        return table
+
+
+def _memory_put(cache_key, table):
+    with _lock:
+        _memory[cache_key] = table
+        _memory.move_to_end(cache_key)
+        _latest_etag[cache_key[:2]] = cache_key[2]
+        while len(_memory) > MEMORY_ENTRIES:
+            _memory.popitem(last=False)
+
+
+def _disk_path(cache_key):
+    digest = hashlib.sha256("/".join(cache_key).encode('utf-8')).hexdigest()
+    return os.path.join(DISK_DIR, digest + '.pkl')
+
+
+def _disk_get(cache_key):
+    if not DISK_DIR:
+        return None
+    path = _disk_path(cache_key)
+    try:
+        with open(path, 'rb') as f:
+            table = pickle.load(f)
+        # Refresh the mtime so eviction drops the least recently used files first
+        os.utime(path)
+        return table
+    except FileNotFoundError:
+        return None
+    except Exception as e:
+        logging.warning(f"Discarding unreadable table cache file {path}: {e}")
+        return None
+
+
+def _disk_put(cache_key, table):
+    if not DISK_DIR:
+        return
+    os.makedirs(DISK_DIR, exist_ok=True)
+    path = _disk_path(cache_key)
+    tmp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+    with open(tmp_path, 'wb') as f:
+        pickle.dump(table, f, protocol=pickle.HIGHEST_PROTOCOL)
+    os.replace(tmp_path, path)
+    _disk_evict()
+
+
+def _disk_evict():
+    entries = []
+    for name in os.listdir(DISK_DIR):
+        if name.endswith('.pkl'):
+            path = os.path.join(DISK_DIR, name)
+            try:
+                st = os.stat(path)
+            except FileNotFoundError:
+                continue
+            entries.append((st.st_mtime, st.st_size, path))
+    total = sum(size for _, size, _ in entries)
+    for _, size, path in sorted(entries):
+        if total <= DISK_MAX_BYTES:
+            break
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
+        total -= size
+        _count('disk_evictions')
+
+
+def _is_not_modified(error):
+    status = error.response.get('ResponseMetadata', {}).get('HTTPStatusCode')
+    return status == 304 or error.response.get('Error', {}).get('Code') in ('304', 'NotModified')
+
+
+def _sidecar_get(cache_key, from_sidecar):
+    # The sidecar's value for this version of the object, kept in the local tiers too; None on a miss
+    if not sidecar.ENABLED or from_sidecar is None:
+        return None
+    with tracing.span('sidecar'):
+        value = from_sidecar(cache_key[2])
+    if value is not None:
+        _count('sidecar_hits')
+        tracing.count('table_cache_hits')
+        _memory_put(cache_key, value)
+        _disk_put(cache_key, value)
+    return value
+
+
+def _cached(cache_key, from_sidecar):
+    # The value for this version of the object from memory, disk or the sidecar; None on a miss
+    value = _memory_get(cache_key)
+    if value is not None:
+        _count('memory_hits')
+        tracing.count('table_cache_hits')
+        return value
+    value = _disk_get(cache_key)
+    if value is not None:
+        _count('disk_hits')
+        tracing.count('table_cache_hits')
+        _memory_put(cache_key, value)
+        return value
+    return _sidecar_get(cache_key, from_sidecar)
+
+
+def _get(s3_client, bucket_name, file_key, variant, load, from_sidecar=None):
+    # Shared lookup: variant distinguishes different parses of the same object; load(body, etag)
+    # parses the object and from_sidecar(etag) returns the sidecar's value or None
+    etag = _latest_etag.get((bucket_name, file_key))
+
+    if (sidecar.ENABLED and from_sidecar is not None) or (etag is None and DISK_DIR):
+        # A HEAD gives the current ETag, so the local tiers and the sidecar are looked up
+        # under it without starting a download that might not be needed: on a cold process,
+        # and with sidecars whenever the object may have changed since this process saw it
+        with tracing.span('s3_get'):
+            head_etag = s3_client.head_object(Bucket=bucket_name, Key=file_key)['ETag']
+        if head_etag == etag:
+            _count('not_modified')
+        value = _cached((bucket_name, file_key, head_etag, variant), from_sidecar)
+        if value is not None:
+            return value
+        etag = None
+
+    request = {'Bucket': bucket_name, 'Key': file_key}
+    if etag is not None:
+        request['IfNoneMatch'] = etag
+    try:
+        with tracing.span('s3_get'):
+            s3_object = s3_client.get_object(**request)
+    except ClientError as e:
+        if not _is_not_modified(e):
+            raise
+        _count('not_modified')
+        value = _cached((bucket_name, file_key, etag, variant), from_sidecar)
+        if value is not None:
+            return value
+        # Not cached for this variant (or evicted); fetch the object unconditionally
+        with tracing.span('s3_get'):
+            s3_object = s3_client.get_object(Bucket=bucket_name, Key=file_key)
+
+    _count('misses')
+    etag = s3_object['ETag']
+    cache_key = (bucket_name, file_key, etag, variant)
+    tracing.count('s3_bytes', s3_object.get('ContentLength', 0))
+    # The body is streamed while parsing, so this includes the rest of the download
+    body = s3stream.open_body(s3_client, bucket_name, file_key, s3_object)
+    try:
+        with tracing.span('parse'):
+            value = load(body, etag)
+    finally:
+        body.close()
+    _memory_put(cache_key, value)
+    _disk_put(cache_key, value)
+    logging.debug(f"Table cache miss for s3://{bucket_name}/{file_key}: {stats()}")
+    return value
+
+
+def _variant(name, columns):
+    return name if columns is None else f"{name}|columns:" + "|".join(map(str, columns))
+
+
+def get_table(s3_client, bucket_name, file_key, filetype=None, sheet_name=None, columns=None):
+    # Return the parsed table for an S3 object, fetching and parsing only when it changed;
+    # columns (header names) limits it to those columns
+    filetype = filetype or file_key.split('.')[-1]
+
+    def from_sidecar(etag):
+        tables = sidecar.read_tables(s3_client, bucket_name, file_key, etag,
+                                     None if sheet_name is None else [sheet_name], columns)
+        return None if tables is None else tables[sheet_name]
+
+    def load(body, etag):
+        table = ingest.load_table(body, filetype, sheet_name)
+        if sidecar.ENABLED:
+            sidecar.write_tables(s3_client, bucket_name, file_key, etag, {sheet_name: table})
+        return table if columns is None else table.select(columns)
+
+    return _get(s3_client, bucket_name, file_key, _variant(sheet_name or '', columns), load, from_sidecar)
+
+
+def get_sheets(s3_client, bucket_name, file_key, sheets=None, columns=None):
+    # Same as get_table for several sheets ('all' or a list of names); returns {sheet name: table}
+    if sheets is None:
+        return {None: get_table(s3_client, bucket_name, file_key, columns=columns)}
+
+    def load(body, etag):
+        tables = ingest.load_sheets(body.read(), sheets)
+        if sidecar.ENABLED:
+            sidecar.write_tables(s3_client, bucket_name, file_key, etag, tables, all_sheets=sheets == 'all')
+        return tables if columns is None else {name: table.select(columns) for name, table in tables.items()}
+
+    variant = 'sheets:' + (sheets if sheets == 'all' else '|'.join(sheets))
+    return _get(s3_client, bucket_name, file_key, _variant(variant, columns), load,
+                lambda etag: sidecar.read_tables(s3_client, bucket_name, file_key, etag, sheets, columns))
@@ -0,0 +1,125 @@
+# Cached, paginated S3 key listings for the file pickers.
+#
+# list_keys() pages through list_objects_v2 to the end of the prefix (a single
+# call stops at 1,000 keys) and keeps the sorted keys per bucket and prefix for
+# S3_LIST_TTL seconds, so a Streamlit rerun costs a dict lookup instead of a
+# round trip per page. A longer prefix is answered from a cached listing of a
+# shorter one by bisecting its sorted keys, and extension filters (xlsx, csv)
+# are applied client-side and remembered per listing. refresh=True, or
+# invalidate(), drops a bucket's listings after uploads.
+
+import bisect
+import logging
+import os
+import threading
+import time
+from collections import OrderedDict
+
+TTL_SECONDS = float(os.environ.get('S3_LIST_TTL', '300'))
+MAX_LISTINGS = 32         # (bucket, prefix) listings kept
+MAX_VIEWS = 64            # filtered views kept per listing
+
+_lock = threading.Lock()
+_listings = OrderedDict()    # (bucket, prefix) -> _Listing
+_stats = {
+    'hits': 0,
+    'misses': 0,
+    'pages': 0,
+}
+
+
+class _Listing:
+    __slots__ = ('keys', 'created', 'views')
+
+    def __init__(self, keys, created):
+        self.keys = keys
+        self.created = created
+        self.views = {}    # (prefix, suffixes) -> tuple of keys
+
+
+def stats():
+    with _lock:
+        counters = dict(_stats)
+        counters['listings'] = len(_listings)
+        counters['keys'] = sum(len(listing.keys) for listing in _listings.values())
+    return counters
+
+
+def invalidate(bucket_name=None):
+    # Drop the listings of one bucket, or of every bucket
+    with _lock:
+        for cache_key in [k for k in _listings if bucket_name is None or k[0] == bucket_name]:
+            del _listings[cache_key]
+
+
+def _count(name, amount=1):
+    with _lock:
+        _stats[name] += amount
+
+
+def _fetch(s3_client, bucket_name, prefix):
+    keys = []
+    pages = 0
+    for page in s3_client.get_paginator('list_objects_v2').paginate(Bucket=bucket_name, Prefix=prefix):
+        pages += 1
+        keys.extend(obj['Key'] for obj in page.get('Contents', ()) if not obj['Key'].endswith('/'))
+    _count('pages', pages)
+    # S3 returns UTF-8 binary order, which is code point order; sorting an already sorted list is linear
+    keys.sort()
+    logging.debug(f"Listed {len(keys)} keys in s3://{bucket_name}/{prefix} ({pages} pages)")
+    return keys
+
+
+def _cached(bucket_name, prefix, now):
+    # The freshest listing covering prefix, preferring the longest cached prefix of it
+    best = None
+    with _lock:
+        for (bucket, cached_prefix), listing in list(_listings.items()):
+            if now - listing.created > TTL_SECONDS:
+                del _listings[(bucket, cached_prefix)]
+            elif bucket == bucket_name and prefix.startswith(cached_prefix):
+                if best is None or len(cached_prefix) > len(best[0]):
+                    best = (cached_prefix, listing)
+        if best is not None:
+            _listings.move_to_end((bucket_name, best[0]))
+    return best
+
+
+def _prefix_range(keys, prefix):
+    if not prefix:
+        return keys
+    return keys[bisect.bisect_left(keys, prefix):bisect.bisect_left(keys, prefix + '\U0010ffff')]
+
+
+def list_keys(s3_client, bucket_name, prefix='', extensions=None, refresh=False):
+    # Sorted keys under prefix as a tuple, optionally only those with one of the extensions
+    # (e.g. ('xlsx', 'csv'), case-insensitive)
+    if refresh:
+        invalidate(bucket_name)
+    now = time.monotonic()
+    cached = _cached(bucket_name, prefix, now)
+    if cached is None:
+        _count('misses')
+        listing = _Listing(_fetch(s3_client, bucket_name, prefix), now)
+        with _lock:
+            _listings[(bucket_name, prefix)] = listing
+            while len(_listings) > MAX_LISTINGS:
+                _listings.popitem(last=False)
+    else:
+        _count('hits')
+        listing = cached[1]
+
+    suffixes = tuple('.' + extension.lower().lstrip('.') for extension in extensions) if extensions else None
+    view_key = (prefix, suffixes)
+    with _lock:
+        keys = listing.views.get(view_key)
+    if keys is None:
+        keys = _prefix_range(listing.keys, prefix)
+        if suffixes:
+            keys = [key for key in keys if key.lower().endswith(suffixes)]
+        keys = tuple(keys)
+        with _lock:
+            if len(listing.views) >= MAX_VIEWS:
+                listing.views.clear()
+            listing.views[view_key] = keys
+    return keys
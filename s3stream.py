@@ -0,0 +1,170 @@
+# Parallel ranged downloads for large S3 objects.
+#
+# One GET streams at whatever a single connection manages. For objects of at
+# least S3_PARALLEL_MIN_BYTES, open_body() keeps streaming the first
+# S3_PART_BYTES from the GET already made and fetches the rest as ranged GETs on
+# S3_READ_CONCURRENCY threads, pinned to the object's ETag with If-Match so a
+# concurrent overwrite fails instead of mixing versions. The result is a binary
+# stream that returns the bytes in order, so a streaming parser (CSV, via
+# ingest.iter_csv_rows) starts on the first part while later ones are still
+# downloading. At most S3_READ_CONCURRENCY parts are buffered ahead of the
+# reader, which bounds memory however large the object is.
+#
+# ObjectFile is the random-access counterpart: a seekable file whose reads are
+# ranged GETs, for formats such as Parquet that read a footer and then only the
+# parts they need.
+
+import contextlib
+import io
+import os
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+PART_BYTES = int(os.environ.get('S3_PART_BYTES', str(8 * 1024 * 1024)))
+CONCURRENCY = int(os.environ.get('S3_READ_CONCURRENCY', '8'))
+PARALLEL_MIN_BYTES = int(os.environ.get('S3_PARALLEL_MIN_BYTES', str(2 * PART_BYTES)))
+
+
+class RangedReader(io.RawIOBase):
+    def __init__(self, s3_client, bucket_name, file_key, size, etag, first_body=None,
+                 part_bytes=PART_BYTES, concurrency=CONCURRENCY):
+        self.s3_client = s3_client
+        self.bucket_name = bucket_name
+        self.file_key = file_key
+        self.size = size
+        self.etag = etag
+        self.part_bytes = part_bytes
+        self.concurrency = concurrency
+        self._starts = range(0, size, part_bytes)
+        self._next = 0
+        # The first part comes from the body of the original GET, when there is one
+        self._first = None
+        self._first_left = 0
+        if first_body is not None and size:
+            self._first = first_body
+            self._first_left = min(part_bytes, size)
+            self._next = 1
+        self._current = memoryview(b'')
+        self._pending = deque()    # futures for the following parts, in order
+        self._pool = ThreadPoolExecutor(max_workers=max(1, concurrency))
+        self._submit()
+
+    def _fetch(self, start):
+        end = min(start + self.part_bytes, self.size) - 1
+        response = self.s3_client.get_object(Bucket=self.bucket_name, Key=self.file_key,
+                                             Range=f"bytes={start}-{end}", IfMatch=self.etag)
+        data = response['Body'].read()
+        if len(data) != end - start + 1:
+            raise IOError(f"Short read of s3://{self.bucket_name}/{self.file_key} bytes {start}-{end}: {len(data)} bytes")
+        return data
+
+    def _submit(self):
+        while self._next < len(self._starts) and len(self._pending) < self.concurrency:
+            self._pending.append(self._pool.submit(self._fetch, self._starts[self._next]))
+            self._next += 1
+
+    def _close_first(self):
+        if self._first is not None:
+            # Stops the original GET's transfer; its connection is not reused
+            self._first.close()
+            self._first = None
+
+    def _chunk(self, limit):
+        # Next bytes in order, at most limit of them (None: as many as are at hand); b'' at the end
+        if self._first is not None:
+            data = self._first.read(self._first_left if limit is None else min(limit, self._first_left))
+            if not data:
+                raise IOError(f"Short read of s3://{self.bucket_name}/{self.file_key}: "
+                              f"{self._first_left} bytes missing from the first part")
+            self._first_left -= len(data)
+            if not self._first_left:
+                self._close_first()
+            return data
+        if not self._current:
+            if not self._pending:
+                return b''
+            self._current = memoryview(self._pending.popleft().result())
+            self._submit()
+        n = len(self._current) if limit is None else min(limit, len(self._current))
+        data = self._current[:n]
+        self._current = self._current[n:]
+        return data
+
+    def readable(self):
+        return True
+
+    def readinto(self, buffer):
+        data = self._chunk(len(buffer))
+        buffer[:len(data)] = data
+        return len(data)
+
+    def readall(self):
+        # Whole parts at a time rather than RawIOBase's small reads
+        chunks = []
+        while True:
+            data = self._chunk(None)
+            if not data:
+                return b"".join(chunks)
+            chunks.append(data)
+
+    def close(self):
+        if not self.closed:
+            for future in self._pending:
+                future.cancel()
+            self._pending.clear()
+            self._pool.shutdown(wait=False)
+            self._close_first()
+        super().close()
+
+
+class ObjectFile(io.RawIOBase):
+    # Seekable, read-only view of one version of an S3 object; every read is one ranged GET
+    def __init__(self, s3_client, bucket_name, file_key, size, etag):
+        self.s3_client = s3_client
+        self.bucket_name = bucket_name
+        self.file_key = file_key
+        self.size = size
+        self.etag = etag
+        self.requests = 0
+        self._position = 0
+
+    def readable(self):
+        return True
+
+    def seekable(self):
+        return True
+
+    def tell(self):
+        return self._position
+
+    def seek(self, offset, whence=io.SEEK_SET):
+        base = {io.SEEK_SET: 0, io.SEEK_CUR: self._position, io.SEEK_END: self.size}[whence]
+        self._position = max(0, base + offset)
+        return self._position
+
+    def readinto(self, buffer):
+        end = min(self._position + len(buffer), self.size)
+        if end <= self._position:
+            return 0
+        response = self.s3_client.get_object(Bucket=self.bucket_name, Key=self.file_key,
+                                             Range=f"bytes={self._position}-{end - 1}", IfMatch=self.etag)
+        data = response['Body'].read()
+        self.requests += 1
+        buffer[:len(data)] = data
+        self._position += len(data)
+        return len(data)
+
+
+def open_body(s3_client, bucket_name, file_key, s3_object):
+    # Body stream for a get_object response: as it is for small objects, a RangedReader for large ones
+    size = s3_object.get('ContentLength', 0)
+    if size < PARALLEL_MIN_BYTES or 'ContentRange' in s3_object:
+        return s3_object['Body']
+    return RangedReader(s3_client, bucket_name, file_key, size, s3_object['ETag'], s3_object['Body'])
+
+
+def read_object(s3_client, bucket_name, file_key):
+    # Whole object as bytes, downloaded in parallel parts when it is large
+    s3_object = s3_client.get_object(Bucket=bucket_name, Key=file_key)
+    with contextlib.closing(open_body(s3_client, bucket_name, file_key, s3_object)) as body:
+        return body.read()
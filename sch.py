@@ -1,19 +1,28 @@
-# Use the Converse API to send a text message to Claude 3 Sonnet.
-
-import boto3
+# Long-document question answering with the Converse API and Claude 3 Sonnet.
+#
+# The model is asked for numbered quotes from the document followed by an answer.
+# ask_document() streams the reply with converse_stream and parses it as it
+# arrives, yielding each quote as soon as it is complete, then the answer text
+# (as deltas and in full), then token usage and latency.
+
+import re
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import clients
+import ratelimit
+import router
 from botocore.exceptions import ClientError
 
-# Create a Bedrock Runtime client in the AWS Region you want to use.
-client = boto3.client("bedrock-runtime", region_name="us-east-1")
-
 # Set the model ID, e.g., Titan Text Premier.
 model_id = "anthropic.claude-3-sonnet-20240229-v1:0"
 
-# Start a conversation with the user message.
-user_message = """I'm going to give you a document. Then I'm going to ask you a question about it. I'd like you to first write down exact quotes of parts of the document that would help answer the question, and then I'd like you to answer the question using facts from the quoted content. Here is the document:
+# Converse cache points need a model with prompt caching (Claude 3.7 Sonnet via its inference profile)
+CACHE_MODEL_ID = "us.anthropic.claude-3-7-sonnet-20250219-v1:0"
 
-<document>
-Anthropic: Challenges in evaluating AI systems
+DOCUMENT = """Anthropic: Challenges in evaluating AI systems
 
 Introduction
 Most conversations around the societal impacts of artificial intelligence (AI) come down to discussing some quality of an AI system, such as its truthfulness, fairness, potential for misuse, and so on. We are able to talk about these characteristics because we can technically evaluate models for their performance in these areas. But what many people working inside and outside of AI don’t fully appreciate is how difficult it is to build robust and reliable model evaluations. Many of today’s existing evaluation suites are limited in their ability to serve as accurate indicators of model capabilities or safety.
@@ -132,7 +141,13 @@ Increase funding for government agencies focused on evaluations, such as the Nat
 Create a legal safe harbor allowing companies to work with governments and third-parties to rigorously evaluate models for national security risks—such as those in the chemical, biological, radiological and nuclear defense (CBRN) domains—without legal repercussions, in the interest of improving safety. This could also include a “responsible disclosure protocol” that enables labs to share sensitive information about identified risks.
 
 Conclusion
-We hope that by openly sharing our experiences evaluating our own systems across many different dimensions, we can help people interested in AI policy acknowledge challenges with current model evaluations.
+We hope that by openly sharing our experiences evaluating our own systems across many different dimensions, we can help people interested in AI policy acknowledge challenges with current model evaluations."""
+
+# The document and instructions form a fixed prefix that can be cached across questions
+PREFIX = """I'm going to give you a document. Then I'm going to ask you a question about it. I'd like you to first write down exact quotes of parts of the document that would help answer the question, and then I'd like you to answer the question using facts from the quoted content. Here is the document:
+
+<document>
+{document}
 </document>
 
 First, find the quotes from the document that are most relevant to answering the question, and then print them in numbered order. Quotes should be relatively short.
@@ -152,31 +167,260 @@ Answer:
 Company X earned $12 million. [1]  Almost 90% of it was from widget sales. [2]
 </example>
 
-Here is the first question: In bullet points and simple terms, what are the key challenges in evaluating AI systems?
+"""
+
+QUESTION_PROMPT = """Here is the first question: {question}
 
 If the question cannot be answered by the document, say so.
 
 Answer the question immediately without preamble."""
-conversation = [
-    {
-        "role": "user",
-        "content": [{"text": user_message}],
-    }
-]
-
-try:
-    # Send the message to the model, using a basic inference configuration.
-    response = client.converse(
-        modelId="anthropic.claude-3-sonnet-20240229-v1:0",
+
+PROMPT = PREFIX + QUESTION_PROMPT
+
+QUESTION = "In bullet points and simple terms, what are the key challenges in evaluating AI systems?"
+
+ANSWER_MARKER = "Answer:"
+NO_QUOTES = "No relevant quotes"
+QUOTE_LINE = re.compile(r"\[(\d+)\]\s*(.*)")
+QUOTE_MARKS = "\"\u201c\u201d"
+
+
+class QuoteAnswerParser:
+    # Incremental parser for the "Relevant quotes: [n] ... Answer: ..." reply format.
+    # feed() takes text deltas and returns the events completed by them.
+    def __init__(self):
+        self.quotes = []
+        self._buffer = ""
+        self._raw = []
+        self._quote = None  # [number, text] of a quote that may continue on the next line
+        self._answer = None  # answer parts once the "Answer:" line has been seen
+
+    def feed(self, text):
+        self._raw.append(text)
+        if self._answer is not None:
+            return self._answer_delta(text)
+        events = []
+        self._buffer += text
+        while self._answer is None:
+            line, newline, rest = self._buffer.partition("\n")
+            if line.lstrip().startswith(ANSWER_MARKER):
+                events.extend(self._flush_quote())
+                self._answer = []
+                self._buffer = ""
+                events.extend(self._answer_delta(line.lstrip()[len(ANSWER_MARKER):] + newline + rest))
+                break
+            if not newline:
+                break
+            self._buffer = rest
+            events.extend(self._line(line.strip()))
+        return events
+
+    def close(self):
+        # Flush what is left once the stream ends and return the final events
+        events = []
+        if self._answer is None:
+            events.extend(self._line(self._buffer.strip()))
+            events.extend(self._flush_quote())
+        # Without an "Answer:" section the whole reply is the answer
+        answer = "".join(self._answer) if self._answer is not None else "".join(self._raw)
+        events.append({'type': 'answer', 'text': answer.strip(), 'quotes': self.quotes})
+        return events
+
+    def _line(self, line):
+        if not line:
+            return self._flush_quote()
+        match = QUOTE_LINE.match(line)
+        if match:
+            events = self._flush_quote()
+            self._quote = [int(match.group(1)), match.group(2)]
+        elif line.lower().startswith(NO_QUOTES.lower()):
+            return self._flush_quote() + [{'type': 'no_quotes'}]
+        elif self._quote is not None:
+            events = []
+            self._quote[1] += " " + line
+        else:
+            return []
+        # A quote is complete once its closing quotation mark arrives
+        text = self._quote[1]
+        if len(text) > 1 and text[0] in QUOTE_MARKS and text[-1] in QUOTE_MARKS:
+            events.extend(self._flush_quote())
+        return events
+
+    def _flush_quote(self):
+        if self._quote is None:
+            return []
+        number, text = self._quote
+        self._quote = None
+        quote = {'type': 'quote', 'number': number, 'text': text.strip().strip(QUOTE_MARKS)}
+        self.quotes.append(quote)
+        return [quote]
+
+    def _answer_delta(self, text):
+        # Drop the whitespace between "Answer:" and the first word
+        if not self._answer:
+            text = text.lstrip()
+            if not text:
+                return []
+        self._answer.append(text)
+        return [{'type': 'answer_delta', 'text': text}]
+
+
+def ask_document(client, question, document=DOCUMENT, model_id=None, max_tokens=2000, temperature=0, top_k=250):
+    # Yields quote, no_quotes, answer_delta and answer events as the reply streams in,
+    # then a metadata event with usage, stop reason and latency. Without model_id the
+    # router picks the model from the document size and the question
+    prompt = PROMPT.format(document=document, question=question)
+    route = router.route_prompt('document', prompt, question, model_id)
+    conversation = [
+        {
+            "role": "user",
+            "content": [{"text": prompt}],
+        }
+    ]
+    started = time.perf_counter()
+    response = ratelimit.converse(
+        client,
+        'converse_stream',
+        modelId=route.model_id,
         messages=conversation,
-        inferenceConfig={"maxTokens":2000,"temperature":0},
-        additionalModelRequestFields={"top_k":250}
+        inferenceConfig={"maxTokens": max_tokens, "temperature": temperature},
+        additionalModelRequestFields={"top_k": top_k}
     )
 
-    # Extract and print the response text.
-    response_text = response["output"]["message"]["content"][0]["text"]
-    print(response_text)
-
-except (ClientError, Exception) as e:
-    print(f"ERROR: Can't invoke '{model_id}'. Reason: {e}")
-    exit(1)
+    parser = QuoteAnswerParser()
+    metadata = {'type': 'metadata', 'usage': {}, 'metrics': {}, 'stop_reason': None, 'time_to_first_token': None}
+    for event in response["stream"]:
+        if "contentBlockDelta" in event:
+            text = event["contentBlockDelta"]["delta"].get("text", "")
+            if text and metadata['time_to_first_token'] is None:
+                metadata['time_to_first_token'] = time.perf_counter() - started
+            yield from parser.feed(text)
+        elif "messageStop" in event:
+            metadata['stop_reason'] = event["messageStop"].get("stopReason")
+        elif "metadata" in event:
+            metadata['usage'] = event["metadata"].get("usage", {})
+            metadata['metrics'] = event["metadata"].get("metrics", {})
+    yield from parser.close()
+    metadata['total_latency'] = time.perf_counter() - started
+    metadata['model_id'] = route.model_id
+    router.record(route, started)
+    yield metadata
+
+
+USAGE_FIELDS = ('inputTokens', 'outputTokens', 'cacheReadInputTokens', 'cacheWriteInputTokens')
+
+
+class DocumentSession:
+    # Several questions over one document. The document and instructions sit before a
+    # Converse cache point, so after the first call the model reads them from the prompt
+    # cache instead of reprocessing them; only the question after the cache point is new.
+    def __init__(self, client, document=DOCUMENT, model_id=CACHE_MODEL_ID, max_tokens=2000, temperature=0, top_k=250):
+        self.client = client
+        self.model_id = model_id
+        self.max_tokens = max_tokens
+        self.temperature = temperature
+        self.top_k = top_k
+        self.prefix = PREFIX.format(document=document)
+        self.usage = dict.fromkeys(USAGE_FIELDS, 0)
+        self.calls = 0
+        self._lock = threading.Lock()
+
+    def messages(self, question):
+        return [
+            {
+                "role": "user",
+                "content": [
+                    {"text": self.prefix},
+                    {"cachePoint": {"type": "default"}},
+                    {"text": QUESTION_PROMPT.format(question=question)},
+                ],
+            }
+        ]
+
+    def ask(self, question):
+        # Returns the parsed quotes and answer with this call's usage, including cache reads/writes
+        started = time.perf_counter()
+        response = ratelimit.converse(
+            self.client,
+            modelId=self.model_id,
+            messages=self.messages(question),
+            inferenceConfig={"maxTokens": self.max_tokens, "temperature": self.temperature},
+            additionalModelRequestFields={"top_k": self.top_k}
+        )
+        parser = QuoteAnswerParser()
+        parser.feed("".join(part.get("text", "") for part in response["output"]["message"]["content"]))
+        answer = parser.close()[-1]
+        usage = {name: response.get("usage", {}).get(name, 0) for name in USAGE_FIELDS}
+        with self._lock:
+            self.calls += 1
+            for name in USAGE_FIELDS:
+                self.usage[name] += usage[name]
+        return {
+            'question': question,
+            'answer': answer['text'],
+            'quotes': answer['quotes'],
+            'usage': usage,
+            'stop_reason': response.get("stopReason"),
+            'latency': time.perf_counter() - started,
+        }
+
+    def ask_all(self, questions, concurrency=1):
+        # Sequential by default; with concurrency > 1 the first question warms the cache
+        # before the rest run in parallel, so they all read the prefix instead of writing it
+        questions = list(questions)
+        if concurrency <= 1 or len(questions) < 2:
+            return [self.ask(question) for question in questions]
+        results = [self.ask(questions[0])]
+        with ThreadPoolExecutor(max_workers=min(concurrency, len(questions) - 1)) as pool:
+            results.extend(pool.map(self.ask, questions[1:]))
+        return results
+
+    def stats(self):
+        # Totals so far and the share of prompt tokens served from the cache
+        with self._lock:
+            totals = dict(self.usage, calls=self.calls)
+        prompt_tokens = totals['inputTokens'] + totals['cacheReadInputTokens'] + totals['cacheWriteInputTokens']
+        totals['cache_read_share'] = totals['cacheReadInputTokens'] / prompt_tokens if prompt_tokens else 0.0
+        return totals
+
+
+if __name__ == "__main__":
+    # Shared Bedrock Runtime client in the AWS Region you want to use.
+    client = clients.bedrock_runtime()
+
+    if len(sys.argv) > 1:
+        # Several questions: answer them in one session that reuses the cached document
+        session = DocumentSession(client)
+        try:
+            for result in session.ask_all(sys.argv[1:]):
+                print(f"Q: {result['question']}\n{result['answer']}\nUsage: {result['usage']}\n")
+        except (ClientError, Exception) as e:
+            print(f"ERROR: Can't invoke '{session.model_id}'. Reason: {e}")
+            exit(1)
+        print(f"Session usage: {session.stats()}")
+        exit(0)
+
+    # Routed here so an error names the model that was actually called
+    route = router.route_prompt('document', PROMPT.format(document=DOCUMENT, question=QUESTION), QUESTION)
+    try:
+        # Print each quote as soon as it is complete, then the answer as it streams
+        answer_started = False
+        for event in ask_document(client, QUESTION, model_id=route.model_id):
+            if event['type'] == 'quote':
+                print(f"[{event['number']}] {event['text']}", flush=True)
+            elif event['type'] == 'no_quotes':
+                print(NO_QUOTES, flush=True)
+            elif event['type'] == 'answer_delta':
+                if not answer_started:
+                    print("\nAnswer:", flush=True)
+                    answer_started = True
+                print(event['text'], end="", flush=True)
+            elif event['type'] == 'answer' and not answer_started:
+                print("\nAnswer:\n" + event['text'])
+            elif event['type'] == 'metadata':
+                print(f"\n\nTokens: {event['usage']}, time to first token: "
+                      f"{event['time_to_first_token'] or 0:.2f} s, total: {event['total_latency']:.2f} s")
+
+    except (ClientError, Exception) as e:
+        print(f"ERROR: Can't invoke '{route.model_id}'. Reason: {e}")
+        exit(1)
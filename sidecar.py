@@ -0,0 +1,169 @@
+# Parquet sidecars for spreadsheets in S3.
+#
+# Parsing an XLSX with openpyxl is by far the slowest step of a request. The
+# first time a sheet of an S3 workbook (or a CSV) is parsed, s3cache writes it
+# as Parquet next to the source:
+#
+#     s3://bucket/<key>.<etag>.parquet/<sheet>.parquet
+#
+# plus _sheets.json with the sheet names when the whole workbook was read. The
+# ETag is part of the key, so a changed source never matches an old sidecar,
+# and any process (a cold Lambda, another Streamlit host) reads the sidecar
+# instead of the source from then on. With columns given, only the footer and
+# those column chunks are fetched, through ranged GETs.
+#
+# Column names and kinds are stored in the Parquet schema metadata, so the
+# table read back is the table that was parsed. TABLE_SIDECAR=0 turns sidecars
+# off, and they are off without pyarrow. Write failures (e.g. no s3:PutObject
+# on the bucket) are logged and otherwise ignored.
+
+import contextlib
+import io
+import json
+import logging
+import os
+from urllib.parse import quote
+
+from botocore.exceptions import ClientError
+
+import ingest
+import s3stream
+
+try:
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+except ImportError:
+    pa = None
+
+ENABLED = os.environ.get('TABLE_SIDECAR', '1') != '0' and pa is not None
+COMPRESSION = os.environ.get('TABLE_SIDECAR_COMPRESSION', 'zstd')
+ACTIVE_SHEET = '_active'
+SHEETS_MANIFEST = '_sheets.json'
+
+NUMPY_KINDS = {'int': 'int64', 'float': 'float64', 'bool': 'bool'}
+ARROW_TYPES = {'int': 'int64', 'float': 'float64', 'bool': 'bool_', 'str': 'string'}
+FILL = {'int': 0, 'float': 0.0, 'bool': False, 'str': ''}
+
+
+def prefix(file_key, etag):
+    return file_key + '.' + etag.strip('"') + '.parquet/'
+
+
+def sheet_key(file_key, etag, sheet_name):
+    name = ACTIVE_SHEET if sheet_name is None else quote(str(sheet_name), safe='')
+    return f"{prefix(file_key, etag)}{name}.parquet"
+
+
+def _json_name(name):
+    # Header cells can be numbers or dates; anything JSON cannot hold is kept as its text
+    return name if name is None or isinstance(name, (str, int, float, bool)) else str(name)
+
+
+def to_arrow(table, sheet_name=None):
+    # Positional field names ("<i>", plus "<i>.text" for a number column's source text); the real
+    # (possibly empty or repeated) names go in the metadata
+    fields, arrays = [], []
+    for i, column in enumerate(table.columns):
+        fields.append(str(i))
+        arrays.append(pa.array(column.values, type=getattr(pa, ARROW_TYPES[column.kind])(), mask=column.mask))
+        if column.text is not None:
+            fields.append(f"{i}.text")
+            arrays.append(pa.array(column.text, type=pa.string(), mask=column.mask))
+    metadata = {
+        'names': json.dumps([_json_name(name) for name in table.names]),
+        'kinds': json.dumps([column.kind for column in table.columns]),
+        'text': json.dumps([i for i, column in enumerate(table.columns) if column.text is not None]),
+        'sheet': json.dumps(_json_name(sheet_name)),
+    }
+    schema = pa.schema([pa.field(name, array.type) for name, array in zip(fields, arrays)], metadata=metadata)
+    return pa.Table.from_arrays(arrays, schema=schema)
+
+
+def _column(array, kind, text=None):
+    mask = array.is_null().to_numpy(zero_copy_only=False)
+    values = array.fill_null(FILL[kind]).to_numpy(zero_copy_only=False)
+    if kind in NUMPY_KINDS:
+        values = values.astype(NUMPY_KINDS[kind], copy=False)
+    if text is not None:
+        text = text.fill_null('').to_numpy(zero_copy_only=False).astype(object)
+    return ingest.Column(kind, values, mask, text)
+
+
+def _read(parquet_file, columns=None):
+    metadata = parquet_file.schema_arrow.metadata
+    names = json.loads(metadata[b'names'])
+    kinds = json.loads(metadata[b'kinds'])
+    with_text = set(json.loads(metadata.get(b'text', b'[]')))
+    positions = range(len(names)) if columns is None else [names.index(name) for name in columns]
+    fields = [str(i) for i in positions] + [f"{i}.text" for i in positions if i in with_text]
+    arrow_table = parquet_file.read(columns=fields)
+    return ingest.Table([names[i] for i in positions],
+                        [_column(arrow_table.column(str(i)), kinds[i],
+                                 arrow_table.column(f"{i}.text") if i in with_text else None)
+                         for i in positions])
+
+
+def from_bytes(data, columns=None):
+    return _read(pq.ParquetFile(pa.BufferReader(data)), columns)
+
+
+def to_bytes(table, sheet_name=None):
+    out = io.BytesIO()
+    pq.write_table(to_arrow(table, sheet_name), out, compression=COMPRESSION)
+    return out.getvalue()
+
+
+def _missing(error):
+    return error.response.get('Error', {}).get('Code') in ('NoSuchKey', '404', 'NotFound')
+
+
+def _read_sheet(s3_client, bucket_name, key, columns):
+    try:
+        s3_object = s3_client.get_object(Bucket=bucket_name, Key=key) if columns is None else \
+            s3_client.head_object(Bucket=bucket_name, Key=key)
+    except ClientError as e:
+        if _missing(e):
+            return None
+        raise
+    if columns is None:
+        # Everything is needed: one (parallel, for large files) download
+        with contextlib.closing(s3stream.open_body(s3_client, bucket_name, key, s3_object)) as body:
+            return from_bytes(body.read())
+    # Only the footer and the projected column chunks
+    source = s3stream.ObjectFile(s3_client, bucket_name, key, s3_object['ContentLength'], s3_object['ETag'])
+    return _read(pq.ParquetFile(source), columns)
+
+
+def read_tables(s3_client, bucket_name, file_key, etag, sheets=None, columns=None):
+    # {sheet name: table} like s3cache.get_sheets (None: the active sheet), or None when any
+    # requested sheet has no sidecar yet
+    if sheets == 'all':
+        try:
+            manifest = s3_client.get_object(Bucket=bucket_name, Key=prefix(file_key, etag) + SHEETS_MANIFEST)
+        except ClientError as e:
+            if _missing(e):
+                return None
+            raise
+        sheets = json.loads(manifest['Body'].read())
+    tables = {}
+    for sheet_name in (sheets or [None]):
+        table = _read_sheet(s3_client, bucket_name, sheet_key(file_key, etag, sheet_name), columns)
+        if table is None:
+            return None
+        tables[sheet_name] = table
+    return tables
+
+
+def write_tables(s3_client, bucket_name, file_key, etag, tables, all_sheets=False):
+    # Store parsed tables ({sheet name or None: table}); all_sheets records the workbook's sheet list
+    try:
+        for sheet_name, table in tables.items():
+            s3_client.put_object(Bucket=bucket_name, Key=sheet_key(file_key, etag, sheet_name),
+                                 Body=to_bytes(table, sheet_name), ContentType='application/vnd.apache.parquet')
+        if all_sheets:
+            s3_client.put_object(Bucket=bucket_name, Key=prefix(file_key, etag) + SHEETS_MANIFEST,
+                                 Body=json.dumps(list(tables)).encode('utf-8'), ContentType='application/json')
+        return True
+    except ClientError as e:
+        logging.warning(f"Could not write the Parquet sidecar for s3://{bucket_name}/{file_key}: {e}")
+        return False
@@ -0,0 +1,99 @@
+# Token streaming for Messages API requests via invoke_model_with_response_stream.
+#
+# MessageStream is an iterable of text deltas, so a UI can render the answer as it
+# is generated. Once iteration finishes it carries the full text, token usage,
+# stop reason, time to first token and total latency.
+
+import time
+
+import codec
+import ratelimit
+
+MODEL_ID = "anthropic.claude-3-sonnet-20240229-v1:0"
+
+
+class MessageStream:
+    def __init__(self, client, request_body, model_id=MODEL_ID):
+        self.model_id = model_id
+        self.usage = {}
+        self.stop_reason = None
+        self.invocation_metrics = {}
+        self.time_to_first_token = None
+        self.total_latency = None
+        self._parts = []
+        self._started = time.perf_counter()
+        body = request_body if isinstance(request_body, codec.EncodedRequest) else codec.encode(request_body)
+        response = ratelimit.call(model_id, body.tokens,
+                                  lambda: client.invoke_model_with_response_stream(modelId=model_id, body=body.data))
+        self._events = response['body']
+
+    def __iter__(self):
+        for event in self._events:
+            chunk = event.get('chunk')
+            if not chunk:
+                continue
+            data = codec.loads(chunk['bytes'])
+            kind = data.get('type')
+            if kind == 'message_start':
+                self.usage.update(data.get('message', {}).get('usage', {}))
+            elif kind == 'content_block_delta' and data.get('delta', {}).get('type') == 'text_delta':
+                if self.time_to_first_token is None:
+                    self.time_to_first_token = time.perf_counter() - self._started
+                text = data['delta']['text']
+                self._parts.append(text)
+                yield text
+            elif kind == 'message_delta':
+                self.usage.update(data.get('usage', {}))
+                self.stop_reason = data.get('delta', {}).get('stop_reason')
+            elif kind == 'message_stop':
+                self.invocation_metrics = data.get('amazon-bedrock-invocationMetrics', {})
+        self.total_latency = time.perf_counter() - self._started
+
+    @property
+    def text(self):
+        return "".join(self._parts)
+
+    def stats(self):
+        return {
+            'input_tokens': self.usage.get('input_tokens'),
+            'output_tokens': self.usage.get('output_tokens'),
+            'stop_reason': self.stop_reason,
+            'time_to_first_token': self.time_to_first_token,
+            'total_latency': self.total_latency,
+        }
+
+    def payload(self):
+        # Messages-shaped payload equivalent to the non-streaming response
+        return {
+            'type': 'message',
+            'role': 'assistant',
+            'model': self.model_id,
+            'content': [{'type': 'text', 'text': self.text}],
+            'stop_reason': self.stop_reason,
+            'usage': self.usage,
+            'metrics': self.stats(),
+        }
+
+
+def prompt_body(prompt, max_tokens=900):
+    # The encoded request stream_text sends; callers that route on its size encode it once here
+    return codec.encode({
+        "anthropic_version": "bedrock-2023-05-31",
+        "max_tokens": max_tokens,
+        "temperature": 0,
+        "messages": [
+            {
+                "role": "user",
+                "content": [
+                    {
+                        "type": "text",
+                        "text": prompt
+                    }
+                ]
+            }
+        ]
+    })
+
+
+def stream_text(client, prompt, max_tokens=900, model_id=MODEL_ID):
+    return MessageStream(client, prompt_body(prompt, max_tokens), model_id)
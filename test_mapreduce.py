@@ -0,0 +1,73 @@
+import io
+import json
+import threading
+
+import pytest
+
+import ingest
+import mapreduce
+import ratelimit
+import responsecache
+
+
+class FakeClient:
+    # Stand-in bedrock-runtime client that records every prompt it is sent
+    def __init__(self):
+        self.prompts = []
+        self._lock = threading.Lock()
+
+    def invoke_model(self, modelId, body, **kwargs):
+        prompt = json.loads(body)['messages'][0]['content'][0]['text']
+        with self._lock:
+            self.prompts.append(prompt)
+        if prompt.startswith("A spreadsheet was split"):
+            text = "final answer"
+        elif "Row 3," in prompt:
+            text = "3 matching rows"
+        else:
+            text = mapreduce.NO_DATA
+        payload = {'content': [{'type': 'text', 'text': text}], 'usage': {'input_tokens': 10, 'output_tokens': 2}}
+        return {'body': io.BytesIO(json.dumps(payload).encode('utf-8'))}
+
+
+@pytest.fixture(autouse=True)
+def no_response_cache(monkeypatch):
+    monkeypatch.setattr(responsecache, 'ENABLED', False)
+    ratelimit.reset()
+
+
+def table(rows):
+    return ingest.Table.from_rows(['Name', 'Amount'], [[f"Row {i}", i] for i in range(rows)])
+
+
+def test_split_chunks_keeps_header_in_every_chunk():
+    chunks = list(mapreduce.split_chunks({'S1': table(8)}, chunk_tokens=1))
+    assert len(chunks) == 8
+    for i, chunk in enumerate(chunks):
+        assert chunk.startswith("Sheet: S1\nName, Amount\n")
+        assert f"Row {i}," in chunk
+
+
+def test_eight_chunks_make_eight_map_calls_and_one_reduce():
+    client = FakeClient()
+    payload = mapreduce.run(client, "How many?", {'S1': table(8)}, chunk_tokens=1, concurrency=3)
+
+    assert len(client.prompts) == 9
+    assert sum(p.startswith("A spreadsheet was split") for p in client.prompts) == 1
+    assert payload['chunks'] == 8
+    assert mapreduce.response_text(payload) == "final answer"
+    assert payload['partials'][3] == "3 matching rows"
+    assert payload['total_usage'] == {'input_tokens': 90, 'output_tokens': 18}
+
+    reduce_prompt = next(p for p in client.prompts if p.startswith("A spreadsheet was split"))
+    assert "Part 4:\n3 matching rows" in reduce_prompt
+    assert mapreduce.NO_DATA not in reduce_prompt.split("Question:")[1]
+
+
+def test_single_chunk_skips_reduce():
+    client = FakeClient()
+    payload = mapreduce.run(client, "How many?", {'S1': table(8)})
+
+    assert len(client.prompts) == 1
+    assert payload['chunks'] == 1
+    assert payload['partials'] == ["3 matching rows"]
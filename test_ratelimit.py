@@ -0,0 +1,110 @@
+import pytest
+from botocore.exceptions import ClientError, ReadTimeoutError
+
+import ratelimit
+
+MODEL_ID = "test-model"
+
+
+def client_error(code, status=400):
+    return ClientError({'Error': {'Code': code, 'Message': code},
+                        'ResponseMetadata': {'HTTPStatusCode': status}}, 'InvokeModel')
+
+
+class Flaky:
+    # Stand-in for a Bedrock call: raises the given errors in turn, then succeeds
+    def __init__(self, *errors):
+        self.errors = list(errors)
+        self.calls = 0
+
+    def __call__(self):
+        self.calls += 1
+        if self.errors:
+            raise self.errors.pop(0)
+        return 'ok'
+
+
+@pytest.fixture(autouse=True)
+def fast_backoff(monkeypatch):
+    # Short backoff and a high request rate, so waits after a throttle stay short
+    monkeypatch.setattr(ratelimit, 'BACKOFF_BASE', 0.001)
+    monkeypatch.setattr(ratelimit, 'REQUESTS_PER_MINUTE', 60000)
+    ratelimit.reset()
+    yield
+    ratelimit.reset()
+
+
+def test_throttle_then_success_after_retry():
+    fn = Flaky(client_error('ThrottlingException'))
+    assert ratelimit.call(MODEL_ID, 100, fn) == 'ok'
+    assert fn.calls == 2
+    assert ratelimit.limiter(MODEL_ID).stats()['throttles'] == 1
+
+
+def test_transient_errors_are_retried_without_slowing_down():
+    fn = Flaky(client_error('InternalServerException', 500), client_error('BadGateway', 502),
+               ReadTimeoutError(endpoint_url='https://bedrock-runtime'))
+    assert ratelimit.call(MODEL_ID, 100, fn) == 'ok'
+    assert fn.calls == 4
+    assert ratelimit.limiter(MODEL_ID).stats()['throttles'] == 0
+
+
+def test_retries_complete_requests_that_retry_free_calls_lose():
+    # A service that throttles every other call: plain calls lose half the requests
+    calls = []
+
+    def service():
+        calls.append(1)
+        if len(calls) % 2:
+            raise client_error('ThrottlingException')
+        return 'ok'
+
+    plain = 0
+    for _ in range(10):
+        try:
+            plain += service() == 'ok'
+        except ClientError:
+            pass
+    limited = sum(ratelimit.call(MODEL_ID, 0, service) == 'ok' for _ in range(10))
+    assert plain == 5
+    assert limited == 10
+
+
+def test_other_errors_are_raised_at_once():
+    fn = Flaky(client_error('ValidationException'))
+    with pytest.raises(ClientError):
+        ratelimit.call(MODEL_ID, 100, fn)
+    assert fn.calls == 1
+
+
+def test_gives_up_after_max_attempts():
+    fn = Flaky(*[client_error('ThrottlingException') for _ in range(5)])
+    with pytest.raises(ClientError):
+        ratelimit.call(MODEL_ID, 100, fn, max_attempts=3)
+    assert fn.calls == 3
+
+
+def test_throttling_lowers_the_rate_and_success_raises_it_again():
+    limiter = ratelimit.RateLimiter(requests_per_minute=60, tokens_per_minute=60000)
+    limiter.throttled()
+    assert limiter.stats()['requests_per_minute'] == pytest.approx(60 * ratelimit.DECREASE_FACTOR)
+    for _ in range(100):
+        limiter.succeeded()
+    assert limiter.stats()['requests_per_minute'] == pytest.approx(60)
+
+
+def test_wait_longer_than_the_deadline_raises():
+    limiter = ratelimit.RateLimiter(requests_per_minute=6)
+    limiter.acquire()
+    with ratelimit.deadline(0.5):
+        with pytest.raises(ratelimit.DeadlineExceeded):
+            limiter.acquire()
+
+
+def test_backoff_past_the_deadline_raises_the_last_error(monkeypatch):
+    monkeypatch.setattr(ratelimit, 'backoff', lambda attempt: 10.0)
+    fn = Flaky(client_error('ThrottlingException'))
+    with ratelimit.deadline(1.0):
+        with pytest.raises(ClientError):
+            ratelimit.call(MODEL_ID, 100, fn)
+    assert fn.calls == 1
@@ -0,0 +1,83 @@
+import threading
+
+import pytest
+
+import ratelimit
+import sch
+
+PREFIX_TOKENS = 3000
+REPLY = 'Relevant quotes:\n[1] "Evaluations are hard."\n\nAnswer: They are hard to build.'
+
+
+class FakeClient:
+    # Stand-in bedrock-runtime client with Converse prompt caching: the first request
+    # writes the prefix before the cache point, later ones with the same prefix read it
+    def __init__(self):
+        self.requests = []
+        self.cached = set()
+        self._lock = threading.Lock()
+
+    def converse(self, **request):
+        content = request['messages'][0]['content']
+        prefix = content[0]['text']
+        with self._lock:
+            self.requests.append(request)
+            hit = prefix in self.cached
+            self.cached.add(prefix)
+        return {
+            'output': {'message': {'role': 'assistant', 'content': [{'text': REPLY}]}},
+            'usage': {
+                'inputTokens': 20,
+                'outputTokens': 15,
+                'cacheReadInputTokens': PREFIX_TOKENS if hit else 0,
+                'cacheWriteInputTokens': 0 if hit else PREFIX_TOKENS,
+            },
+            'stopReason': 'end_turn',
+        }
+
+
+@pytest.fixture(autouse=True)
+def fresh_limiters():
+    ratelimit.reset()
+
+
+def test_document_sits_before_a_cache_point():
+    client = FakeClient()
+    sch.DocumentSession(client, document="Some document.").ask("What is it?")
+
+    request = client.requests[0]
+    content = request['messages'][0]['content']
+    assert request['modelId'] == sch.CACHE_MODEL_ID
+    assert "Some document." in content[0]['text']
+    assert content[1] == {'cachePoint': {'type': 'default'}}
+    assert "What is it?" in content[2]['text']
+    assert "Some document." not in content[2]['text']
+
+
+def test_sequential_questions_read_the_cached_document():
+    client = FakeClient()
+    session = sch.DocumentSession(client, document="Some document.")
+    results = session.ask_all(["One?", "Two?", "Three?"])
+
+    assert [r['question'] for r in results] == ["One?", "Two?", "Three?"]
+    assert results[0]['answer'] == "They are hard to build."
+    assert results[0]['quotes'][0]['text'] == "Evaluations are hard."
+    assert results[0]['usage']['cacheWriteInputTokens'] == PREFIX_TOKENS
+    assert all(r['usage']['cacheReadInputTokens'] == PREFIX_TOKENS for r in results[1:])
+
+    stats = session.stats()
+    assert stats['calls'] == 3
+    assert stats['cacheWriteInputTokens'] == PREFIX_TOKENS
+    assert stats['cacheReadInputTokens'] == 2 * PREFIX_TOKENS
+    assert stats['cache_read_share'] == pytest.approx(2 * PREFIX_TOKENS / (60 + 3 * PREFIX_TOKENS))
+
+
+def test_concurrent_questions_run_after_a_warm_up_call():
+    client = FakeClient()
+    session = sch.DocumentSession(client, document="Some document.")
+    questions = [f"Question {i}?" for i in range(6)]
+    results = session.ask_all(questions, concurrency=4)
+
+    assert [r['question'] for r in results] == questions
+    assert session.stats()['cacheWriteInputTokens'] == PREFIX_TOKENS
+    assert session.stats()['cacheReadInputTokens'] == 5 * PREFIX_TOKENS
@@ -0,0 +1,28 @@
+# Tokenizer-free token estimate for prompt text.
+#
+# Claude's tokenizer is not available offline, so we approximate it: runs of letters
+# or digits cost roughly one token per four characters, and every other non-space
+# character (punctuation, separators) costs about one token on its own.
+
+import math
+import re
+
+_PIECES = re.compile(r"[A-Za-z]+|[0-9]+|[^\sA-Za-z0-9]")
+
+# Average characters per token for alphabetic and numeric runs
+CHARS_PER_TOKEN = 4
+DIGITS_PER_TOKEN = 3
+
+
+def estimate_tokens(text):
+    if not text:
+        return 0
+    count = 0
+    for piece in _PIECES.findall(text):
+        if piece[0].isalpha():
+            count += math.ceil(len(piece) / CHARS_PER_TOKEN)
+        elif piece[0].isdigit():
+            count += math.ceil(len(piece) / DIGITS_PER_TOKEN)
+        else:
+            count += 1
+    return count
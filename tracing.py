@@ -0,0 +1,228 @@
+# Lightweight per-stage tracing for the request pipeline.
+#
+# A trace covers one request (a Lambda invocation, a process_event call). Inside
+# it, `with tracing.span('s3_get'):` times a stage and tracing.count() adds to a
+# counter such as rows, prompt_bytes or input_tokens. Spans and counters outside
+# a trace are no-ops, so shared modules can instrument themselves unconditionally.
+#
+# A finished trace is added to in-process histograms (stats()) and exported as
+# a CloudWatch Embedded Metric Format log line when TRACE_EXPORT=emf, the
+# default on Lambda, or as a plain debug log with TRACE_EXPORT=log. Each span
+# costs two perf_counter() calls and a dict update, about a microsecond.
+
+import contextvars
+import functools
+import json
+import logging
+import math
+import os
+import threading
+import time
+from collections import defaultdict
+
+NAMESPACE = os.environ.get('METRICS_NAMESPACE', 'BedrockTableQA')
+EXPORT = os.environ.get('TRACE_EXPORT', 'emf' if os.environ.get('AWS_LAMBDA_FUNCTION_NAME') else 'none')
+BUCKET_GROWTH = 1.1       # histogram buckets are 10% wide
+
+_current = contextvars.ContextVar('trace', default=None)
+_lock = threading.Lock()
+
+
+def _unit(name):
+    if name.endswith('bytes'):
+        return 'Bytes'
+    return 'Count'
+
+
+class Histogram:
+    # Log-bucketed histogram: constant memory, percentiles within one bucket width
+    def __init__(self):
+        self.buckets = defaultdict(int)
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+
+    def add(self, value):
+        self.buckets[math.floor(math.log(value, BUCKET_GROWTH)) if value > 0 else None] += 1
+        self.count += 1
+        self.total += value
+        self.max = max(self.max, value)
+
+    def percentile(self, q):
+        rank = q * self.count
+        seen = 0
+        for bucket in sorted(self.buckets, key=lambda b: -math.inf if b is None else b):
+            seen += self.buckets[bucket]
+            if seen >= rank:
+                return 0.0 if bucket is None else BUCKET_GROWTH ** (bucket + 1)
+        return self.max
+
+    def summary(self):
+        return {
+            'count': self.count,
+            'mean': self.total / self.count if self.count else 0.0,
+            'p50': self.percentile(0.5),
+            'p90': self.percentile(0.9),
+            'p99': self.percentile(0.99),
+            'max': self.max,
+        }
+
+
+_histograms = defaultdict(Histogram)    # (operation, metric) -> Histogram
+
+
+class _Span:
+    __slots__ = ('trace', 'name', 'started')
+
+    def __init__(self, trace, name):
+        self.trace = trace
+        self.name = name
+
+    def __enter__(self):
+        self.started = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        spans = self.trace.spans
+        spans[self.name] = spans.get(self.name, 0.0) + time.perf_counter() - self.started
+        return False
+
+
+class _NoSpan:
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+
+_NO_SPAN = _NoSpan()
+
+
+class Trace:
+    def __init__(self, operation, **dimensions):
+        self.operation = operation
+        self.dimensions = dimensions
+        self.spans = {}
+        self.counters = {}
+        self.error = None
+        self.started = time.perf_counter()
+        self.total = None
+
+    def span(self, name):
+        return _Span(self, name)
+
+    def count(self, name, value=1):
+        self.counters[name] = self.counters.get(name, 0) + value
+
+    def summary(self):
+        # Milliseconds per stage, plus the counters
+        return {
+            'operation': self.operation,
+            'total_ms': (self.total if self.total is not None else time.perf_counter() - self.started) * 1000,
+            'spans_ms': {name: seconds * 1000 for name, seconds in self.spans.items()},
+            'counters': dict(self.counters),
+            'error': self.error,
+        }
+
+    def finish(self):
+        self.total = time.perf_counter() - self.started
+        with _lock:
+            _histograms[(self.operation, 'total_ms')].add(self.total * 1000)
+            for name, seconds in self.spans.items():
+                _histograms[(self.operation, name + '_ms')].add(seconds * 1000)
+            for name, value in self.counters.items():
+                _histograms[(self.operation, name)].add(value)
+        if EXPORT == 'emf':
+            print(json.dumps(emf(self)))
+        elif EXPORT == 'log':
+            logging.debug(f"Trace: {self.summary()}")
+        return self.summary()
+
+
+def emf(trace):
+    # CloudWatch Embedded Metric Format record: one log line that CloudWatch turns into metrics
+    summary = trace.summary()
+    metrics = [{'Name': 'total_ms', 'Unit': 'Milliseconds'}]
+    record = dict(trace.dimensions, Operation=trace.operation, total_ms=summary['total_ms'])
+    for name, value in summary['spans_ms'].items():
+        metrics.append({'Name': name + '_ms', 'Unit': 'Milliseconds'})
+        record[name + '_ms'] = value
+    for name, value in summary['counters'].items():
+        metrics.append({'Name': name, 'Unit': _unit(name)})
+        record[name] = value
+    if trace.error:
+        metrics.append({'Name': 'errors', 'Unit': 'Count'})
+        record['errors'] = 1
+        record['error'] = trace.error
+    record['_aws'] = {
+        'Timestamp': int(time.time() * 1000),
+        'CloudWatchMetrics': [{
+            'Namespace': NAMESPACE,
+            'Dimensions': [['Operation'] + sorted(trace.dimensions)],
+            'Metrics': metrics,
+        }],
+    }
+    return record
+
+
+def current():
+    return _current.get()
+
+
+def span(name):
+    trace = _current.get()
+    return _NO_SPAN if trace is None else _Span(trace, name)
+
+
+def count(name, value=1):
+    trace = _current.get()
+    if trace is not None:
+        trace.counters[name] = trace.counters.get(name, 0) + value
+
+
+def usage(payload_usage):
+    # Token usage from an invoke_model (input_tokens) or Converse (inputTokens) response
+    for name, keys in (('input_tokens', ('input_tokens', 'inputTokens')),
+                       ('output_tokens', ('output_tokens', 'outputTokens'))):
+        for key in keys:
+            if isinstance((payload_usage or {}).get(key), int):
+                count(name, payload_usage[key])
+
+
+def traced(operation, attach=False, **dimensions):
+    # Decorator: run the function as one trace. With attach=True a dict result gets
+    # the trace summary under 'trace' (for callers that display the breakdown).
+    def decorate(fn):
+        @functools.wraps(fn)
+        def wrapper(*args, **kwargs):
+            trace = Trace(operation, **dimensions)
+            token = _current.set(trace)
+            try:
+                result = fn(*args, **kwargs)
+            except Exception as e:
+                trace.error = str(e)
+                trace.finish()
+                raise
+            finally:
+                _current.reset(token)
+            # Handlers report failures in their result rather than raising
+            if isinstance(result, dict) and (result.get('error') or result.get('statusCode', 200) >= 500):
+                trace.error = str(result.get('error') or result.get('body'))
+            summary = trace.finish()
+            if attach and isinstance(result, dict):
+                result['trace'] = summary
+            return result
+        return wrapper
+    return decorate
+
+
+def stats():
+    # Histogram summaries per operation and metric
+    with _lock:
+        return {f"{operation}.{metric}": histogram.summary() for (operation, metric), histogram in _histograms.items()}
+
+
+def reset():
+    with _lock:
+        _histograms.clear()